@@ -0,0 +1,66 @@
+import argparse
+import time
+
+import torch
+
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import Attention
+
+# forward and backward time and peak memory of the mid block attention, across feature map sizes, for
+# scaled dot product attention, the chunked fallback, and the fallback with a single chunk (the full similarity matrix)
+#
+#   python benchmarks/attention.py --sizes 16 32 64 --device cuda
+#
+# peak memory is only reported on cuda
+
+def benchmark(attn, x, repeats, device):
+    def step():
+        attn(x).sum().backward()
+
+    step()
+
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        step()
+
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+    elapsed = (time.perf_counter() - start) / repeats
+    peak_memory = torch.cuda.max_memory_allocated() / 2 ** 20 if device.startswith('cuda') else None
+    return elapsed, peak_memory
+
+def main():
+    parser = argparse.ArgumentParser(description = 'time and peak memory of sdpa against the chunked attention fallback')
+    parser.add_argument('--dim', type = int, default = 256)
+    parser.add_argument('--batch-size', type = int, default = 4)
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [16, 32, 64])
+    parser.add_argument('--query-chunk-size', type = int, default = 1024)
+    parser.add_argument('--repeats', type = int, default = 5)
+    parser.add_argument('--device', default = 'cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        num_queries = size * size
+
+        variants = (
+            ('sdpa', dict()),
+            ('chunked', dict(use_sdpa = False, query_chunk_size = args.query_chunk_size)),
+            ('unchunked', dict(use_sdpa = False, query_chunk_size = num_queries))
+        )
+
+        x = torch.randn(args.batch_size, args.dim, size, size, device = args.device, requires_grad = True)
+
+        for name, kwargs in variants:
+            attn = Attention(args.dim, **kwargs).to(args.device)
+            elapsed, peak_memory = benchmark(attn, x, args.repeats, args.device)
+
+            memory = f', peak memory {peak_memory:.0f} MiB' if peak_memory is not None else ''
+            print(f'{size}x{size} ({num_queries} queries) {name}: {elapsed * 1e3:.1f} ms forward and backward{memory}')
+
+if __name__ == '__main__':
+    main()
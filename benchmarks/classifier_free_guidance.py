@@ -0,0 +1,60 @@
+import argparse
+import time
+
+import torch
+
+from denoising_diffusion_pytorch.classifier_free_guidance import Unet
+
+# time of one guided step of forward_with_cond_scale, with the conditional and null class passes batched into one forward or run separately
+#
+#   python benchmarks/classifier_free_guidance.py --configs 16:16 32:32 --batch-size 2 --threads 1
+#
+# every config is dim:image_size
+
+def timed(fn, repeats):
+    fn()
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        fn()
+
+    return (time.perf_counter() - start) / repeats
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description = 'time of a guided step with batched against two pass guidance')
+    parser.add_argument('--configs', nargs = '+', default = ['16:16', '32:32'], help = 'dim:image_size of every unet to time')
+    parser.add_argument('--dim-mults', type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument('--batch-size', type = int, default = 2)
+    parser.add_argument('--cond-scale', type = float, default = 6.)
+    parser.add_argument('--threads', type = int, default = 1)
+    parser.add_argument('--repeats', type = int, default = 20)
+    parser.add_argument('--device', default = 'cpu')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+
+    print(f'batch {args.batch_size}, dim mults {tuple(args.dim_mults)}, {args.threads} threads, {args.device}')
+
+    for config in args.configs:
+        dim, image_size = map(int, config.split(':'))
+
+        model = Unet(dim = dim, dim_mults = tuple(args.dim_mults), num_classes = 10).to(args.device).eval()
+
+        x = torch.randn(args.batch_size, 3, image_size, image_size, device = args.device)
+        t = torch.randint(0, 1000, (args.batch_size,), device = args.device)
+        classes = torch.randint(0, 10, (args.batch_size,), device = args.device)
+
+        def step(batched_guidance):
+            model.forward_with_cond_scale(x, t, classes, cond_scale = args.cond_scale, batched_guidance = batched_guidance)
+
+            if args.device.startswith('cuda'):
+                torch.cuda.synchronize()
+
+        two_pass_time = timed(lambda: step(False), args.repeats)
+        batched_time = timed(lambda: step(True), args.repeats)
+
+        print(f'dim {dim} / {image_size}px: {two_pass_time * 1e3:.0f} ms -> {batched_time * 1e3:.0f} ms ({two_pass_time / batched_time:.2f}x)')
+
+if __name__ == '__main__':
+    main()
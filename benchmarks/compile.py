@@ -0,0 +1,83 @@
+import argparse
+import time
+
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+
+# time of a training step and of a ddim sampling step, eager against GaussianDiffusion(compile = True)
+#
+#   python benchmarks/compile.py --dim 64 --image-size 64 --batch-size 16 --device cuda
+#
+# the first calls, which compile the graphs, are left out of the timings and reported separately
+
+def synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+def timed(fn, repeats, device):
+    synchronize(device)
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        fn()
+
+    synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+def main():
+    parser = argparse.ArgumentParser(description = 'training and sampling step time of the eager and compiled unet')
+    parser.add_argument('--dim', type = int, default = 32)
+    parser.add_argument('--dim-mults', type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument('--image-size', type = int, default = 32)
+    parser.add_argument('--batch-size', type = int, default = 8)
+    parser.add_argument('--sampling-timesteps', type = int, default = 10)
+    parser.add_argument('--repeats', type = int, default = 5)
+    parser.add_argument('--device', default = 'cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    shape = (args.batch_size, 3, args.image_size, args.image_size)
+    images = torch.rand(shape, device = args.device)
+
+    results = dict()
+
+    for compile in (False, True):
+        torch.manual_seed(0)
+
+        diffusion = GaussianDiffusion(
+            Unet(dim = args.dim, dim_mults = tuple(args.dim_mults)),
+            image_size = args.image_size,
+            timesteps = 1000,
+            sampling_timesteps = args.sampling_timesteps,
+            compile = compile
+        ).to(args.device)
+
+        opt = torch.optim.Adam(diffusion.parameters(), lr = 1e-4)
+
+        def train_step():
+            diffusion(images).backward()
+            opt.step()
+            opt.zero_grad()
+
+        def sample():
+            with torch.no_grad():
+                diffusion.ddim_sample(shape)
+
+        start = time.perf_counter()
+        train_step()
+        sample()
+        synchronize(args.device)
+        warmup_time = time.perf_counter() - start
+
+        train_time = timed(train_step, args.repeats, args.device)
+        sample_step_time = timed(sample, args.repeats, args.device) / args.sampling_timesteps
+
+        name = 'compiled' if compile else 'eager'
+        results[name] = (train_time, sample_step_time)
+        print(f'{name}: {train_time * 1e3:.0f} ms per training step, {sample_step_time * 1e3:.1f} ms per ddim step, first calls {warmup_time:.1f} s')
+
+    (eager_train, eager_sample), (compiled_train, compiled_sample) = results['eager'], results['compiled']
+    print(f'speedup: {eager_train / compiled_train:.2f}x training, {eager_sample / compiled_sample:.2f}x sampling')
+
+if __name__ == '__main__':
+    main()
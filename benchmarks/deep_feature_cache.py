@@ -0,0 +1,67 @@
+import argparse
+import time
+
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+
+# speed against deviation from uncached sampling, across feature_cache_interval
+#
+#   python benchmarks/deep_feature_cache.py --checkpoint ./results/model-100.pt --intervals 1 2 3 5
+#
+# every interval samples from the same seeds, and the deviation is the rmse of the images against those of interval 1
+# without a Trainer checkpoint the unet is untrained, which only measures the speed meaningfully
+
+def main():
+    parser = argparse.ArgumentParser(description = 'sampling time and deviation from uncached ddim sampling across feature cache intervals')
+    parser.add_argument('--checkpoint', default = None, help = 'path to a model-{milestone}.pt saved by the Trainer, whose ema weights are sampled from')
+    parser.add_argument('--dim', type = int, default = 64)
+    parser.add_argument('--dim-mults', type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument('--image-size', type = int, default = 32)
+    parser.add_argument('--timesteps', type = int, default = 1000)
+    parser.add_argument('--sampling-timesteps', type = int, default = 50)
+    parser.add_argument('--num-samples', type = int, default = 16)
+    parser.add_argument('--intervals', type = int, nargs = '+', default = [1, 2, 3, 5])
+    parser.add_argument('--device', default = 'cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    model = Unet(dim = args.dim, dim_mults = tuple(args.dim_mults))
+    seeds = list(range(args.num_samples))
+
+    def build(feature_cache_interval):
+        return GaussianDiffusion(
+            model,
+            image_size = args.image_size,
+            timesteps = args.timesteps,
+            sampling_timesteps = args.sampling_timesteps,
+            feature_cache_interval = feature_cache_interval
+        ).to(args.device)
+
+    if args.checkpoint is not None:
+        from denoising_diffusion_pytorch.generate import load_trainer_checkpoint
+        load_trainer_checkpoint(build(1), args.checkpoint)
+
+    uncached = None
+
+    for feature_cache_interval in [1, *(interval for interval in args.intervals if interval != 1)]:
+        diffusion = build(feature_cache_interval)
+
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+
+        start = time.perf_counter()
+        images = diffusion.sample(seeds = seeds)
+
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+
+        elapsed = time.perf_counter() - start
+
+        if uncached is None:
+            uncached, uncached_time = images, elapsed
+
+        rmse = (images - uncached).pow(2).mean().sqrt().item()
+        print(f'interval {feature_cache_interval}: {elapsed:.2f} s, {uncached_time / elapsed:.2f}x, rmse against uncached {rmse:.4f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import time
+
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+
+# training step time and activation memory of the unet, with and without per level gradient checkpointing
+#
+#   python benchmarks/gradient_checkpointing.py --dim 64 --image-size 64 --batch-size 16 --device cuda
+#
+# the memory is the peak allocated on cuda, and on cpu the size of the tensors saved for backward outside of the checkpoints
+
+def saved_activation_bytes(step):
+    storages = dict()
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step()
+
+    return sum(storages.values())
+
+def main():
+    parser = argparse.ArgumentParser(description = 'step time and memory of gradient checkpointing')
+    parser.add_argument('--dim', type = int, default = 64)
+    parser.add_argument('--dim-mults', type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument('--image-size', type = int, default = 64)
+    parser.add_argument('--batch-size', type = int, default = 8)
+    parser.add_argument('--repeats', type = int, default = 5)
+    parser.add_argument('--device', default = 'cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    is_cuda = args.device.startswith('cuda')
+    images = torch.rand(args.batch_size, 3, args.image_size, args.image_size, device = args.device)
+
+    for gradient_checkpointing in (False, True):
+        torch.manual_seed(0)
+
+        model = Unet(dim = args.dim, dim_mults = tuple(args.dim_mults), gradient_checkpointing = gradient_checkpointing)
+        diffusion = GaussianDiffusion(model, image_size = args.image_size, timesteps = 1000).to(args.device)
+
+        def step():
+            diffusion(images).backward()
+
+        step()
+
+        if is_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+
+        start = time.perf_counter()
+
+        for _ in range(args.repeats):
+            step()
+
+        if is_cuda:
+            torch.cuda.synchronize()
+
+        elapsed = (time.perf_counter() - start) / args.repeats
+        memory = torch.cuda.max_memory_allocated() if is_cuda else saved_activation_bytes(step)
+
+        name = 'checkpointed' if gradient_checkpointing else 'plain'
+        memory_name = 'peak memory' if is_cuda else 'saved activations'
+        print(f'{name}: {elapsed * 1e3:.0f} ms per step, {args.batch_size / elapsed:.1f} images / s, {memory_name} {memory / 2 ** 20:.0f} MiB')
+
+if __name__ == '__main__':
+    main()
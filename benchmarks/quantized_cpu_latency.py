@@ -0,0 +1,63 @@
+import argparse
+import copy
+import time
+
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+
+# cpu latency of one unet forward and of a full ddim sample, fp32 against int8 (quantize_for_cpu)
+#
+#   python benchmarks/quantized_cpu_latency.py --dim 32 --image-size 32 --threads 4
+#
+# the relative error of the int8 unet output against fp32 is reported alongside
+
+def timed(fn, repeats):
+    fn()
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        fn()
+
+    return (time.perf_counter() - start) / repeats
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description = 'cpu latency of the fp32 and int8 quantized unet')
+    parser.add_argument('--dim', type = int, default = 32)
+    parser.add_argument('--dim-mults', type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument('--image-size', type = int, default = 32)
+    parser.add_argument('--batch-size', type = int, default = 4)
+    parser.add_argument('--sampling-timesteps', type = int, default = 20)
+    parser.add_argument('--threads', type = int, default = 1)
+    parser.add_argument('--repeats', type = int, default = 10)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    fp32 = GaussianDiffusion(
+        Unet(dim = args.dim, dim_mults = tuple(args.dim_mults)),
+        image_size = args.image_size,
+        timesteps = 1000,
+        sampling_timesteps = args.sampling_timesteps
+    ).eval()
+
+    int8 = copy.deepcopy(fp32).quantize_for_cpu()
+
+    x = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+    t = torch.randint(0, 1000, (args.batch_size,))
+
+    fp32_out, int8_out = fp32.model(x, t), int8.model(x, t)
+    relative_error = ((int8_out - fp32_out).norm() / fp32_out.norm()).item()
+
+    print(f'unet dim {args.dim}, dim mults {tuple(args.dim_mults)}, {args.image_size}px, batch {args.batch_size}, {args.threads} threads')
+    print(f'relative error of the int8 unet output: {relative_error:.4f}')
+
+    for name, diffusion in (('fp32', fp32), ('int8', int8)):
+        forward_time = timed(lambda: diffusion.model(x, t), args.repeats)
+        sample_time = timed(lambda: diffusion.ddim_sample((args.batch_size, 3, args.image_size, args.image_size)), max(args.repeats // 5, 1))
+        print(f'{name}: {forward_time * 1e3:.1f} ms per forward, {sample_time:.2f} s per {args.sampling_timesteps} step ddim sample')
+
+if __name__ == '__main__':
+    main()
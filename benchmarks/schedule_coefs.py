@@ -0,0 +1,62 @@
+import argparse
+import time
+
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import ScheduleCoefs, extract
+
+# time to gather the schedule coefficients of a step, one extract per coefficient against the single gather of schedule_coefs
+#
+#   python benchmarks/schedule_coefs.py --batch-sizes 1 16 256 --device cuda
+#
+# the extracts of p_mean_variance (6) and of p_losses with pred_v (5) before the coefficient table are timed alongside
+
+def timed(fn, repeats, is_cuda):
+    for _ in range(10):
+        fn()
+
+    if is_cuda:
+        torch.cuda.synchronize()
+
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        fn()
+
+    if is_cuda:
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / repeats
+
+def main():
+    parser = argparse.ArgumentParser(description = 'time of gathering the schedule coefficients with extract against schedule_coefs')
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [1, 16, 256])
+    parser.add_argument('--image-size', type = int, default = 64)
+    parser.add_argument('--repeats', type = int, default = 1000)
+    parser.add_argument('--device', default = 'cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    is_cuda = args.device.startswith('cuda')
+    diffusion = GaussianDiffusion(Unet(dim = 8), image_size = args.image_size, timesteps = 1000).to(args.device)
+
+    names = {
+        'p_mean_variance': ('sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod', 'posterior_mean_coef1', 'posterior_mean_coef2', 'posterior_variance', 'posterior_log_variance_clipped'),
+        'p_losses': ('sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod', 'sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod', 'p2_loss_weight'),
+        'all': ScheduleCoefs._fields
+    }
+
+    for batch_size in args.batch_sizes:
+        t = torch.randint(0, 1000, (batch_size,), device = args.device)
+        shape = (batch_size, 3, args.image_size, args.image_size)
+
+        gather_time = timed(lambda: diffusion.schedule_coefs(t, shape), args.repeats, is_cuda)
+        print(f'batch {batch_size}: schedule_coefs {gather_time * 1e6:.1f} us')
+
+        for name, buffer_names in names.items():
+            buffers = [getattr(diffusion, buffer_name) for buffer_name in buffer_names]
+            extract_time = timed(lambda: [extract(buffer, t, shape) for buffer in buffers], args.repeats, is_cuda)
+            print(f'batch {batch_size}: {len(buffers)} extracts ({name}) {extract_time * 1e6:.1f} us, {extract_time / gather_time:.2f}x')
+
+if __name__ == '__main__':
+    main()
@@ -8,3 +8,9 @@ from denoising_diffusion_pytorch.v_param_continuous_time_gaussian_diffusion impo
 
 from denoising_diffusion_pytorch.denoising_diffusion_pytorch_1d import GaussianDiffusion1D, Unet1D
 
+
+from denoising_diffusion_pytorch.continuous_batching import ContinuousBatchingSampler
+from denoising_diffusion_pytorch.fused_ema import FusedEMA
+from denoising_diffusion_pytorch.progressive_distillation import ProgressiveDistiller, progressive_distillation
+from denoising_diffusion_pytorch.consistency_distillation import ConsistencyDistiller
+from denoising_diffusion_pytorch.sharded_dataset import ShardedImageDataset, write_image_shards
@@ -9,16 +9,35 @@ from multiprocessing import cpu_count
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from einops import rearrange, reduce, repeat
 from einops.layers.torch import Rearrange
 
 from tqdm.auto import tqdm
 
+from denoising_diffusion_pytorch.multistep_solvers import dpm_solver_pp_sample, unipc_sample
+from denoising_diffusion_pytorch.sample_rng import SampleRNG
+
 # constants
 
 ModelPrediction =  namedtuple('ModelPrediction', ['pred_noise', 'pred_x_start'])
 
+# per timestep coefficients of the noise schedule, gathered together
+
+ScheduleCoefs = namedtuple('ScheduleCoefs', [
+    'betas',
+    'sqrt_alphas_cumprod',
+    'sqrt_one_minus_alphas_cumprod',
+    'sqrt_recip_alphas_cumprod',
+    'sqrt_recipm1_alphas_cumprod',
+    'posterior_variance',
+    'posterior_log_variance_clipped',
+    'posterior_mean_coef1',
+    'posterior_mean_coef2',
+    'p2_loss_weight'
+])
+
 # helpers functions
 
 def exists(x):
@@ -98,16 +117,43 @@ class WeightStandardizedConv2d(nn.Conv2d):
     https://arxiv.org/abs/1903.10520
     weight standardization purportedly works synergistically with group normalization
     """
-    def forward(self, x):
-        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
-
+    def normalized_weight(self, eps):
         weight = self.weight
         mean = reduce(weight, 'o ... -> o 1 1 1', 'mean')
         var = reduce(weight, 'o ... -> o 1 1 1', partial(torch.var, unbiased = False))
-        normalized_weight = (weight - mean) * (var + eps).rsqrt()
+        return (weight - mean) * (var + eps).rsqrt()
+
+    def forward(self, x):
+        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
+        normalized_weight = self.normalized_weight(eps)
 
         return F.conv2d(x, normalized_weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
 
+    @torch.no_grad()
+    def to_conv(self):
+        weight = self.weight
+        eps = 1e-5 if weight.dtype == torch.float32 else 1e-3
+
+        conv = nn.Conv2d(
+            self.in_channels,
+            self.out_channels,
+            self.kernel_size,
+            stride = self.stride,
+            padding = self.padding,
+            dilation = self.dilation,
+            groups = self.groups,
+            bias = exists(self.bias),
+            device = weight.device,
+            dtype = weight.dtype
+        )
+
+        conv.weight.copy_(self.normalized_weight(eps))
+
+        if exists(self.bias):
+            conv.bias.copy_(self.bias)
+
+        return conv
+
 class LayerNorm(nn.Module):
     def __init__(self, dim):
         super().__init__()
@@ -241,29 +287,66 @@ class LinearAttention(nn.Module):
         return self.to_out(out)
 
 class Attention(nn.Module):
-    def __init__(self, dim, heads = 4, dim_head = 32):
+    def __init__(self, dim, heads = 4, dim_head = 32, use_sdpa = True, query_chunk_size = 1024):
         super().__init__()
         self.scale = dim_head ** -0.5
         self.heads = heads
         hidden_dim = dim_head * heads
 
+        # use the fused scaled dot product attention when available (pytorch 2.0 and above), and chunk the queries otherwise
+
+        self.use_sdpa = use_sdpa and hasattr(F, 'scaled_dot_product_attention')
+        self.query_chunk_size = query_chunk_size
+
         self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
         self.to_out = nn.Conv2d(hidden_dim, dim, 1)
 
+    def attend(self, q, k, v):
+        if self.use_sdpa:
+            q, k, v = map(lambda t: t.contiguous(), (q, k, v)) # the fused kernels need the head dimension to be contiguous
+            return F.scaled_dot_product_attention(q, k, v) # default scale of dim_head ** -0.5 is the same as self.scale
+
+        # fallback, where the similarity matrix is only ever materialized for a chunk of queries at a time, bounding peak memory
+
+        q = q * self.scale
+
+        out = []
+
+        for q_chunk in q.split(self.query_chunk_size, dim = -2):
+            sim = einsum('b h i d, b h j d -> b h i j', q_chunk, k)
+            attn = sim.softmax(dim = -1)
+            out.append(einsum('b h i j, b h j d -> b h i d', attn, v))
+
+        return torch.cat(out, dim = -2)
+
     def forward(self, x):
         b, c, h, w = x.shape
         qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
-
-        q = q * self.scale
+        q, k, v = map(lambda t: rearrange(t, 'b (h d) x y -> b h (x y) d', h = self.heads), qkv)
 
-        sim = einsum('b h d i, b h d j -> b h i j', q, k)
-        attn = sim.softmax(dim = -1)
-        out = einsum('b h i j, b h d j -> b h i d', attn, v)
+        out = self.attend(q, k, v)
 
         out = rearrange(out, 'b h (x y) d -> b (h d) x y', x = h, y = w)
         return self.to_out(out)
 
+# activation checkpointing, where the resnet blocks and attention of a resolution level are recomputed during backward
+
+def down_level(block1, block2, attn, x, *cond):
+    skip = block1(x, *cond)
+    x = block2(skip, *cond)
+    x = attn(x)
+    return skip, x
+
+def mid_level(block1, attn, block2, x, *cond):
+    x = block1(x, *cond)
+    x = attn(x)
+    return block2(x, *cond)
+
+def up_level(block1, block2, attn, x, first_skip, second_skip, *cond):
+    x = block1(torch.cat((x, first_skip), dim = 1), *cond)
+    x = block2(torch.cat((x, second_skip), dim = 1), *cond)
+    return attn(x)
+
 # model
 
 class Unet(nn.Module):
@@ -281,6 +364,7 @@ class Unet(nn.Module):
         learned_sinusoidal_cond = False,
         random_fourier_features = False,
         learned_sinusoidal_dim = 16,
+        gradient_checkpointing = False
     ):
         super().__init__()
 
@@ -371,18 +455,82 @@ class Unet(nn.Module):
         self.final_res_block = block_klass(dim * 2, dim, time_emb_dim = time_dim, classes_emb_dim = classes_dim)
         self.final_conv = nn.Conv2d(dim, self.out_dim, 1)
 
+        # recompute the activations of each resolution level during backward, trading compute for memory
+
+        self.gradient_checkpointing = gradient_checkpointing
+
+        # weight standardized convs that were folded into plain convs for inference
+
+        self.standardized_convs = []
+
+    def run_level(self, fn, *args):
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint(fn, *args, use_reentrant = False)
+
+        return fn(*args)
+
+    @property
+    def frozen_for_inference(self):
+        return len(self.standardized_convs) > 0
+
+    @torch.no_grad()
+    def freeze_for_inference(self):
+        # weights are frozen while sampling, so the weight standardization can be folded into plain convs once
+        # the original convs are kept, and restored with unfreeze_for_training
+
+        if self.frozen_for_inference:
+            return self
+
+        for block in self.modules():
+            if not isinstance(block, Block):
+                continue
+
+            self.standardized_convs.append((block, block.proj))
+            block.proj = block.proj.to_conv()
+
+        return self
+
+    def unfreeze_for_training(self):
+        for block, standardized_conv in self.standardized_convs:
+            block.proj = standardized_conv
+
+        self.standardized_convs = []
+        return self
+
+    def _apply(self, fn, *args, **kwargs):
+        # the original convs kept while frozen are not submodules, so that they stay out of parameters() and the state dict
+        # they still follow the unet through .to(), .half(), .cuda() and the like, to be restored on the same device and dtype
+
+        for _, standardized_conv in self.standardized_convs:
+            standardized_conv._apply(fn, *args, **kwargs)
+
+        return super()._apply(fn, *args, **kwargs)
+
     def forward_with_cond_scale(
         self,
-        *args,
+        x,
+        time,
+        classes,
         cond_scale = 1.,
-        **kwargs
+        batched_guidance = True
     ):
-        logits = self.forward(*args, **kwargs)
-
         if cond_scale == 1:
-            return logits
+            return self.forward(x, time, classes, cond_drop_prob = 0.)
+
+        if not batched_guidance:
+            logits = self.forward(x, time, classes, cond_drop_prob = 0.)
+            null_logits = self.forward(x, time, classes, cond_drop_prob = 1.)
+            return null_logits + (logits - null_logits) * cond_scale
+
+        # conditional and null-class passes fused into one forward of twice the batch size
+
+        batch, device = x.shape[0], x.device
+
+        keep_mask = torch.arange(batch * 2, device = device) < batch
 
-        null_logits = self.forward(*args, cond_drop_prob = 1., **kwargs)
+        x, time, classes = map(lambda t: torch.cat((t, t), dim = 0), (x, time, classes))
+
+        logits, null_logits = self.forward(x, time, classes, keep_mask = keep_mask).chunk(2, dim = 0)
         return null_logits + (logits - null_logits) * cond_scale
 
     def forward(
@@ -390,7 +538,8 @@ class Unet(nn.Module):
         x,
         time,
         classes,
-        cond_drop_prob = None
+        cond_drop_prob = None,
+        keep_mask = None
     ):
         batch, device = x.shape[0], x.device
 
@@ -400,8 +549,10 @@ class Unet(nn.Module):
 
         classes_emb = self.classes_emb(classes)
 
-        if cond_drop_prob > 0:
+        if cond_drop_prob > 0 and not exists(keep_mask):
             keep_mask = prob_mask_like((batch,), 1 - cond_drop_prob, device = device)
+
+        if exists(keep_mask):
             null_classes_emb = repeat(self.null_classes_emb, 'd -> b d', b = batch)
 
             classes_emb = torch.where(
@@ -422,27 +573,16 @@ class Unet(nn.Module):
         h = []
 
         for block1, block2, attn, downsample in self.downs:
-            x = block1(x, t, c)
-            h.append(x)
-
-            x = block2(x, t, c)
-            x = attn(x)
+            skip, x = self.run_level(partial(down_level, block1, block2, attn), x, t, c)
+            h.append(skip)
             h.append(x)
 
             x = downsample(x)
 
-        x = self.mid_block1(x, t, c)
-        x = self.mid_attn(x)
-        x = self.mid_block2(x, t, c)
+        x = self.run_level(partial(mid_level, self.mid_block1, self.mid_attn, self.mid_block2), x, t, c)
 
         for block1, block2, attn, upsample in self.ups:
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block1(x, t, c)
-
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block2(x, t, c)
-            x = attn(x)
-
+            x = self.run_level(partial(up_level, block1, block2, attn), x, h.pop(), h.pop(), t, c)
             x = upsample(x)
 
         x = torch.cat((x, r), dim = 1)
@@ -488,7 +628,9 @@ class GaussianDiffusion(nn.Module):
         beta_schedule = 'cosine',
         p2_loss_weight_gamma = 0., # p2 loss weight, from https://arxiv.org/abs/2204.00227 - 0 is equivalent to weight of 1 across time - 1. is recommended
         p2_loss_weight_k = 1,
-        ddim_sampling_eta = 1.
+        ddim_sampling_eta = 1.,
+        sampler = 'ddim',         # the sampler used when sampling_timesteps is less than timesteps, one of 'ddim', 'dpm_solver++', 'unipc'
+        solver_order = 2          # order of the dpm_solver++ or unipc multistep solvers
     ):
         super().__init__()
         assert not (type(self) == GaussianDiffusion and model.channels != model.out_dim)
@@ -526,6 +668,10 @@ class GaussianDiffusion(nn.Module):
         self.is_ddim_sampling = self.sampling_timesteps < timesteps
         self.ddim_sampling_eta = ddim_sampling_eta
 
+        assert sampler in {'ddim', 'dpm_solver++', 'unipc'}, 'sampler must be either ddim, dpm_solver++ or unipc'
+        self.sampler = sampler
+        self.solver_order = solver_order
+
         # helper function to register buffer from float64 to float32
 
         register_buffer = lambda name, val: self.register_buffer(name, val.to(torch.float32))
@@ -560,103 +706,130 @@ class GaussianDiffusion(nn.Module):
 
         register_buffer('p2_loss_weight', (p2_loss_weight_k + alphas_cumprod / (1 - alphas_cumprod)) ** -p2_loss_weight_gamma)
 
-    def predict_start_from_noise(self, x_t, t, noise):
+        # all the per timestep coefficients packed into one [timesteps, coefficients] table, see schedule_coefs
+
+        self.register_buffer('schedule_coef_table', torch.stack([getattr(self, name) for name in ScheduleCoefs._fields], dim = -1), persistent = False)
+
+    def schedule_coefs(self, t, x_shape):
+        # one gather for all the schedule coefficients at timesteps t, instead of one extract per coefficient
+
+        b, *_ = t.shape
+        coefs = self.schedule_coef_table[t]
+        coefs = coefs.reshape(b, -1, *((1,) * (len(x_shape) - 1)))
+        return ScheduleCoefs(*coefs.unbind(dim = 1))
+
+    def predict_start_from_noise(self, x_t, t, noise, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         return (
-            extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
+            coefs.sqrt_recip_alphas_cumprod * x_t -
+            coefs.sqrt_recipm1_alphas_cumprod * noise
         )
 
-    def predict_noise_from_start(self, x_t, t, x0):
+    def predict_noise_from_start(self, x_t, t, x0, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         return (
-            (extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - x0) / \
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            (coefs.sqrt_recip_alphas_cumprod * x_t - x0) / \
+            coefs.sqrt_recipm1_alphas_cumprod
         )
 
-    def predict_v(self, x_start, t, noise):
+    def predict_v(self, x_start, t, noise, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_start.shape))
+
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * noise -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * x_start
+            coefs.sqrt_alphas_cumprod * noise -
+            coefs.sqrt_one_minus_alphas_cumprod * x_start
         )
 
-    def predict_start_from_v(self, x_t, t, v):
+    def predict_start_from_v(self, x_t, t, v, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_t.shape) * v
+            coefs.sqrt_alphas_cumprod * x_t -
+            coefs.sqrt_one_minus_alphas_cumprod * v
         )
 
-    def q_posterior(self, x_start, x_t, t):
+    def q_posterior(self, x_start, x_t, t, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         posterior_mean = (
-            extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-            extract(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            coefs.posterior_mean_coef1 * x_start +
+            coefs.posterior_mean_coef2 * x_t
         )
-        posterior_variance = extract(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = extract(self.posterior_log_variance_clipped, t, x_t.shape)
+        posterior_variance = coefs.posterior_variance
+        posterior_log_variance_clipped = coefs.posterior_log_variance_clipped
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
 
-    def model_predictions(self, x, t, classes, cond_scale = 3., clip_x_start = False):
+    def model_predictions(self, x, t, classes, cond_scale = 3., clip_x_start = False, coefs = None):
         model_output = self.model.forward_with_cond_scale(x, t, classes, cond_scale = cond_scale)
         maybe_clip = partial(torch.clamp, min = -1., max = 1.) if clip_x_start else identity
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x.shape))
 
         if self.objective == 'pred_noise':
             pred_noise = model_output
-            x_start = self.predict_start_from_noise(x, t, pred_noise)
+            x_start = self.predict_start_from_noise(x, t, pred_noise, coefs)
             x_start = maybe_clip(x_start)
 
         elif self.objective == 'pred_x0':
             x_start = model_output
             x_start = maybe_clip(x_start)
-            pred_noise = self.predict_noise_from_start(x, t, x_start)
+            pred_noise = self.predict_noise_from_start(x, t, x_start, coefs)
 
         elif self.objective == 'pred_v':
             v = model_output
-            x_start = self.predict_start_from_v(x, t, v)
+            x_start = self.predict_start_from_v(x, t, v, coefs)
             x_start = maybe_clip(x_start)
-            pred_noise = self.predict_noise_from_start(x, t, x_start)
+            pred_noise = self.predict_noise_from_start(x, t, x_start, coefs)
 
         return ModelPrediction(pred_noise, x_start)
 
     def p_mean_variance(self, x, t, classes, cond_scale, clip_denoised = True):
-        preds = self.model_predictions(x, t, classes, cond_scale)
+        coefs = self.schedule_coefs(t, x.shape)
+        preds = self.model_predictions(x, t, classes, cond_scale, coefs = coefs)
         x_start = preds.pred_x_start
 
         if clip_denoised:
             x_start.clamp_(-1., 1.)
 
-        model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start = x_start, x_t = x, t = t)
+        model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start = x_start, x_t = x, t = t, coefs = coefs)
         return model_mean, posterior_variance, posterior_log_variance, x_start
 
     @torch.no_grad()
-    def p_sample(self, x, t: int, classes, cond_scale = 3., clip_denoised = True):
+    def p_sample(self, x, t: int, classes, cond_scale = 3., clip_denoised = True, rng = None):
         b, *_, device = *x.shape, x.device
+        rng = default(rng, lambda: SampleRNG(device = device))
         batched_times = torch.full((x.shape[0],), t, device = x.device, dtype = torch.long)
         model_mean, _, model_log_variance, x_start = self.p_mean_variance(x = x, t = batched_times, classes = classes, cond_scale = cond_scale, clip_denoised = clip_denoised)
-        noise = torch.randn_like(x) if t > 0 else 0. # no noise if t == 0
+        noise = rng.randn_like(x) if t > 0 else 0. # no noise if t == 0
         pred_img = model_mean + (0.5 * model_log_variance).exp() * noise
         return pred_img, x_start
 
     @torch.no_grad()
-    def p_sample_loop(self, classes, shape, cond_scale = 3.):
+    def p_sample_loop(self, classes, shape, cond_scale = 3., rng = None):
         batch, device = shape[0], self.betas.device
+        rng = default(rng, lambda: SampleRNG(device = device))
 
-        img = torch.randn(shape, device=device)
+        img = rng.randn(shape)
 
         x_start = None
 
         for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps):
-            img, x_start = self.p_sample(img, t, classes, cond_scale)
+            img, x_start = self.p_sample(img, t, classes, cond_scale, rng = rng)
 
         img = unnormalize_to_zero_to_one(img)
         return img
 
     @torch.no_grad()
-    def ddim_sample(self, classes, shape, cond_scale = 3., clip_denoised = True):
+    def ddim_sample(self, classes, shape, cond_scale = 3., clip_denoised = True, rng = None):
         batch, device, total_timesteps, sampling_timesteps, eta, objective = shape[0], self.betas.device, self.num_timesteps, self.sampling_timesteps, self.ddim_sampling_eta, self.objective
+        rng = default(rng, lambda: SampleRNG(device = device))
 
         times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
         times = list(reversed(times.int().tolist()))
         time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
 
-        img = torch.randn(shape, device = device)
+        img = rng.randn(shape)
 
         x_start = None
 
@@ -674,7 +847,7 @@ class GaussianDiffusion(nn.Module):
             sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
             c = (1 - alpha_next - sigma ** 2).sqrt()
 
-            noise = torch.randn_like(img)
+            noise = rng.randn_like(img)
 
             img = x_start * alpha_next.sqrt() + \
                   c * pred_noise + \
@@ -684,10 +857,35 @@ class GaussianDiffusion(nn.Module):
         return img
 
     @torch.no_grad()
-    def sample(self, classes, cond_scale = 3.):
+    def multistep_solver_sample(self, classes, shape, cond_scale = 3., clip_denoised = True, rng = None):
+        batch, device, total_timesteps, sampling_timesteps = shape[0], self.betas.device, self.num_timesteps, self.sampling_timesteps
+        rng = default(rng, lambda: SampleRNG(device = device))
+
+        times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)
+        times = list(reversed(times.int().tolist()))[:-1] # [T-1, ..., 0], the x0 prediction at time 0 is returned, as in ddim
+
+        img = rng.randn(shape)
+
+        def x_start_fn(img, time):
+            time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
+            _, x_start, *_ = self.model_predictions(img, time_cond, classes, cond_scale = cond_scale, clip_x_start = clip_denoised)
+            return x_start
+
+        solver_fn = dpm_solver_pp_sample if self.sampler == 'dpm_solver++' else unipc_sample
+        img = solver_fn(x_start_fn, img, times, self.alphas_cumprod.tolist(), order = self.solver_order)
+
+        img = unnormalize_to_zero_to_one(img)
+        return img
+
+    @torch.no_grad()
+    def sample(self, classes, cond_scale = 3., seeds = None):
+        # with seeds, one per class, every sample is drawn with its own generator and is the same regardless of the batch it is sampled in
         batch_size, image_size, channels = classes.shape[0], self.image_size, self.channels
-        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
-        return sample_fn(classes, (batch_size, channels, image_size, image_size), cond_scale)
+        fast_sample_fn = self.ddim_sample if self.sampler == 'ddim' else self.multistep_solver_sample
+        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else fast_sample_fn
+
+        rng = SampleRNG(seeds, device = self.betas.device)
+        return sample_fn(classes, (batch_size, channels, image_size, image_size), cond_scale, rng = rng)
 
     @torch.no_grad()
     def interpolate(self, x1, x2, t = None, lam = 0.5):
@@ -705,12 +903,13 @@ class GaussianDiffusion(nn.Module):
 
         return img
 
-    def q_sample(self, x_start, t, noise=None):
+    def q_sample(self, x_start, t, noise=None, coefs = None):
         noise = default(noise, lambda: torch.randn_like(x_start))
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_start.shape))
 
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            coefs.sqrt_alphas_cumprod * x_start +
+            coefs.sqrt_one_minus_alphas_cumprod * noise
         )
 
     @property
@@ -725,10 +924,11 @@ class GaussianDiffusion(nn.Module):
     def p_losses(self, x_start, t, *, classes, noise = None):
         b, c, h, w = x_start.shape
         noise = default(noise, lambda: torch.randn_like(x_start))
+        coefs = self.schedule_coefs(t, x_start.shape)
 
         # noise sample
 
-        x = self.q_sample(x_start = x_start, t = t, noise = noise)
+        x = self.q_sample(x_start = x_start, t = t, noise = noise, coefs = coefs)
 
         # predict and take gradient step
 
@@ -739,7 +939,7 @@ class GaussianDiffusion(nn.Module):
         elif self.objective == 'pred_x0':
             target = x_start
         elif self.objective == 'pred_v':
-            v = self.predict_v(x_start, t, noise)
+            v = self.predict_v(x_start, t, noise, coefs)
             target = v
         else:
             raise ValueError(f'unknown objective {self.objective}')
@@ -747,7 +947,7 @@ class GaussianDiffusion(nn.Module):
         loss = self.loss_fn(model_out, target, reduction = 'none')
         loss = reduce(loss, 'b ... -> b (...)', 'mean')
 
-        loss = loss * extract(self.p2_loss_weight, t, loss.shape)
+        loss = loss * coefs.p2_loss_weight.reshape(b, 1)
         return loss.mean()
 
     def forward(self, img, *args, **kwargs):
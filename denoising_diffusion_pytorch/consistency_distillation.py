@@ -0,0 +1,123 @@
+import copy
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from einops import rearrange
+
+from denoising_diffusion_pytorch.elucidated_diffusion import normalize_to_neg_one_to_one
+from denoising_diffusion_pytorch.progressive_distillation import Frozen, module_device
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    if exists(val):
+        return val
+    return d() if callable(d) else d
+
+# consistency distillation - https://arxiv.org/abs/2303.01469
+# the student learns to map any point of the teacher's probability flow ode trajectory to its end, so it can sample in one to four steps
+# its output at a noise level is matched to the output of a target network (an ema of the student) at the adjacent lower noise level, reached with one heun step of the teacher
+
+class ConsistencyDistiller(nn.Module):
+    def __init__(
+        self,
+        teacher,
+        student = None,
+        *,
+        num_discretization_steps = 18,  # N in the paper, the number of karras noise levels the ode is discretized into
+        target_ema_decay = 0.95,        # mu in the paper
+        sample_steps = 1
+    ):
+        super().__init__()
+        assert not teacher.self_condition, 'self conditioning is not supported for consistency distillation'
+        assert num_discretization_steps > 1
+
+        # the student (and the target network) is initialized from the teacher
+
+        student = default(student, lambda: copy.deepcopy(teacher))
+
+        teacher.requires_grad_(False)
+        teacher.eval()
+
+        target = copy.deepcopy(student)
+        target.requires_grad_(False)
+
+        # the teacher and target are left out of the state dict and optimizer, the target is re-initialized from the student on load_state_dict
+
+        self.teacher = Frozen(teacher)
+        self.target = Frozen(target)
+        self.student = student
+
+        self.num_discretization_steps = num_discretization_steps
+        self.target_ema_decay = target_ema_decay
+        self.sample_steps = sample_steps
+
+        self.image_size = student.image_size
+
+    @torch.no_grad()
+    def sample(self, batch_size = 16, steps = None, **kwargs):
+        return self.student.sample_consistency(batch_size, steps = default(steps, self.sample_steps), **kwargs)
+
+    def move_frozen_to(self, device):
+        for module in (self.teacher.module, self.target.module):
+            if module_device(module) != device:
+                module.to(device)
+
+    @torch.no_grad()
+    def update_target(self, weight = None):
+        # the target network trails the student, and should be updated once after every optimizer step
+        # the Trainer does so through after_optimizer_step, a custom training loop has to call it itself
+
+        self.move_frozen_to(module_device(self.student))
+
+        target_params = list(self.target.module.parameters())
+        student_params = list(self.student.parameters())
+        torch._foreach_lerp_(target_params, student_params, default(weight, 1. - self.target_ema_decay))
+
+    def after_optimizer_step(self):
+        self.update_target()
+
+    def load_state_dict(self, *args, **kwargs):
+        out = super().load_state_dict(*args, **kwargs)
+        self.update_target(weight = 1.)
+        return out
+
+    @torch.no_grad()
+    def teacher_heun_step(self, x, sigma, sigma_next):
+        teacher = self.teacher.module
+        padded_sigma, padded_sigma_next = map(lambda t: rearrange(t, 'b -> b 1 1 1'), (sigma, sigma_next))
+
+        denoised_over_sigma = (x - teacher.preconditioned_network_forward(x, sigma)) / padded_sigma
+        x_next = x + (padded_sigma_next - padded_sigma) * denoised_over_sigma
+
+        denoised_prime_over_sigma = (x_next - teacher.preconditioned_network_forward(x_next, sigma_next)) / padded_sigma_next
+        return x + 0.5 * (padded_sigma_next - padded_sigma) * (denoised_over_sigma + denoised_prime_over_sigma)
+
+    def forward(self, images):
+        teacher, target, student = self.teacher.module, self.target.module, self.student
+        batch, device = images.shape[0], images.device
+
+        self.move_frozen_to(device)
+
+        images = normalize_to_neg_one_to_one(images)
+
+        # adjacent noise levels on the karras schedule, sigma_min up to sigma_max
+
+        sigmas = student.sample_schedule(self.num_discretization_steps)[:-1].flip(0)
+
+        index = torch.randint(0, self.num_discretization_steps - 1, (batch,), device = device)
+        sigma, sigma_next = sigmas[index], sigmas[index + 1]
+
+        noised_images = images + rearrange(sigma_next, 'b -> b 1 1 1') * torch.randn_like(images)
+
+        with torch.no_grad():
+            denoised_images = self.teacher_heun_step(noised_images, sigma_next, sigma)
+            target_out = target.consistency_network_forward(denoised_images, sigma)
+
+        out = student.consistency_network_forward(noised_images, sigma_next)
+        return F.mse_loss(out, target_out)
@@ -0,0 +1,187 @@
+from collections import deque, namedtuple
+from contextlib import ExitStack
+
+import torch
+
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import extract
+from denoising_diffusion_pytorch.sample_rng import SampleRNG
+
+# constants
+
+FinishedSample = namedtuple('FinishedSample', ['request_id', 'image'])
+
+# helpers functions
+
+def exists(x):
+    return x is not None
+
+def default(val, d):
+    if exists(val):
+        return val
+    return d() if callable(d) else d
+
+# continuous batching sampler
+# keeps a running batch where every slot is at its own ddim step
+# new requests are admitted as soon as a slot frees up, and finished images are returned right away
+# a request with a seed draws its noise from its own generator, and gives the same image as diffusion.sample(seeds = [seed]) with ddim
+
+class ContinuousBatchingSampler(object):
+    def __init__(
+        self,
+        diffusion,
+        *,
+        max_batch_size = 16,
+        sampling_timesteps = None,
+        ddim_sampling_eta = None,
+        clip_denoised = True
+    ):
+        super().__init__()
+        self.diffusion = diffusion
+        self.max_batch_size = max_batch_size
+        self.clip_denoised = clip_denoised
+
+        self.sampling_timesteps = default(sampling_timesteps, diffusion.sampling_timesteps)
+        self.eta = default(ddim_sampling_eta, diffusion.ddim_sampling_eta)
+
+        assert self.sampling_timesteps <= diffusion.num_timesteps
+
+        # same time pairs as GaussianDiffusion.ddim_sample, including searched ddim timesteps, indexed per slot by its step
+
+        device = diffusion.betas.device
+
+        times = diffusion.sampling_times(sampling_timesteps)
+        self.cached_times = times[:-1]
+
+        self.times = torch.tensor(times[:-1], device = device, dtype = torch.long)
+        self.times_next = torch.tensor(times[1:], device = device, dtype = torch.long)
+
+        # pending requests and running batch state, with the random number generator of every slot
+
+        self.queue = deque()
+        self.num_requests = 0
+
+        self.request_ids = []
+        self.rngs = []
+        self.img = None
+        self.x_start = None
+        self.step_index = None
+
+        # the time conditioning of the unet is cached while there are requests running
+
+        self.time_cache = None
+
+    @property
+    def device(self):
+        return self.diffusion.betas.device
+
+    @property
+    def sample_shape(self):
+        diffusion = self.diffusion
+        return (diffusion.channels, diffusion.image_size, diffusion.image_size)
+
+    @property
+    def num_running(self):
+        return len(self.request_ids)
+
+    @property
+    def is_idle(self):
+        return len(self.queue) == 0 and self.num_running == 0
+
+    def add_request(self, request_id = None, seed = None):
+        request_id = default(request_id, self.num_requests)
+        self.num_requests += 1
+        self.queue.append((request_id, seed))
+        return request_id
+
+    def randn(self, rngs):
+        return torch.cat([rng.randn((1, *self.sample_shape)) for rng in rngs], dim = 0)
+
+    def admit(self):
+        num_free = self.max_batch_size - self.num_running
+        num_admit = min(num_free, len(self.queue))
+
+        if num_admit == 0:
+            return
+
+        new_ids, new_seeds = zip(*[self.queue.popleft() for _ in range(num_admit)])
+        new_rngs = [SampleRNG([seed] if exists(seed) else None, device = self.device) for seed in new_seeds]
+
+        img = self.randn(new_rngs)
+        x_start = torch.zeros_like(img)
+        step_index = torch.zeros((num_admit,), device = self.device, dtype = torch.long)
+
+        if self.num_running > 0:
+            img = torch.cat((self.img, img), dim = 0)
+            x_start = torch.cat((self.x_start, x_start), dim = 0)
+            step_index = torch.cat((self.step_index, step_index), dim = 0)
+
+        self.request_ids.extend(new_ids)
+        self.rngs.extend(new_rngs)
+        self.img, self.x_start, self.step_index = img, x_start, step_index
+
+        if not exists(self.time_cache):
+            self.time_cache = ExitStack()
+            self.time_cache.enter_context(self.diffusion.cached_time_conditioning(self.cached_times))
+
+    def clear_time_cache(self):
+        if exists(self.time_cache):
+            self.time_cache.close()
+
+        self.time_cache = None
+
+    @torch.no_grad()
+    def step(self):
+        self.admit()
+
+        if self.num_running == 0:
+            return []
+
+        diffusion, img, eta = self.diffusion, self.img, self.eta
+
+        time = self.times[self.step_index]
+        time_next = self.times_next[self.step_index]
+
+        self_cond = self.x_start if diffusion.self_condition else None
+        pred_noise, x_start, *_ = diffusion.model_predictions(img, time, self_cond, clip_x_start = self.clip_denoised)
+
+        # ddim step, with the alphas gathered per slot
+
+        is_last = time_next < 0
+
+        alpha = extract(diffusion.alphas_cumprod, time, img.shape)
+        alpha_next = extract(diffusion.alphas_cumprod, time_next.clamp(min = 0), img.shape)
+
+        sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
+        c = (1 - alpha_next - sigma ** 2).sqrt()
+
+        noise = self.randn(self.rngs).to(img.dtype)
+
+        img = x_start * alpha_next.sqrt() + \
+              c * pred_noise + \
+              sigma * noise
+
+        # slots whose next time is -1 are done, and their prediction of x0 is the final image
+
+        finished = []
+        finished_indices = is_last.nonzero().flatten().tolist()
+
+        if len(finished_indices) > 0:
+            images = diffusion.unnormalize(x_start[is_last])
+            finished = [FinishedSample(self.request_ids[i], image) for i, image in zip(finished_indices, images)]
+
+        keep = ~is_last
+
+        is_done = is_last.tolist()
+
+        self.request_ids = [request_id for request_id, done in zip(self.request_ids, is_done) if not done]
+        self.rngs = [rng for rng, done in zip(self.rngs, is_done) if not done]
+        self.img, self.x_start, self.step_index = img[keep], x_start[keep], self.step_index[keep] + 1
+
+        if self.is_idle:
+            self.clear_time_cache()
+
+        return finished
+
+    def run(self):
+        while not self.is_idle:
+            yield from self.step()
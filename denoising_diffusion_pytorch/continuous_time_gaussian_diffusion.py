@@ -9,6 +9,8 @@ from tqdm import tqdm
 from einops import rearrange, repeat, reduce
 from einops.layers.torch import Rearrange
 
+from denoising_diffusion_pytorch.sample_rng import SampleRNG
+
 # helpers
 
 def exists(val):
@@ -215,36 +217,44 @@ class ContinuousTimeGaussianDiffusion(nn.Module):
     # sampling related functions
 
     @torch.no_grad()
-    def p_sample(self, x, time, time_next):
+    def p_sample(self, x, time, time_next, rng = None):
         batch, *_, device = *x.shape, x.device
+        rng = default(rng, lambda: SampleRNG(device = device))
 
         model_mean, model_variance = self.p_mean_variance(x = x, time = time, time_next = time_next)
 
         if time_next == 0:
             return model_mean
 
-        noise = torch.randn_like(x)
+        noise = rng.randn_like(x)
         return model_mean + sqrt(model_variance) * noise
 
     @torch.no_grad()
-    def p_sample_loop(self, shape):
+    def p_sample_loop(self, shape, rng = None):
         batch = shape[0]
+        rng = default(rng, lambda: SampleRNG(device = self.device))
 
-        img = torch.randn(shape, device = self.device)
+        img = rng.randn(shape)
         steps = torch.linspace(1., 0., self.num_sample_steps + 1, device = self.device)
 
         for i in tqdm(range(self.num_sample_steps), desc = 'sampling loop time step', total = self.num_sample_steps):
             times = steps[i]
             times_next = steps[i + 1]
-            img = self.p_sample(img, times, times_next)
+            img = self.p_sample(img, times, times_next, rng = rng)
 
         img.clamp_(-1., 1.)
         img = unnormalize_to_zero_to_one(img)
         return img
 
     @torch.no_grad()
-    def sample(self, batch_size = 16):
-        return self.p_sample_loop((batch_size, self.channels, self.image_size, self.image_size))
+    def sample(self, batch_size = 16, seeds = None):
+        # with seeds, one per sample, every sample is drawn with its own generator and is the same regardless of the batch it is sampled in
+
+        if exists(seeds):
+            batch_size = len(seeds)
+
+        rng = SampleRNG(seeds, device = self.device)
+        return self.p_sample_loop((batch_size, self.channels, self.image_size, self.image_size), rng = rng)
 
     # training related functions - noise prediction
 
@@ -1,14 +1,21 @@
 import math
 import copy
+import time
+import warnings
 from pathlib import Path
 from random import random
 from functools import partial
+from contextlib import contextmanager, nullcontext
 from collections import namedtuple
-from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count, Pool
+
+import numpy as np
 
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import Dataset, DataLoader
 
 from torch.optim import Adam
@@ -19,14 +26,35 @@ from einops.layers.torch import Rearrange
 
 from PIL import Image
 from tqdm.auto import tqdm
-from ema_pytorch import EMA
 
 from accelerate import Accelerator
 
+from denoising_diffusion_pytorch.fused_ema import FusedEMA
+from denoising_diffusion_pytorch.quantization import quantize_unet_for_cpu
+from denoising_diffusion_pytorch.multistep_solvers import dpm_solver_pp_sample, unipc_sample
+from denoising_diffusion_pytorch.sample_rng import SampleRNG
+from denoising_diffusion_pytorch.sharded_dataset import ShardedImageDataset
+from denoising_diffusion_pytorch.file_manifest import list_image_paths
+
 # constants
 
 ModelPrediction =  namedtuple('ModelPrediction', ['pred_noise', 'pred_x_start'])
 
+# per timestep coefficients of the noise schedule, gathered together
+
+ScheduleCoefs = namedtuple('ScheduleCoefs', [
+    'betas',
+    'sqrt_alphas_cumprod',
+    'sqrt_one_minus_alphas_cumprod',
+    'sqrt_recip_alphas_cumprod',
+    'sqrt_recipm1_alphas_cumprod',
+    'posterior_variance',
+    'posterior_log_variance_clipped',
+    'posterior_mean_coef1',
+    'posterior_mean_coef2',
+    'p2_loss_weight'
+])
+
 # helpers functions
 
 def exists(x):
@@ -45,6 +73,15 @@ def cycle(dl):
         for data in dl:
             yield data
 
+def tree_to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy = True)
+    if isinstance(obj, dict):
+        return {k: tree_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(tree_to_cpu(v) for v in obj)
+    return obj
+
 def has_int_squareroot(num):
     return (math.sqrt(num) ** 2) == num
 
@@ -93,16 +130,43 @@ class WeightStandardizedConv2d(nn.Conv2d):
     https://arxiv.org/abs/1903.10520
     weight standardization purportedly works synergistically with group normalization
     """
-    def forward(self, x):
-        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
-
+    def normalized_weight(self, eps):
         weight = self.weight
         mean = reduce(weight, 'o ... -> o 1 1 1', 'mean')
         var = reduce(weight, 'o ... -> o 1 1 1', partial(torch.var, unbiased = False))
-        normalized_weight = (weight - mean) * (var + eps).rsqrt()
+        return (weight - mean) * (var + eps).rsqrt()
+
+    def forward(self, x):
+        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
+        normalized_weight = self.normalized_weight(eps)
 
         return F.conv2d(x, normalized_weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
 
+    @torch.no_grad()
+    def to_conv(self):
+        weight = self.weight
+        eps = 1e-5 if weight.dtype == torch.float32 else 1e-3
+
+        conv = nn.Conv2d(
+            self.in_channels,
+            self.out_channels,
+            self.kernel_size,
+            stride = self.stride,
+            padding = self.padding,
+            dilation = self.dilation,
+            groups = self.groups,
+            bias = exists(self.bias),
+            device = weight.device,
+            dtype = weight.dtype
+        )
+
+        conv.weight.copy_(self.normalized_weight(eps))
+
+        if exists(self.bias):
+            conv.bias.copy_(self.bias)
+
+        return conv
+
 class LayerNorm(nn.Module):
     def __init__(self, dim):
         super().__init__()
@@ -189,11 +253,16 @@ class ResnetBlock(nn.Module):
         self.block2 = Block(dim_out, dim_out, groups = groups)
         self.res_conv = nn.Conv2d(dim, dim_out, 1) if dim != dim_out else nn.Identity()
 
+        # output of the time mlp for each timestep of a sampling schedule, see Unet.cache_time_conditioning
+
+        self.register_buffer('cached_time_cond', None, persistent = False)
+
     def forward(self, x, time_emb = None):
 
         scale_shift = None
         if exists(self.mlp) and exists(time_emb):
-            time_emb = self.mlp(time_emb)
+            # when the time conditioning is cached, the Unet passes in the (integer) row indices into the cache instead of the embedding
+            time_emb = self.cached_time_cond[time_emb] if not torch.is_floating_point(time_emb) else self.mlp(time_emb)
             time_emb = rearrange(time_emb, 'b c -> b c 1 1')
             scale_shift = time_emb.chunk(2, dim = 1)
 
@@ -234,29 +303,66 @@ class LinearAttention(nn.Module):
         return self.to_out(out)
 
 class Attention(nn.Module):
-    def __init__(self, dim, heads = 4, dim_head = 32):
+    def __init__(self, dim, heads = 4, dim_head = 32, use_sdpa = True, query_chunk_size = 1024):
         super().__init__()
         self.scale = dim_head ** -0.5
         self.heads = heads
         hidden_dim = dim_head * heads
 
+        # use the fused scaled dot product attention when available (pytorch 2.0 and above), and chunk the queries otherwise
+
+        self.use_sdpa = use_sdpa and hasattr(F, 'scaled_dot_product_attention')
+        self.query_chunk_size = query_chunk_size
+
         self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
         self.to_out = nn.Conv2d(hidden_dim, dim, 1)
 
+    def attend(self, q, k, v):
+        if self.use_sdpa:
+            q, k, v = map(lambda t: t.contiguous(), (q, k, v)) # the fused kernels need the head dimension to be contiguous
+            return F.scaled_dot_product_attention(q, k, v) # default scale of dim_head ** -0.5 is the same as self.scale
+
+        # fallback, where the similarity matrix is only ever materialized for a chunk of queries at a time, bounding peak memory
+
+        q = q * self.scale
+
+        out = []
+
+        for q_chunk in q.split(self.query_chunk_size, dim = -2):
+            sim = einsum('b h i d, b h j d -> b h i j', q_chunk, k)
+            attn = sim.softmax(dim = -1)
+            out.append(einsum('b h i j, b h j d -> b h i d', attn, v))
+
+        return torch.cat(out, dim = -2)
+
     def forward(self, x):
         b, c, h, w = x.shape
         qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
-
-        q = q * self.scale
+        q, k, v = map(lambda t: rearrange(t, 'b (h d) x y -> b h (x y) d', h = self.heads), qkv)
 
-        sim = einsum('b h d i, b h d j -> b h i j', q, k)
-        attn = sim.softmax(dim = -1)
-        out = einsum('b h i j, b h d j -> b h i d', attn, v)
+        out = self.attend(q, k, v)
 
         out = rearrange(out, 'b h (x y) d -> b (h d) x y', x = h, y = w)
         return self.to_out(out)
 
+# activation checkpointing, where the resnet blocks and attention of a resolution level are recomputed during backward
+
+def down_level(block1, block2, attn, x, *cond):
+    skip = block1(x, *cond)
+    x = block2(skip, *cond)
+    x = attn(x)
+    return skip, x
+
+def mid_level(block1, attn, block2, x, *cond):
+    x = block1(x, *cond)
+    x = attn(x)
+    return block2(x, *cond)
+
+def up_level(block1, block2, attn, x, first_skip, second_skip, *cond):
+    x = block1(torch.cat((x, first_skip), dim = 1), *cond)
+    x = block2(torch.cat((x, second_skip), dim = 1), *cond)
+    return attn(x)
+
 # model
 
 class Unet(nn.Module):
@@ -272,7 +378,8 @@ class Unet(nn.Module):
         learned_variance = False,
         learned_sinusoidal_cond = False,
         random_fourier_features = False,
-        learned_sinusoidal_dim = 16
+        learned_sinusoidal_dim = 16,
+        gradient_checkpointing = False
     ):
         super().__init__()
 
@@ -347,40 +454,196 @@ class Unet(nn.Module):
         self.final_res_block = block_klass(dim * 2, dim, time_emb_dim = time_dim)
         self.final_conv = nn.Conv2d(dim, self.out_dim, 1)
 
+        # recompute the activations of each resolution level during backward, trading compute for memory
+
+        self.gradient_checkpointing = gradient_checkpointing
+
+        # weight standardized convs that were folded into plain convs for inference
+
+        self.standardized_convs = []
+        self.quantized = False
+
+        # maps timesteps to rows of the cached time conditioning of each resnet block, see cache_time_conditioning
+
+        self.register_buffer('time_cond_index', None, persistent = False)
+
+        # torch.compile, see compile
+
+        self.channels_last = False
+        self.compiled_unet_forward = None
+
+        # deep feature reuse across adjacent sampling steps, see enable_deep_feature_cache
+
+        self.cache_deep_features = False
+        self.reuse_deep_features = False
+        self.deep_features = None
+
+    def run_level(self, fn, *args):
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint(fn, *args, use_reentrant = False)
+
+        return fn(*args)
+
+    @property
+    def frozen_for_inference(self):
+        return len(self.standardized_convs) > 0
+
+    @torch.no_grad()
+    def freeze_for_inference(self):
+        # weights are frozen while sampling, so the weight standardization can be folded into plain convs once
+        # the original convs are kept, and restored with unfreeze_for_training
+
+        if self.frozen_for_inference:
+            return self
+
+        for block in self.modules():
+            if not isinstance(block, Block):
+                continue
+
+            self.standardized_convs.append((block, block.proj))
+            block.proj = block.proj.to_conv()
+
+        return self
+
+    def unfreeze_for_training(self):
+        assert not self.quantized, 'a unet quantized for cpu inference cannot be unfrozen for training'
+
+        for block, standardized_conv in self.standardized_convs:
+            block.proj = standardized_conv
+
+        self.standardized_convs = []
+        return self
+
+    def _apply(self, fn, *args, **kwargs):
+        # the original convs kept while frozen are not submodules, so that they stay out of parameters() and the state dict
+        # they still follow the unet through .to(), .half(), .cuda() and the like, to be restored on the same device and dtype
+
+        for _, standardized_conv in self.standardized_convs:
+            standardized_conv._apply(fn, *args, **kwargs)
+
+        return super()._apply(fn, *args, **kwargs)
+
+    def quantize_for_cpu(self, calibrate_fn, backend = 'fbgemm'):
+        quantize_unet_for_cpu(self, calibrate_fn, backend = backend)
+        self.quantized = True
+        return self
+
+    @property
+    def resnet_blocks_with_time_cond(self):
+        return [module for module in self.modules() if isinstance(module, ResnetBlock) and exists(module.mlp)]
+
+    @torch.no_grad()
+    def cache_time_conditioning(self, times):
+        # sampling only ever visits the timesteps of its schedule, so the time mlp and the scale / shift of every resnet block
+        # can be computed once for all of them, and looked up by index in the forward
+
+        times = torch.unique(times.long())
+        t = self.time_mlp(times)
+
+        for block in self.resnet_blocks_with_time_cond:
+            block.cached_time_cond = block.mlp(t)
+
+        time_cond_index = torch.full((int(times.amax().item()) + 1,), -1, device = times.device, dtype = torch.long)
+        time_cond_index[times] = torch.arange(times.shape[0], device = times.device)
+        self.time_cond_index = time_cond_index
+
+    def clear_time_conditioning_cache(self):
+        for block in self.resnet_blocks_with_time_cond:
+            block.cached_time_cond = None
+
+        self.time_cond_index = None
+
+    def time_conditioning(self, time):
+        # the row indices into the cached time conditioning when it is cached, otherwise the time embedding
+        # the timesteps are not checked on the host, which would sync on every step and break the compiled graph in two -
+        # sampling only visits the timesteps cached on entering GaussianDiffusion.cached_time_conditioning, and any other timestep fails on device
+
+        if not exists(self.time_cond_index) or torch.is_floating_point(time):
+            return self.time_mlp(time)
+
+        rows = self.time_cond_index[time.long()]
+        torch._assert_async((rows >= 0).all(), 'timestep missing from the time conditioning cache')
+        return rows
+
+    def enable_deep_feature_cache(self):
+        # deepcache - https://arxiv.org/abs/2312.00858
+        # the features going into the outermost up level are kept from the last full forward, and when reuse_deep_features is set,
+        # only the outermost down and up levels are run, with the cached features standing in for everything below them
+
+        assert len(self.downs) > 1, 'deep feature reuse needs at least two resolution levels'
+        self.cache_deep_features = True
+
+    def clear_deep_feature_cache(self):
+        self.cache_deep_features = False
+        self.reuse_deep_features = False
+        self.deep_features = None
+
+    def compile(self, *args, channels_last = True, **kwargs):
+        # compiles the forward with torch.compile, optionally running the convolutions in channels last memory format
+        # the arguments are passed on to torch.compile, as with nn.Module.compile, which this takes the place of
+        # the unbound forward is compiled, so copies of the model (the ema) get their own graph instead of calling into this one
+
+        assert hasattr(torch, 'compile'), 'torch.compile requires pytorch 2.0 or above'
+
+        try:
+            from einops._torch_specific import allow_ops_in_compiled_graph
+            allow_ops_in_compiled_graph()
+        except ImportError:
+            pass
+
+        if channels_last:
+            self.to(memory_format = torch.channels_last)
+
+        self.channels_last = channels_last
+        self.compiled_unet_forward = torch.compile(Unet.unet_forward, *args, **kwargs)
+        return self
+
     def forward(self, x, time, x_self_cond = None):
+        if exists(self.compiled_unet_forward):
+            return self.compiled_unet_forward(self, x, time, x_self_cond)
+
+        return self.unet_forward(x, time, x_self_cond)
+
+    def unet_forward(self, x, time, x_self_cond = None):
         if self.self_condition:
             x_self_cond = default(x_self_cond, lambda: torch.zeros_like(x))
             x = torch.cat((x_self_cond, x), dim = 1)
 
+        if self.channels_last:
+            x = x.contiguous(memory_format = torch.channels_last)
+
         x = self.init_conv(x)
         r = x.clone()
 
-        t = self.time_mlp(time)
+        t = self.time_conditioning(time)
+
+        reuse_deep_features = self.cache_deep_features and self.reuse_deep_features and exists(self.deep_features)
+
+        downs = self.downs[:1] if reuse_deep_features else self.downs
+        ups = self.ups[-1:] if reuse_deep_features else self.ups
 
         h = []
 
-        for block1, block2, attn, downsample in self.downs:
-            x = block1(x, t)
+        for block1, block2, attn, downsample in downs:
+            skip, x = self.run_level(partial(down_level, block1, block2, attn), x, t)
+            h.append(skip)
             h.append(x)
 
-            x = block2(x, t)
-            x = attn(x)
-            h.append(x)
+            if reuse_deep_features:
+                break
 
             x = downsample(x)
 
-        x = self.mid_block1(x, t)
-        x = self.mid_attn(x)
-        x = self.mid_block2(x, t)
-
-        for block1, block2, attn, upsample in self.ups:
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block1(x, t)
+        if reuse_deep_features:
+            x = self.deep_features
+        else:
+            x = self.run_level(partial(mid_level, self.mid_block1, self.mid_attn, self.mid_block2), x, t)
 
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block2(x, t)
-            x = attn(x)
+        for ind, (block1, block2, attn, upsample) in enumerate(ups):
+            if self.cache_deep_features and not reuse_deep_features and ind == (len(ups) - 1):
+                self.deep_features = x
 
+            x = self.run_level(partial(up_level, block1, block2, attn), x, h.pop(), h.pop(), t)
             x = upsample(x)
 
         x = torch.cat((x, r), dim = 1)
@@ -426,12 +689,20 @@ class GaussianDiffusion(nn.Module):
         beta_schedule = 'cosine',
         p2_loss_weight_gamma = 0., # p2 loss weight, from https://arxiv.org/abs/2204.00227 - 0 is equivalent to weight of 1 across time - 1. is recommended
         p2_loss_weight_k = 1,
-        ddim_sampling_eta = 1.
+        ddim_sampling_eta = 1.,
+        sampler = 'ddim',         # the sampler used when sampling_timesteps is less than timesteps, one of 'ddim', 'dpm_solver++', 'unipc'
+        solver_order = 2,         # order of the dpm_solver++ or unipc multistep solvers
+        compile = False,          # compile the unet with torch.compile, in channels last memory format
+        feature_cache_interval = 1, # with ddim sampling, run the full unet only every this many steps, and reuse its deep features in between
+        auto_normalize = True
     ):
         super().__init__()
         assert not (type(self) == GaussianDiffusion and model.channels != model.out_dim)
         assert not model.random_or_learned_sinusoidal_cond
 
+        if compile:
+            model.compile()
+
         self.model = model
         self.channels = self.model.channels
         self.self_condition = self.model.self_condition
@@ -463,8 +734,26 @@ class GaussianDiffusion(nn.Module):
 
         assert self.sampling_timesteps <= timesteps
         self.is_ddim_sampling = self.sampling_timesteps < timesteps
+
+        self.uniform_sampling_timesteps = self.sampling_timesteps # restored by clear_ddim_timesteps
         self.ddim_sampling_eta = ddim_sampling_eta
 
+        assert sampler in {'ddim', 'dpm_solver++', 'unipc'}, 'sampler must be either ddim, dpm_solver++ or unipc'
+        self.sampler = sampler
+        self.solver_order = solver_order
+
+        assert feature_cache_interval >= 1
+        self.feature_cache_interval = feature_cache_interval
+
+        # auto-normalization of data [0, 1] -> [-1, 1] - can turn off by setting it to be False
+
+        self.normalize = normalize_to_neg_one_to_one if auto_normalize else identity
+        self.unnormalize = unnormalize_to_zero_to_one if auto_normalize else identity
+
+        # optional searched timestep schedule for ddim sampling, saved with the state dict, see set_ddim_timesteps
+
+        self.register_buffer('ddim_timesteps', None)
+
         # helper function to register buffer from float64 to float32
 
         register_buffer = lambda name, val: self.register_buffer(name, val.to(torch.float32))
@@ -499,136 +788,302 @@ class GaussianDiffusion(nn.Module):
 
         register_buffer('p2_loss_weight', (p2_loss_weight_k + alphas_cumprod / (1 - alphas_cumprod)) ** -p2_loss_weight_gamma)
 
-    def predict_start_from_noise(self, x_t, t, noise):
+        # all the per timestep coefficients packed into one [timesteps, coefficients] table, see schedule_coefs
+
+        self.register_buffer('schedule_coef_table', torch.stack([getattr(self, name) for name in ScheduleCoefs._fields], dim = -1), persistent = False)
+
+    def schedule_coefs(self, t, x_shape):
+        # one gather for all the schedule coefficients at timesteps t, instead of one extract per coefficient
+
+        b, *_ = t.shape
+        coefs = self.schedule_coef_table[t]
+        coefs = coefs.reshape(b, -1, *((1,) * (len(x_shape) - 1)))
+        return ScheduleCoefs(*coefs.unbind(dim = 1))
+
+    def predict_start_from_noise(self, x_t, t, noise, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         return (
-            extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
+            coefs.sqrt_recip_alphas_cumprod * x_t -
+            coefs.sqrt_recipm1_alphas_cumprod * noise
         )
 
-    def predict_noise_from_start(self, x_t, t, x0):
+    def predict_noise_from_start(self, x_t, t, x0, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         return (
-            (extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - x0) / \
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            (coefs.sqrt_recip_alphas_cumprod * x_t - x0) / \
+            coefs.sqrt_recipm1_alphas_cumprod
         )
 
-    def predict_v(self, x_start, t, noise):
+    def predict_v(self, x_start, t, noise, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_start.shape))
+
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * noise -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * x_start
+            coefs.sqrt_alphas_cumprod * noise -
+            coefs.sqrt_one_minus_alphas_cumprod * x_start
         )
 
-    def predict_start_from_v(self, x_t, t, v):
+    def predict_start_from_v(self, x_t, t, v, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_t.shape) * v
+            coefs.sqrt_alphas_cumprod * x_t -
+            coefs.sqrt_one_minus_alphas_cumprod * v
         )
 
-    def q_posterior(self, x_start, x_t, t):
+    def q_posterior(self, x_start, x_t, t, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         posterior_mean = (
-            extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-            extract(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            coefs.posterior_mean_coef1 * x_start +
+            coefs.posterior_mean_coef2 * x_t
         )
-        posterior_variance = extract(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = extract(self.posterior_log_variance_clipped, t, x_t.shape)
+        posterior_variance = coefs.posterior_variance
+        posterior_log_variance_clipped = coefs.posterior_log_variance_clipped
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
 
-    def model_predictions(self, x, t, x_self_cond = None, clip_x_start = False):
+    def model_predictions(self, x, t, x_self_cond = None, clip_x_start = False, coefs = None):
         model_output = self.model(x, t, x_self_cond)
         maybe_clip = partial(torch.clamp, min = -1., max = 1.) if clip_x_start else identity
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x.shape))
 
         if self.objective == 'pred_noise':
             pred_noise = model_output
-            x_start = self.predict_start_from_noise(x, t, pred_noise)
+            x_start = self.predict_start_from_noise(x, t, pred_noise, coefs)
             x_start = maybe_clip(x_start)
 
         elif self.objective == 'pred_x0':
             x_start = model_output
             x_start = maybe_clip(x_start)
-            pred_noise = self.predict_noise_from_start(x, t, x_start)
+            pred_noise = self.predict_noise_from_start(x, t, x_start, coefs)
 
         elif self.objective == 'pred_v':
             v = model_output
-            x_start = self.predict_start_from_v(x, t, v)
+            x_start = self.predict_start_from_v(x, t, v, coefs)
             x_start = maybe_clip(x_start)
-            pred_noise = self.predict_noise_from_start(x, t, x_start)
+            pred_noise = self.predict_noise_from_start(x, t, x_start, coefs)
 
         return ModelPrediction(pred_noise, x_start)
 
     def p_mean_variance(self, x, t, x_self_cond = None, clip_denoised = True):
-        preds = self.model_predictions(x, t, x_self_cond)
+        coefs = self.schedule_coefs(t, x.shape)
+        preds = self.model_predictions(x, t, x_self_cond, coefs = coefs)
         x_start = preds.pred_x_start
 
         if clip_denoised:
             x_start.clamp_(-1., 1.)
 
-        model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start = x_start, x_t = x, t = t)
+        model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start = x_start, x_t = x, t = t, coefs = coefs)
         return model_mean, posterior_variance, posterior_log_variance, x_start
 
+    @contextmanager
+    def cached_time_conditioning(self, times):
+        # the time conditioning of the unet is precomputed for all the timesteps visited while sampling
+        # they are checked here once, as the unet does not check the timesteps it is called with against the cache
+
+        model = self.model
+
+        if not hasattr(model, 'cache_time_conditioning'):
+            yield
+            return
+
+        times = list(times)
+        assert all(0 <= time < self.num_timesteps for time in times), f'the cached timesteps must be in [0, {self.num_timesteps})'
+
+        model.cache_time_conditioning(torch.tensor(times, device = self.betas.device, dtype = torch.long))
+
+        try:
+            yield
+        finally:
+            model.clear_time_conditioning_cache()
+
+    @contextmanager
+    def cached_deep_features(self):
+        # the deep features of the unet are reused for feature_cache_interval - 1 steps after every full forward
+
+        model = self.model
+
+        if self.feature_cache_interval == 1 or not hasattr(model, 'enable_deep_feature_cache'):
+            yield lambda step: None
+            return
+
+        model.enable_deep_feature_cache()
+
+        def set_step(step):
+            model.reuse_deep_features = (step % self.feature_cache_interval) != 0
+
+        try:
+            yield set_step
+        finally:
+            model.clear_deep_feature_cache()
+
     @torch.no_grad()
-    def p_sample(self, x, t: int, x_self_cond = None, clip_denoised = True):
+    def p_sample(self, x, t: int, x_self_cond = None, clip_denoised = True, rng = None):
         b, *_, device = *x.shape, x.device
+        rng = default(rng, lambda: SampleRNG(device = device))
         batched_times = torch.full((x.shape[0],), t, device = x.device, dtype = torch.long)
         model_mean, _, model_log_variance, x_start = self.p_mean_variance(x = x, t = batched_times, x_self_cond = x_self_cond, clip_denoised = clip_denoised)
-        noise = torch.randn_like(x) if t > 0 else 0. # no noise if t == 0
+        noise = rng.randn_like(x) if t > 0 else 0. # no noise if t == 0
         pred_img = model_mean + (0.5 * model_log_variance).exp() * noise
         return pred_img, x_start
 
     @torch.no_grad()
-    def p_sample_loop(self, shape):
+    def p_sample_loop(self, shape, rng = None):
         batch, device = shape[0], self.betas.device
+        rng = default(rng, lambda: SampleRNG(device = device))
 
-        img = torch.randn(shape, device=device)
+        img = rng.randn(shape)
 
         x_start = None
 
-        for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps):
-            self_cond = x_start if self.self_condition else None
-            img, x_start = self.p_sample(img, t, self_cond)
+        with self.cached_time_conditioning(range(self.num_timesteps)):
+            for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps):
+                self_cond = x_start if self.self_condition else None
+                img, x_start = self.p_sample(img, t, self_cond, rng = rng)
 
-        img = unnormalize_to_zero_to_one(img)
+        img = self.unnormalize(img)
         return img
 
+    def set_ddim_timesteps(self, times):
+        # use a custom (for example searched, see timestep_search.py) set of timesteps for ddim sampling instead of the uniform one
+        # the search tunes the timesteps for the deterministic (eta = 0) sampler, so ddim sampling must not add noise
+
+        assert self.sampler != 'ddim' or self.ddim_sampling_eta == 0, 'searched ddim timesteps are tuned for deterministic sampling, set ddim_sampling_eta = 0.'
+
+        times = sorted(set(int(time) for time in times), reverse = True)
+        assert len(times) > 0 and times[0] < self.num_timesteps and times[-1] >= 0, f'ddim timesteps must be between 0 and {self.num_timesteps - 1}'
+
+        self.ddim_timesteps = torch.tensor(times, dtype = torch.long, device = self.betas.device)
+        self.sampling_timesteps = len(times)
+        self.is_ddim_sampling = True
+
+    def clear_ddim_timesteps(self):
+        # back to the uniform ddim timesteps (or ancestral sampling) given at init
+
+        self.ddim_timesteps = None
+        self.sampling_timesteps = self.uniform_sampling_timesteps
+        self.is_ddim_sampling = self.sampling_timesteps < self.num_timesteps
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the ddim timesteps buffer only exists once set, so it is set from the checkpoint before loading,
+        # or cleared if the checkpoint has none, so that checkpoints without searched timesteps still load strictly
+
+        key = f'{prefix}ddim_timesteps'
+
+        if key in state_dict:
+            self.set_ddim_timesteps(state_dict[key].tolist())
+        elif exists(self.ddim_timesteps):
+            self.clear_ddim_timesteps()
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def sampling_times(self, sampling_timesteps = None):
+        # the searched ddim timesteps if set, otherwise sampling_timesteps evenly spaced ones
+
+        if exists(self.ddim_timesteps) and not exists(sampling_timesteps):
+            return [*self.ddim_timesteps.tolist(), -1]
+
+        sampling_timesteps = default(sampling_timesteps, self.sampling_timesteps)
+        times = torch.linspace(-1, self.num_timesteps - 1, steps=sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
+        return list(reversed(times.int().tolist()))
+
     @torch.no_grad()
-    def ddim_sample(self, shape, clip_denoised = True):
-        batch, device, total_timesteps, sampling_timesteps, eta, objective = shape[0], self.betas.device, self.num_timesteps, self.sampling_timesteps, self.ddim_sampling_eta, self.objective
+    def ddim_sample(self, shape, clip_denoised = True, times = None, rng = None):
+        batch, device, eta, objective = shape[0], self.betas.device, self.ddim_sampling_eta, self.objective
+        rng = default(rng, lambda: SampleRNG(device = device))
 
-        times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
+        times = default(times, self.sampling_times)
         time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
 
-        img = torch.randn(shape, device = device)
+        img = rng.randn(shape)
 
         x_start = None
 
-        for time, time_next in tqdm(time_pairs, desc = 'sampling loop time step'):
+        with self.cached_time_conditioning(times[:-1]), self.cached_deep_features() as set_feature_cache_step:
+            for step, (time, time_next) in enumerate(tqdm(time_pairs, desc = 'sampling loop time step')):
+                set_feature_cache_step(step)
+
+                time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
+                self_cond = x_start if self.self_condition else None
+                pred_noise, x_start, *_ = self.model_predictions(img, time_cond, self_cond, clip_x_start = clip_denoised)
+
+                if time_next < 0:
+                    img = x_start
+                    continue
+
+                alpha = self.alphas_cumprod[time]
+                alpha_next = self.alphas_cumprod[time_next]
+
+                sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
+                c = (1 - alpha_next - sigma ** 2).sqrt()
+
+                noise = rng.randn_like(img)
+
+                img = x_start * alpha_next.sqrt() + \
+                      c * pred_noise + \
+                      sigma * noise
+
+        img = self.unnormalize(img)
+        return img
+
+    @torch.no_grad()
+    def multistep_solver_sample(self, shape, clip_denoised = True, rng = None):
+        batch, device = shape[0], self.betas.device
+        rng = default(rng, lambda: SampleRNG(device = device))
+
+        times = self.sampling_times()[:-1] # [T-1, ..., 0], the x0 prediction at time 0 is returned, as in ddim
+
+        img = rng.randn(shape)
+
+        x_start = None
+
+        def x_start_fn(img, time):
+            nonlocal x_start
             time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
             self_cond = x_start if self.self_condition else None
-            pred_noise, x_start, *_ = self.model_predictions(img, time_cond, self_cond, clip_x_start = clip_denoised)
+            _, x_start, *_ = self.model_predictions(img, time_cond, self_cond, clip_x_start = clip_denoised)
+            return x_start
 
-            if time_next < 0:
-                img = x_start
-                continue
+        solver_fn = dpm_solver_pp_sample if self.sampler == 'dpm_solver++' else unipc_sample
 
-            alpha = self.alphas_cumprod[time]
-            alpha_next = self.alphas_cumprod[time_next]
+        with self.cached_time_conditioning(times):
+            img = solver_fn(x_start_fn, img, times, self.alphas_cumprod.tolist(), order = self.solver_order)
 
-            sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-            c = (1 - alpha_next - sigma ** 2).sqrt()
+        img = self.unnormalize(img)
+        return img
 
-            noise = torch.randn_like(img)
+    @torch.no_grad()
+    def quantize_for_cpu(self, calibration_batch_size = 4, calibration_steps = 10, backend = 'fbgemm'):
+        # int8 quantizes the unet for sampling on cpu, calibrated on its own short ddim trajectories
+        # so that the observed activation ranges cover the timesteps visited while sampling
 
-            img = x_start * alpha_next.sqrt() + \
-                  c * pred_noise + \
-                  sigma * noise
+        self.cpu()
 
-        img = unnormalize_to_zero_to_one(img)
-        return img
+        def calibrate_fn(model):
+            sampling_timesteps = self.sampling_timesteps
+            self.sampling_timesteps = min(calibration_steps, self.num_timesteps)
+
+            try:
+                self.ddim_sample((calibration_batch_size, self.channels, self.image_size, self.image_size))
+            finally:
+                self.sampling_timesteps = sampling_timesteps
+
+        self.model.quantize_for_cpu(calibrate_fn, backend = backend)
+        return self
 
     @torch.no_grad()
-    def sample(self, batch_size = 16):
+    def sample(self, batch_size = 16, seeds = None):
+        # with seeds, one per sample, every sample is drawn with its own generator and is the same regardless of the batch it is sampled in
         image_size, channels = self.image_size, self.channels
-        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
-        return sample_fn((batch_size, channels, image_size, image_size))
+        fast_sample_fn = self.ddim_sample if self.sampler == 'ddim' else self.multistep_solver_sample
+        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else fast_sample_fn
+
+        if exists(seeds):
+            batch_size = len(seeds)
+
+        rng = SampleRNG(seeds, device = self.betas.device)
+        return sample_fn((batch_size, channels, image_size, image_size), rng = rng)
 
     @torch.no_grad()
     def interpolate(self, x1, x2, t = None, lam = 0.5):
@@ -646,12 +1101,13 @@ class GaussianDiffusion(nn.Module):
 
         return img
 
-    def q_sample(self, x_start, t, noise=None):
+    def q_sample(self, x_start, t, noise=None, coefs = None):
         noise = default(noise, lambda: torch.randn_like(x_start))
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_start.shape))
 
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            coefs.sqrt_alphas_cumprod * x_start +
+            coefs.sqrt_one_minus_alphas_cumprod * noise
         )
 
     @property
@@ -666,10 +1122,11 @@ class GaussianDiffusion(nn.Module):
     def p_losses(self, x_start, t, noise = None):
         b, c, h, w = x_start.shape
         noise = default(noise, lambda: torch.randn_like(x_start))
+        coefs = self.schedule_coefs(t, x_start.shape)
 
         # noise sample
 
-        x = self.q_sample(x_start = x_start, t = t, noise = noise)
+        x = self.q_sample(x_start = x_start, t = t, noise = noise, coefs = coefs)
 
         # if doing self-conditioning, 50% of the time, predict x_start from current set of times
         # and condition with unet with that
@@ -678,7 +1135,7 @@ class GaussianDiffusion(nn.Module):
         x_self_cond = None
         if self.self_condition and random() < 0.5:
             with torch.no_grad():
-                x_self_cond = self.model_predictions(x, t).pred_x_start
+                x_self_cond = self.model_predictions(x, t, coefs = coefs).pred_x_start
                 x_self_cond.detach_()
 
         # predict and take gradient step
@@ -690,7 +1147,7 @@ class GaussianDiffusion(nn.Module):
         elif self.objective == 'pred_x0':
             target = x_start
         elif self.objective == 'pred_v':
-            v = self.predict_v(x_start, t, noise)
+            v = self.predict_v(x_start, t, noise, coefs)
             target = v
         else:
             raise ValueError(f'unknown objective {self.objective}')
@@ -698,7 +1155,7 @@ class GaussianDiffusion(nn.Module):
         loss = self.loss_fn(model_out, target, reduction = 'none')
         loss = reduce(loss, 'b ... -> b (...)', 'mean')
 
-        loss = loss * extract(self.p2_loss_weight, t, loss.shape)
+        loss = loss * coefs.p2_loss_weight.reshape(b, 1)
         return loss.mean()
 
     def forward(self, img, *args, **kwargs):
@@ -706,11 +1163,61 @@ class GaussianDiffusion(nn.Module):
         assert h == img_size and w == img_size, f'height and width of image must be {img_size}'
         t = torch.randint(0, self.num_timesteps, (b,), device=device).long()
 
-        img = normalize_to_neg_one_to_one(img)
+        img = self.normalize(img)
         return self.p_losses(img, t, *args, **kwargs)
 
 # dataset classes
 
+def decode_image_to_array(path, transform):
+    img = transform(Image.open(path))
+    arr = np.asarray(img, dtype = np.uint8)
+
+    if arr.ndim == 2:
+        arr = arr[..., None]
+
+    return arr.transpose(2, 0, 1)
+
+def build_image_cache(
+    folder,
+    image_size,
+    cache_path,
+    exts = ['jpg', 'jpeg', 'png', 'tiff'],
+    convert_image_to = None,
+    num_workers = None,
+    manifest_path = None
+):
+    # decode, resize and center crop every image once, into a single uint8 array of shape (num images, channels, height, width) saved as .npy
+
+    paths = list_image_paths(folder, exts, manifest_path = manifest_path)
+    assert len(paths) > 0, f'no images found in {folder}'
+
+    maybe_convert_fn = partial(convert_image_to_fn, convert_image_to) if exists(convert_image_to) else nn.Identity()
+
+    transform = T.Compose([
+        T.Lambda(maybe_convert_fn),
+        T.Resize(image_size),
+        T.CenterCrop(image_size)
+    ])
+
+    decode_fn = partial(decode_image_to_array, transform = transform)
+    first = decode_fn(paths[0])
+
+    cache_path = Path(cache_path)
+    tmp_path = cache_path.with_name(f'{cache_path.stem}.tmp.npy')
+
+    cache = np.lib.format.open_memmap(str(tmp_path), mode = 'w+', dtype = np.uint8, shape = (len(paths), *first.shape))
+
+    with Pool(default(num_workers, cpu_count())) as pool:
+        for ind, arr in enumerate(tqdm(pool.imap(decode_fn, paths, chunksize = 64), total = len(paths), desc = 'building image cache')):
+            assert arr.shape == first.shape, f'{paths[ind]} decoded to shape {arr.shape}, but expected {first.shape} - set convert_image_to so all images have the same number of channels'
+            cache[ind] = arr
+
+    cache.flush()
+    del cache
+
+    tmp_path.replace(cache_path)
+    return cache_path
+
 class Dataset(Dataset):
     def __init__(
         self,
@@ -718,12 +1225,33 @@ class Dataset(Dataset):
         image_size,
         exts = ['jpg', 'jpeg', 'png', 'tiff'],
         augment_horizontal_flip = False,
-        convert_image_to = None
+        convert_image_to = None,
+        cache_path = None,
+        manifest_path = None,
+        check_manifest = True,
+        uint8_output = False
     ):
         super().__init__()
         self.folder = folder
         self.image_size = image_size
-        self.paths = [p for ext in exts for p in Path(f'{folder}').glob(f'**/*.{ext}')]
+        self.augment_horizontal_flip = augment_horizontal_flip
+
+        # return the images as uint8 tensors, leaving the conversion to float (and any flipping) to be done batched on the training device
+
+        self.uint8_output = uint8_output
+
+        # read from a cache built with build_image_cache, memory mapped so that all dataloader workers share the page cache
+
+        self.cache = None
+
+        if exists(cache_path):
+            self.cache = np.load(str(cache_path), mmap_mode = 'r')
+            assert self.cache.shape[-2:] == (image_size, image_size), f'image cache at {cache_path} has images of size {self.cache.shape[-2:]}, but expected {image_size}'
+            return
+
+        # the image paths are read from a manifest if given, see list_image_paths, so the folder is only walked when it changed
+
+        self.paths = list_image_paths(folder, exts, manifest_path = manifest_path, check_manifest = check_manifest)
 
         maybe_convert_fn = partial(convert_image_to_fn, convert_image_to) if exists(convert_image_to) else nn.Identity()
 
@@ -732,13 +1260,36 @@ class Dataset(Dataset):
             T.Resize(image_size),
             T.RandomHorizontalFlip() if augment_horizontal_flip else nn.Identity(),
             T.CenterCrop(image_size),
-            T.ToTensor()
+            T.PILToTensor() if uint8_output else T.ToTensor()
         ])
 
     def __len__(self):
+        if exists(self.cache):
+            return self.cache.shape[0]
+
         return len(self.paths)
 
+    def get_cached(self, index):
+        # a read only view into the memory mapped cache, which is only copied by the flip, the conversion to float, or the collation into a batch
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning) # the view is never written to
+            img = torch.from_numpy(np.asarray(self.cache[index]))
+
+        # flipped as in the transform of the uncached images, with or without uint8 output
+
+        if self.augment_horizontal_flip and random() < 0.5:
+            img = img.flip(-1)
+
+        if self.uint8_output:
+            return img
+
+        return img.float() / 255.
+
     def __getitem__(self, index):
+        if exists(self.cache):
+            return self.get_cached(index)
+
         path = self.paths[index]
         img = Image.open(path)
         return self.transform(img)
@@ -758,6 +1309,8 @@ class Trainer(object):
         train_num_steps = 100000,
         ema_update_every = 10,
         ema_decay = 0.995,
+        ema_device = None,
+        ema_dtype = None,
         adam_betas = (0.9, 0.99),
         save_and_sample_every = 1000,
         num_samples = 25,
@@ -765,7 +1318,16 @@ class Trainer(object):
         amp = False,
         fp16 = False,
         split_batches = True,
-        convert_image_to = None
+        convert_image_to = None,
+        image_cache_path = None,
+        manifest_path = None,
+        sharded_dataset = False,
+        shuffle_buffer_size = 1000,
+        uint8_transfer = False,
+        async_checkpoint = False,
+        keep_last_n_checkpoints = None,
+        sample_mode = 'main',
+        log_every = 10
     ):
         super().__init__()
 
@@ -779,7 +1341,9 @@ class Trainer(object):
         self.model = diffusion_model
 
         assert has_int_squareroot(num_samples), 'number of samples must have an integer square root'
+        assert sample_mode in {'main', 'sharded', 'background'}, 'sample_mode must be one of main, sharded or background'
         self.num_samples = num_samples
+        self.sample_mode = sample_mode
         self.save_and_sample_every = save_and_sample_every
 
         self.batch_size = train_batch_size
@@ -788,12 +1352,58 @@ class Trainer(object):
         self.train_num_steps = train_num_steps
         self.image_size = diffusion_model.image_size
 
+        # the loss is only brought back to the host every log_every steps, since .item() syncs with the device
+
+        self.log_every = log_every
+
         # dataset and dataloader
 
-        self.ds = Dataset(folder, self.image_size, augment_horizontal_flip = augment_horizontal_flip, convert_image_to = convert_image_to)
-        dl = DataLoader(self.ds, batch_size = train_batch_size, shuffle = True, pin_memory = True, num_workers = cpu_count())
+        # with uint8_transfer, the dataloader workers emit uint8 images, which are copied to the device as is, a quarter of the bytes of float32
+        # the random horizontal flips and the conversion to float are then done for the whole batch on the device, see prepare_batch
+
+        self.uint8_transfer = uint8_transfer
+        self.augment_horizontal_flip = augment_horizontal_flip
+
+        dataset_kwargs = dict(
+            augment_horizontal_flip = augment_horizontal_flip and not uint8_transfer,
+            convert_image_to = convert_image_to,
+            uint8_output = uint8_transfer
+        )
+
+        # optionally decode all images once into a memory mapped uint8 cache, built by the main process and then shared by every rank
+
+        if exists(image_cache_path) and not Path(image_cache_path).exists():
+            if self.accelerator.is_main_process:
+                build_image_cache(folder, self.image_size, image_cache_path, convert_image_to = convert_image_to, manifest_path = manifest_path)
+
+            self.accelerator.wait_for_everyone()
+
+        # the manifest of image paths is checked and, if stale, rebuilt by the main process, then read as is by every other rank
+
+        use_manifest = exists(manifest_path) and not exists(image_cache_path) and not sharded_dataset
+
+        if use_manifest:
+            if self.accelerator.is_main_process:
+                list_image_paths(folder, manifest_path = manifest_path)
+
+            self.accelerator.wait_for_everyone()
+
+        # or stream from tar shards written by write_image_shards, which are split across the ranks and dataloader workers by the dataset itself
+        # so the dataloader is not prepared, as accelerate would otherwise dispatch all batches from the main process
+
+        assert not (sharded_dataset and exists(image_cache_path)), 'the image cache cannot be used with a sharded dataset'
+
+        if sharded_dataset:
+            num_processes = self.accelerator.num_processes
+            self.dl_batch_size = train_batch_size // num_processes if split_batches else train_batch_size
+
+            self.ds = ShardedImageDataset(folder, self.image_size, shuffle_buffer_size = shuffle_buffer_size, rank = self.accelerator.process_index, world_size = num_processes, **dataset_kwargs)
+            dl = DataLoader(self.ds, batch_size = self.dl_batch_size, pin_memory = True, num_workers = min(cpu_count(), len(self.ds.shard_paths) // num_processes))
+        else:
+            self.ds = Dataset(folder, self.image_size, cache_path = image_cache_path, manifest_path = manifest_path if use_manifest else None, check_manifest = False, **dataset_kwargs)
+            dl = DataLoader(self.ds, batch_size = train_batch_size, shuffle = True, pin_memory = True, num_workers = cpu_count())
+            dl = self.accelerator.prepare_data_loader(dl, device_placement = not uint8_transfer)
 
-        dl = self.accelerator.prepare(dl)
         self.dl = cycle(dl)
 
         # optimizer
@@ -801,13 +1411,26 @@ class Trainer(object):
         self.opt = Adam(diffusion_model.parameters(), lr = train_lr, betas = adam_betas)
 
         # for logging results in a folder periodically
+        # when milestone sampling is sharded, every rank keeps an ema, which stays in sync since the model parameters are synced
 
-        if self.accelerator.is_main_process:
-            self.ema = EMA(diffusion_model, beta = ema_decay, update_every = ema_update_every)
+        self.has_ema = self.accelerator.is_main_process or sample_mode == 'sharded'
+
+        self.results_folder = Path(results_folder)
 
-            self.results_folder = Path(results_folder)
+        if self.accelerator.is_main_process:
             self.results_folder.mkdir(exist_ok = True)
 
+        # checkpointing - optionally written from a background thread, from a snapshot of the state on cpu
+
+        self.keep_last_n_checkpoints = keep_last_n_checkpoints
+        self.checkpoint_executor = ThreadPoolExecutor(max_workers = 1) if async_checkpoint else None
+        self.pending_checkpoint = None
+
+        # milestone sampling - optionally run from a background thread on a snapshot of the ema model
+
+        self.sample_executor = ThreadPoolExecutor(max_workers = 1) if sample_mode == 'background' else None
+        self.pending_samples = None
+
         # step counter state
 
         self.step = 0
@@ -816,6 +1439,48 @@ class Trainer(object):
 
         self.model, self.opt = self.accelerator.prepare(self.model, self.opt)
 
+        # the ema is created once the model is on the training device, so it can share the schedule buffers with it
+        # the shadow weights can be kept in another precision (ema_dtype) or on another device (ema_device = 'cpu')
+
+        if self.has_ema:
+            self.ema = FusedEMA(self.accelerator.unwrap_model(self.model), beta = ema_decay, update_every = ema_update_every, ema_device = ema_device, ema_dtype = ema_dtype)
+
+    def checkpoint_path(self, milestone):
+        return self.results_folder / f'model-{milestone}.pt'
+
+    @property
+    def checkpoint_milestones(self):
+        milestones = []
+
+        for path in self.results_folder.glob('model-*.pt'):
+            milestone = path.stem[len('model-'):]
+            if milestone.isdigit():
+                milestones.append(int(milestone))
+
+        return sorted(milestones)
+
+    def write_checkpoint(self, data, milestone):
+        # write to a temporary file and rename, so a checkpoint is either complete or absent
+
+        path = self.checkpoint_path(milestone)
+        tmp_path = path.with_name(f'{path.name}.tmp')
+
+        torch.save(data, str(tmp_path))
+        tmp_path.replace(path)
+
+        if not exists(self.keep_last_n_checkpoints):
+            return
+
+        for old_milestone in self.checkpoint_milestones[:-self.keep_last_n_checkpoints]:
+            self.checkpoint_path(old_milestone).unlink(missing_ok = True)
+
+    def wait_for_checkpoint(self):
+        if not exists(self.pending_checkpoint):
+            return
+
+        self.pending_checkpoint.result()
+        self.pending_checkpoint = None
+
     def save(self, milestone):
         if not self.accelerator.is_local_main_process:
             return
@@ -828,71 +1493,197 @@ class Trainer(object):
             'scaler': self.accelerator.scaler.state_dict() if exists(self.accelerator.scaler) else None
         }
 
-        torch.save(data, str(self.results_folder / f'model-{milestone}.pt'))
+        if not exists(self.checkpoint_executor):
+            self.write_checkpoint(data, milestone)
+            return
+
+        # snapshot to cpu before training mutates the parameters and optimizer state in place, then write in the background
+
+        self.wait_for_checkpoint()
+        data = tree_to_cpu(data)
+        self.pending_checkpoint = self.checkpoint_executor.submit(self.write_checkpoint, data, milestone)
 
-    def load(self, milestone):
+    def load(self, milestone = None):
         accelerator = self.accelerator
         device = accelerator.device
 
-        data = torch.load(str(self.results_folder / f'model-{milestone}.pt'), map_location=device)
+        self.wait_for_checkpoint()
+
+        # resume from the newest complete checkpoint if no milestone is given
+
+        if not exists(milestone):
+            milestones = self.checkpoint_milestones
+            assert len(milestones) > 0, f'no checkpoints found in {self.results_folder}'
+            milestone = milestones[-1]
+
+        data = torch.load(str(self.checkpoint_path(milestone)), map_location=device)
 
         model = self.accelerator.unwrap_model(self.model)
         model.load_state_dict(data['model'])
 
         self.step = data['step']
         self.opt.load_state_dict(data['opt'])
-        self.ema.load_state_dict(data['ema'])
+
+        if self.has_ema:
+            self.ema.load_state_dict(data['ema'])
+
+        # the sharded dataset resumes its stream after the batches already trained on
+        # this is approximate - the shuffle buffer is not checkpointed, so the images it held are skipped until the next epoch
+
+        if isinstance(self.ds, ShardedImageDataset):
+            self.ds.set_position(self.step * self.gradient_accumulate_every, self.dl_batch_size)
 
         if exists(self.accelerator.scaler) and exists(data['scaler']):
             self.accelerator.scaler.load_state_dict(data['scaler'])
 
+    def sample_images(self, model, num_samples, seeds = None):
+        model.eval()
+
+        with torch.no_grad():
+            batches = num_to_groups(num_samples, self.batch_size)
+
+            if not exists(seeds):
+                all_images_list = list(map(lambda n: model.sample(batch_size=n), batches))
+            else:
+                seeds = list(seeds)
+                offsets = [sum(batches[:ind]) for ind in range(len(batches))]
+                all_images_list = [model.sample(seeds = seeds[offset:(offset + n)]) for offset, n in zip(offsets, batches)]
+
+        return torch.cat(all_images_list, dim = 0)
+
+    def save_samples(self, all_images, milestone):
+        utils.save_image(all_images, str(self.results_folder / f'sample-{milestone}.png'), nrow = int(math.sqrt(self.num_samples)))
+
+    def sample_and_save(self, model, milestone):
+        all_images = self.sample_images(model, self.num_samples)
+        self.save_samples(all_images, milestone)
+
+    def wait_for_samples(self):
+        if not exists(self.pending_samples):
+            return
+
+        self.pending_samples.result()
+        self.pending_samples = None
+
+    def ema_sampling_model(self):
+        # the ema model on the training device and precision, for sampling
+
+        online_param = next(self.accelerator.unwrap_model(self.model).parameters())
+        return self.ema.inference_model(device = online_param.device, dtype = online_param.dtype)
+
+    def sample_milestone(self, milestone):
+        accelerator = self.accelerator
+
+        # every rank samples its share of the grid, which is then gathered onto the main process
+        # the samples are seeded by their position in the grid, so the ranks do not repeat each other's noise and the grid is the same for any number of processes
+
+        if self.sample_mode == 'sharded':
+            num_samples_per_process = math.ceil(self.num_samples / accelerator.num_processes)
+            seeds = range(accelerator.process_index * num_samples_per_process, (accelerator.process_index + 1) * num_samples_per_process)
+            images = self.sample_images(self.ema_sampling_model(), num_samples_per_process, seeds = seeds)
+            all_images = accelerator.gather(images)[:self.num_samples]
+
+            if accelerator.is_main_process:
+                self.save_samples(all_images, milestone)
+            return
+
+        if not accelerator.is_main_process:
+            return
+
+        if self.sample_mode == 'main':
+            self.sample_and_save(self.ema_sampling_model(), milestone)
+            return
+
+        # snapshot the ema model, so it can keep updating while the grid is sampled in the background
+
+        self.wait_for_samples()
+        ema_model = self.ema_sampling_model()
+
+        if ema_model is self.ema.ema_model:
+            ema_model = copy.deepcopy(ema_model)
+        self.pending_samples = self.sample_executor.submit(self.sample_and_save, ema_model, milestone)
+
+    def prepare_batch(self, data):
+        data = data.to(self.accelerator.device, non_blocking = True)
+
+        if not self.uint8_transfer:
+            return data
+
+        if self.augment_horizontal_flip:
+            flip = torch.rand((data.shape[0], 1, 1, 1), device = data.device) < 0.5
+            data = torch.where(flip, data.flip(-1), data)
+
+        return data.float() / 255.
+
     def train(self):
         accelerator = self.accelerator
         device = accelerator.device
 
         with tqdm(initial = self.step, total = self.train_num_steps, disable = not accelerator.is_main_process) as pbar:
 
+            # loss is accumulated on device across the logging window
+
+            window_loss = torch.zeros((), device = device)
+            window_steps = 0
+            window_start = time.perf_counter()
+
             while self.step < self.train_num_steps:
 
-                total_loss = 0.
+                for micro_step in range(self.gradient_accumulate_every):
+                    data = self.prepare_batch(next(self.dl))
 
-                for _ in range(self.gradient_accumulate_every):
-                    data = next(self.dl).to(device)
+                    # only all-reduce gradients on the last micro-batch, the earlier ones accumulate locally
 
-                    with self.accelerator.autocast():
-                        loss = self.model(data)
-                        loss = loss / self.gradient_accumulate_every
-                        total_loss += loss.item()
+                    is_last_micro_step = micro_step == (self.gradient_accumulate_every - 1)
+                    sync_context = nullcontext() if is_last_micro_step else accelerator.no_sync(self.model)
 
-                    self.accelerator.backward(loss)
+                    with sync_context:
+                        with self.accelerator.autocast():
+                            loss = self.model(data)
+                            loss = loss / self.gradient_accumulate_every
+                            window_loss += loss.detach()
+
+                        self.accelerator.backward(loss)
 
                 accelerator.clip_grad_norm_(self.model.parameters(), 1.0)
-                pbar.set_description(f'loss: {total_loss:.4f}')
 
-                accelerator.wait_for_everyone()
+                # no barriers are needed around the optimizer step, gradients are already synced by the backward all-reduce
 
                 self.opt.step()
                 self.opt.zero_grad()
 
-                accelerator.wait_for_everyone()
+                # for models with state that follows the optimizer steps, such as the target network of consistency distillation
+
+                unwrapped_model = accelerator.unwrap_model(self.model)
+
+                if hasattr(unwrapped_model, 'after_optimizer_step'):
+                    unwrapped_model.after_optimizer_step()
 
                 self.step += 1
-                if accelerator.is_main_process:
-                    self.ema.to(device)
+                window_steps += 1
+
+                if self.has_ema:
                     self.ema.update()
 
-                    if self.step != 0 and self.step % self.save_and_sample_every == 0:
-                        self.ema.ema_model.eval()
+                if window_steps == self.log_every or self.step == self.train_num_steps:
+                    mean_loss = window_loss.item() / window_steps
+                    step_time = (time.perf_counter() - window_start) / window_steps
+
+                    pbar.set_description(f'loss: {mean_loss:.4f}, {step_time * 1000:.1f} ms / step')
+
+                    window_loss.zero_()
+                    window_steps = 0
+                    window_start = time.perf_counter()
 
-                        with torch.no_grad():
-                            milestone = self.step // self.save_and_sample_every
-                            batches = num_to_groups(self.num_samples, self.batch_size)
-                            all_images_list = list(map(lambda n: self.ema.ema_model.sample(batch_size=n), batches))
+                if self.step != 0 and self.step % self.save_and_sample_every == 0:
+                    milestone = self.step // self.save_and_sample_every
+                    self.sample_milestone(milestone)
 
-                        all_images = torch.cat(all_images_list, dim = 0)
-                        utils.save_image(all_images, str(self.results_folder / f'sample-{milestone}.png'), nrow = int(math.sqrt(self.num_samples)))
+                    if accelerator.is_main_process:
                         self.save(milestone)
 
                 pbar.update(1)
 
+        self.wait_for_samples()
+        self.wait_for_checkpoint()
         accelerator.print('training complete')
@@ -6,16 +6,36 @@ from collections import namedtuple
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from einops import rearrange, reduce
 from einops.layers.torch import Rearrange
 
 from tqdm.auto import tqdm
 
+from denoising_diffusion_pytorch.quantization import quantize_unet_for_cpu
+from denoising_diffusion_pytorch.multistep_solvers import dpm_solver_pp_sample, unipc_sample
+from denoising_diffusion_pytorch.sample_rng import SampleRNG
+
 # constants
 
 ModelPrediction =  namedtuple('ModelPrediction', ['pred_noise', 'pred_x_start'])
 
+# per timestep coefficients of the noise schedule, gathered together
+
+ScheduleCoefs = namedtuple('ScheduleCoefs', [
+    'betas',
+    'sqrt_alphas_cumprod',
+    'sqrt_one_minus_alphas_cumprod',
+    'sqrt_recip_alphas_cumprod',
+    'sqrt_recipm1_alphas_cumprod',
+    'posterior_variance',
+    'posterior_log_variance_clipped',
+    'posterior_mean_coef1',
+    'posterior_mean_coef2',
+    'p2_loss_weight'
+])
+
 # helpers functions
 
 def exists(x):
@@ -82,16 +102,43 @@ class WeightStandardizedConv2d(nn.Conv1d):
     https://arxiv.org/abs/1903.10520
     weight standardization purportedly works synergistically with group normalization
     """
-    def forward(self, x):
-        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
-
+    def normalized_weight(self, eps):
         weight = self.weight
         mean = reduce(weight, 'o ... -> o 1 1', 'mean')
         var = reduce(weight, 'o ... -> o 1 1', partial(torch.var, unbiased = False))
-        normalized_weight = (weight - mean) * (var + eps).rsqrt()
+        return (weight - mean) * (var + eps).rsqrt()
+
+    def forward(self, x):
+        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
+        normalized_weight = self.normalized_weight(eps)
 
         return F.conv1d(x, normalized_weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
 
+    @torch.no_grad()
+    def to_conv(self):
+        weight = self.weight
+        eps = 1e-5 if weight.dtype == torch.float32 else 1e-3
+
+        conv = nn.Conv1d(
+            self.in_channels,
+            self.out_channels,
+            self.kernel_size,
+            stride = self.stride,
+            padding = self.padding,
+            dilation = self.dilation,
+            groups = self.groups,
+            bias = exists(self.bias),
+            device = weight.device,
+            dtype = weight.dtype
+        )
+
+        conv.weight.copy_(self.normalized_weight(eps))
+
+        if exists(self.bias):
+            conv.bias.copy_(self.bias)
+
+        return conv
+
 class LayerNorm(nn.Module):
     def __init__(self, dim):
         super().__init__()
@@ -222,29 +269,66 @@ class LinearAttention(nn.Module):
         return self.to_out(out)
 
 class Attention(nn.Module):
-    def __init__(self, dim, heads = 4, dim_head = 32):
+    def __init__(self, dim, heads = 4, dim_head = 32, use_sdpa = True, query_chunk_size = 1024):
         super().__init__()
         self.scale = dim_head ** -0.5
         self.heads = heads
         hidden_dim = dim_head * heads
 
+        # use the fused scaled dot product attention when available (pytorch 2.0 and above), and chunk the queries otherwise
+
+        self.use_sdpa = use_sdpa and hasattr(F, 'scaled_dot_product_attention')
+        self.query_chunk_size = query_chunk_size
+
         self.to_qkv = nn.Conv1d(dim, hidden_dim * 3, 1, bias = False)
         self.to_out = nn.Conv1d(hidden_dim, dim, 1)
 
+    def attend(self, q, k, v):
+        if self.use_sdpa:
+            q, k, v = map(lambda t: t.contiguous(), (q, k, v)) # the fused kernels need the head dimension to be contiguous
+            return F.scaled_dot_product_attention(q, k, v) # default scale of dim_head ** -0.5 is the same as self.scale
+
+        # fallback, where the similarity matrix is only ever materialized for a chunk of queries at a time, bounding peak memory
+
+        q = q * self.scale
+
+        out = []
+
+        for q_chunk in q.split(self.query_chunk_size, dim = -2):
+            sim = einsum('b h i d, b h j d -> b h i j', q_chunk, k)
+            attn = sim.softmax(dim = -1)
+            out.append(einsum('b h i j, b h j d -> b h i d', attn, v))
+
+        return torch.cat(out, dim = -2)
+
     def forward(self, x):
         b, c, n = x.shape
         qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h = self.heads), qkv)
+        q, k, v = map(lambda t: rearrange(t, 'b (h d) n -> b h n d', h = self.heads), qkv)
 
-        q = q * self.scale
-
-        sim = einsum('b h d i, b h d j -> b h i j', q, k)
-        attn = sim.softmax(dim = -1)
-        out = einsum('b h i j, b h d j -> b h i d', attn, v)
+        out = self.attend(q, k, v)
 
         out = rearrange(out, 'b h n d -> b (h d) n')
         return self.to_out(out)
 
+# activation checkpointing, where the resnet blocks and attention of a resolution level are recomputed during backward
+
+def down_level(block1, block2, attn, x, *cond):
+    skip = block1(x, *cond)
+    x = block2(skip, *cond)
+    x = attn(x)
+    return skip, x
+
+def mid_level(block1, attn, block2, x, *cond):
+    x = block1(x, *cond)
+    x = attn(x)
+    return block2(x, *cond)
+
+def up_level(block1, block2, attn, x, first_skip, second_skip, *cond):
+    x = block1(torch.cat((x, first_skip), dim = 1), *cond)
+    x = block2(torch.cat((x, second_skip), dim = 1), *cond)
+    return attn(x)
+
 # model
 
 class Unet1D(nn.Module):
@@ -260,7 +344,8 @@ class Unet1D(nn.Module):
         learned_variance = False,
         learned_sinusoidal_cond = False,
         random_fourier_features = False,
-        learned_sinusoidal_dim = 16
+        learned_sinusoidal_dim = 16,
+        gradient_checkpointing = False
     ):
         super().__init__()
 
@@ -335,6 +420,65 @@ class Unet1D(nn.Module):
         self.final_res_block = block_klass(dim * 2, dim, time_emb_dim = time_dim)
         self.final_conv = nn.Conv1d(dim, self.out_dim, 1)
 
+        # recompute the activations of each resolution level during backward, trading compute for memory
+
+        self.gradient_checkpointing = gradient_checkpointing
+
+        # weight standardized convs that were folded into plain convs for inference
+
+        self.standardized_convs = []
+        self.quantized = False
+
+    def run_level(self, fn, *args):
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint(fn, *args, use_reentrant = False)
+
+        return fn(*args)
+
+    @property
+    def frozen_for_inference(self):
+        return len(self.standardized_convs) > 0
+
+    @torch.no_grad()
+    def freeze_for_inference(self):
+        # weights are frozen while sampling, so the weight standardization can be folded into plain convs once
+        # the original convs are kept, and restored with unfreeze_for_training
+
+        if self.frozen_for_inference:
+            return self
+
+        for block in self.modules():
+            if not isinstance(block, Block):
+                continue
+
+            self.standardized_convs.append((block, block.proj))
+            block.proj = block.proj.to_conv()
+
+        return self
+
+    def unfreeze_for_training(self):
+        assert not self.quantized, 'a unet quantized for cpu inference cannot be unfrozen for training'
+
+        for block, standardized_conv in self.standardized_convs:
+            block.proj = standardized_conv
+
+        self.standardized_convs = []
+        return self
+
+    def _apply(self, fn, *args, **kwargs):
+        # the original convs kept while frozen are not submodules, so that they stay out of parameters() and the state dict
+        # they still follow the unet through .to(), .half(), .cuda() and the like, to be restored on the same device and dtype
+
+        for _, standardized_conv in self.standardized_convs:
+            standardized_conv._apply(fn, *args, **kwargs)
+
+        return super()._apply(fn, *args, **kwargs)
+
+    def quantize_for_cpu(self, calibrate_fn, backend = 'fbgemm'):
+        quantize_unet_for_cpu(self, calibrate_fn, backend = backend)
+        self.quantized = True
+        return self
+
     def forward(self, x, time, x_self_cond = None):
         if self.self_condition:
             x_self_cond = default(x_self_cond, lambda: torch.zeros_like(x))
@@ -348,27 +492,16 @@ class Unet1D(nn.Module):
         h = []
 
         for block1, block2, attn, downsample in self.downs:
-            x = block1(x, t)
-            h.append(x)
-
-            x = block2(x, t)
-            x = attn(x)
+            skip, x = self.run_level(partial(down_level, block1, block2, attn), x, t)
+            h.append(skip)
             h.append(x)
 
             x = downsample(x)
 
-        x = self.mid_block1(x, t)
-        x = self.mid_attn(x)
-        x = self.mid_block2(x, t)
+        x = self.run_level(partial(mid_level, self.mid_block1, self.mid_attn, self.mid_block2), x, t)
 
         for block1, block2, attn, upsample in self.ups:
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block1(x, t)
-
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block2(x, t)
-            x = attn(x)
-
+            x = self.run_level(partial(up_level, block1, block2, attn), x, h.pop(), h.pop(), t)
             x = upsample(x)
 
         x = torch.cat((x, r), dim = 1)
@@ -414,7 +547,9 @@ class GaussianDiffusion1D(nn.Module):
         beta_schedule = 'cosine',
         p2_loss_weight_gamma = 0.,
         p2_loss_weight_k = 1,
-        ddim_sampling_eta = 1.
+        ddim_sampling_eta = 1.,
+        sampler = 'ddim',         # the sampler used when sampling_timesteps is less than timesteps, one of 'ddim', 'dpm_solver++', 'unipc'
+        solver_order = 2          # order of the dpm_solver++ or unipc multistep solvers
     ):
         super().__init__()
         self.model = model
@@ -448,8 +583,18 @@ class GaussianDiffusion1D(nn.Module):
 
         assert self.sampling_timesteps <= timesteps
         self.is_ddim_sampling = self.sampling_timesteps < timesteps
+
+        self.uniform_sampling_timesteps = self.sampling_timesteps # restored by clear_ddim_timesteps
         self.ddim_sampling_eta = ddim_sampling_eta
 
+        assert sampler in {'ddim', 'dpm_solver++', 'unipc'}, 'sampler must be either ddim, dpm_solver++ or unipc'
+        self.sampler = sampler
+        self.solver_order = solver_order
+
+        # optional searched timestep schedule for ddim sampling, saved with the state dict, see set_ddim_timesteps
+
+        self.register_buffer('ddim_timesteps', None)
+
         # helper function to register buffer from float64 to float32
 
         register_buffer = lambda name, val: self.register_buffer(name, val.to(torch.float32))
@@ -484,104 +629,170 @@ class GaussianDiffusion1D(nn.Module):
 
         register_buffer('p2_loss_weight', (p2_loss_weight_k + alphas_cumprod / (1 - alphas_cumprod)) ** -p2_loss_weight_gamma)
 
-    def predict_start_from_noise(self, x_t, t, noise):
+        # all the per timestep coefficients packed into one [timesteps, coefficients] table, see schedule_coefs
+
+        self.register_buffer('schedule_coef_table', torch.stack([getattr(self, name) for name in ScheduleCoefs._fields], dim = -1), persistent = False)
+
+    def schedule_coefs(self, t, x_shape):
+        # one gather for all the schedule coefficients at timesteps t, instead of one extract per coefficient
+
+        b, *_ = t.shape
+        coefs = self.schedule_coef_table[t]
+        coefs = coefs.reshape(b, -1, *((1,) * (len(x_shape) - 1)))
+        return ScheduleCoefs(*coefs.unbind(dim = 1))
+
+    def predict_start_from_noise(self, x_t, t, noise, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         return (
-            extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
+            coefs.sqrt_recip_alphas_cumprod * x_t -
+            coefs.sqrt_recipm1_alphas_cumprod * noise
         )
 
-    def predict_noise_from_start(self, x_t, t, x0):
+    def predict_noise_from_start(self, x_t, t, x0, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         return (
-            (extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - x0) / \
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            (coefs.sqrt_recip_alphas_cumprod * x_t - x0) / \
+            coefs.sqrt_recipm1_alphas_cumprod
         )
 
-    def predict_v(self, x_start, t, noise):
+    def predict_v(self, x_start, t, noise, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_start.shape))
+
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * noise -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * x_start
+            coefs.sqrt_alphas_cumprod * noise -
+            coefs.sqrt_one_minus_alphas_cumprod * x_start
         )
 
-    def predict_start_from_v(self, x_t, t, v):
+    def predict_start_from_v(self, x_t, t, v, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_t.shape) * v
+            coefs.sqrt_alphas_cumprod * x_t -
+            coefs.sqrt_one_minus_alphas_cumprod * v
         )
 
-    def q_posterior(self, x_start, x_t, t):
+    def q_posterior(self, x_start, x_t, t, coefs = None):
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_t.shape))
+
         posterior_mean = (
-            extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-            extract(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            coefs.posterior_mean_coef1 * x_start +
+            coefs.posterior_mean_coef2 * x_t
         )
-        posterior_variance = extract(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = extract(self.posterior_log_variance_clipped, t, x_t.shape)
+        posterior_variance = coefs.posterior_variance
+        posterior_log_variance_clipped = coefs.posterior_log_variance_clipped
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
 
-    def model_predictions(self, x, t, x_self_cond = None, clip_x_start = False):
+    def model_predictions(self, x, t, x_self_cond = None, clip_x_start = False, coefs = None):
         model_output = self.model(x, t, x_self_cond)
         maybe_clip = partial(torch.clamp, min = -1., max = 1.) if clip_x_start else identity
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x.shape))
 
         if self.objective == 'pred_noise':
             pred_noise = model_output
-            x_start = self.predict_start_from_noise(x, t, pred_noise)
+            x_start = self.predict_start_from_noise(x, t, pred_noise, coefs)
             x_start = maybe_clip(x_start)
 
         elif self.objective == 'pred_x0':
             x_start = model_output
             x_start = maybe_clip(x_start)
-            pred_noise = self.predict_noise_from_start(x, t, x_start)
+            pred_noise = self.predict_noise_from_start(x, t, x_start, coefs)
 
         elif self.objective == 'pred_v':
             v = model_output
-            x_start = self.predict_start_from_v(x, t, v)
+            x_start = self.predict_start_from_v(x, t, v, coefs)
             x_start = maybe_clip(x_start)
-            pred_noise = self.predict_noise_from_start(x, t, x_start)
+            pred_noise = self.predict_noise_from_start(x, t, x_start, coefs)
 
         return ModelPrediction(pred_noise, x_start)
 
     def p_mean_variance(self, x, t, x_self_cond = None, clip_denoised = True):
-        preds = self.model_predictions(x, t, x_self_cond)
+        coefs = self.schedule_coefs(t, x.shape)
+        preds = self.model_predictions(x, t, x_self_cond, coefs = coefs)
         x_start = preds.pred_x_start
 
         if clip_denoised:
             x_start.clamp_(-1., 1.)
 
-        model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start = x_start, x_t = x, t = t)
+        model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start = x_start, x_t = x, t = t, coefs = coefs)
         return model_mean, posterior_variance, posterior_log_variance, x_start
 
     @torch.no_grad()
-    def p_sample(self, x, t: int, x_self_cond = None, clip_denoised = True):
+    def p_sample(self, x, t: int, x_self_cond = None, clip_denoised = True, rng = None):
         b, *_, device = *x.shape, x.device
+        rng = default(rng, lambda: SampleRNG(device = device))
         batched_times = torch.full((x.shape[0],), t, device = x.device, dtype = torch.long)
         model_mean, _, model_log_variance, x_start = self.p_mean_variance(x = x, t = batched_times, x_self_cond = x_self_cond, clip_denoised = clip_denoised)
-        noise = torch.randn_like(x) if t > 0 else 0. # no noise if t == 0
+        noise = rng.randn_like(x) if t > 0 else 0. # no noise if t == 0
         pred_img = model_mean + (0.5 * model_log_variance).exp() * noise
         return pred_img, x_start
 
     @torch.no_grad()
-    def p_sample_loop(self, shape):
+    def p_sample_loop(self, shape, rng = None):
         batch, device = shape[0], self.betas.device
+        rng = default(rng, lambda: SampleRNG(device = device))
 
-        img = torch.randn(shape, device=device)
+        img = rng.randn(shape)
 
         x_start = None
 
         for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps):
             self_cond = x_start if self.self_condition else None
-            img, x_start = self.p_sample(img, t, self_cond)
+            img, x_start = self.p_sample(img, t, self_cond, rng = rng)
 
         img = unnormalize_to_zero_to_one(img)
         return img
 
+    def set_ddim_timesteps(self, times):
+        # use a custom (for example searched, see timestep_search.py) set of timesteps for ddim sampling instead of the uniform one
+        # the search tunes the timesteps for the deterministic (eta = 0) sampler, so ddim sampling must not add noise
+
+        assert self.sampler != 'ddim' or self.ddim_sampling_eta == 0, 'searched ddim timesteps are tuned for deterministic sampling, set ddim_sampling_eta = 0.'
+
+        times = sorted(set(int(time) for time in times), reverse = True)
+        assert len(times) > 0 and times[0] < self.num_timesteps and times[-1] >= 0, f'ddim timesteps must be between 0 and {self.num_timesteps - 1}'
+
+        self.ddim_timesteps = torch.tensor(times, dtype = torch.long, device = self.betas.device)
+        self.sampling_timesteps = len(times)
+        self.is_ddim_sampling = True
+
+    def clear_ddim_timesteps(self):
+        # back to the uniform ddim timesteps (or ancestral sampling) given at init
+
+        self.ddim_timesteps = None
+        self.sampling_timesteps = self.uniform_sampling_timesteps
+        self.is_ddim_sampling = self.sampling_timesteps < self.num_timesteps
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the ddim timesteps buffer only exists once set, so it is set from the checkpoint before loading,
+        # or cleared if the checkpoint has none, so that checkpoints without searched timesteps still load strictly
+
+        key = f'{prefix}ddim_timesteps'
+
+        if key in state_dict:
+            self.set_ddim_timesteps(state_dict[key].tolist())
+        elif exists(self.ddim_timesteps):
+            self.clear_ddim_timesteps()
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def sampling_times(self):
+        if exists(self.ddim_timesteps):
+            return [*self.ddim_timesteps.tolist(), -1]
+
+        times = torch.linspace(-1, self.num_timesteps - 1, steps=self.sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
+        return list(reversed(times.int().tolist()))
+
     @torch.no_grad()
-    def ddim_sample(self, shape, clip_denoised = True):
-        batch, device, total_timesteps, sampling_timesteps, eta, objective = shape[0], self.betas.device, self.num_timesteps, self.sampling_timesteps, self.ddim_sampling_eta, self.objective
+    def ddim_sample(self, shape, clip_denoised = True, times = None, rng = None):
+        batch, device, eta, objective = shape[0], self.betas.device, self.ddim_sampling_eta, self.objective
+        rng = default(rng, lambda: SampleRNG(device = device))
 
-        times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
+        times = default(times, self.sampling_times)
         time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
 
-        img = torch.randn(shape, device = device)
+        img = rng.randn(shape)
 
         x_start = None
 
@@ -600,7 +811,7 @@ class GaussianDiffusion1D(nn.Module):
             sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
             c = (1 - alpha_next - sigma ** 2).sqrt()
 
-            noise = torch.randn_like(img)
+            noise = rng.randn_like(img)
 
             img = x_start * alpha_next.sqrt() + \
                   c * pred_noise + \
@@ -610,10 +821,60 @@ class GaussianDiffusion1D(nn.Module):
         return img
 
     @torch.no_grad()
-    def sample(self, batch_size = 16):
+    def multistep_solver_sample(self, shape, clip_denoised = True, rng = None):
+        batch, device = shape[0], self.betas.device
+        rng = default(rng, lambda: SampleRNG(device = device))
+
+        times = self.sampling_times()[:-1] # [T-1, ..., 0], the x0 prediction at time 0 is returned, as in ddim
+
+        img = rng.randn(shape)
+
+        x_start = None
+
+        def x_start_fn(img, time):
+            nonlocal x_start
+            time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
+            self_cond = x_start if self.self_condition else None
+            _, x_start, *_ = self.model_predictions(img, time_cond, self_cond, clip_x_start = clip_denoised)
+            return x_start
+
+        solver_fn = dpm_solver_pp_sample if self.sampler == 'dpm_solver++' else unipc_sample
+        img = solver_fn(x_start_fn, img, times, self.alphas_cumprod.tolist(), order = self.solver_order)
+
+        img = unnormalize_to_zero_to_one(img)
+        return img
+
+    @torch.no_grad()
+    def quantize_for_cpu(self, calibration_batch_size = 4, calibration_steps = 10, backend = 'fbgemm'):
+        # int8 quantizes the unet for sampling on cpu, calibrated on its own short ddim trajectories
+        # so that the observed activation ranges cover the timesteps visited while sampling
+
+        self.cpu()
+
+        def calibrate_fn(model):
+            sampling_timesteps = self.sampling_timesteps
+            self.sampling_timesteps = min(calibration_steps, self.num_timesteps)
+
+            try:
+                self.ddim_sample((calibration_batch_size, self.channels, self.seq_length))
+            finally:
+                self.sampling_timesteps = sampling_timesteps
+
+        self.model.quantize_for_cpu(calibrate_fn, backend = backend)
+        return self
+
+    @torch.no_grad()
+    def sample(self, batch_size = 16, seeds = None):
+        # with seeds, one per sample, every sample is drawn with its own generator and is the same regardless of the batch it is sampled in
         seq_length, channels = self.seq_length, self.channels
-        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
-        return sample_fn((batch_size, channels, seq_length))
+        fast_sample_fn = self.ddim_sample if self.sampler == 'ddim' else self.multistep_solver_sample
+        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else fast_sample_fn
+
+        if exists(seeds):
+            batch_size = len(seeds)
+
+        rng = SampleRNG(seeds, device = self.betas.device)
+        return sample_fn((batch_size, channels, seq_length), rng = rng)
 
     @torch.no_grad()
     def interpolate(self, x1, x2, t = None, lam = 0.5):
@@ -631,12 +892,13 @@ class GaussianDiffusion1D(nn.Module):
 
         return img
 
-    def q_sample(self, x_start, t, noise=None):
+    def q_sample(self, x_start, t, noise=None, coefs = None):
         noise = default(noise, lambda: torch.randn_like(x_start))
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x_start.shape))
 
         return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            coefs.sqrt_alphas_cumprod * x_start +
+            coefs.sqrt_one_minus_alphas_cumprod * noise
         )
 
     @property
@@ -651,10 +913,11 @@ class GaussianDiffusion1D(nn.Module):
     def p_losses(self, x_start, t, noise = None):
         b, c, n = x_start.shape
         noise = default(noise, lambda: torch.randn_like(x_start))
+        coefs = self.schedule_coefs(t, x_start.shape)
 
         # noise sample
 
-        x = self.q_sample(x_start = x_start, t = t, noise = noise)
+        x = self.q_sample(x_start = x_start, t = t, noise = noise, coefs = coefs)
 
         # if doing self-conditioning, 50% of the time, predict x_start from current set of times
         # and condition with unet with that
@@ -663,7 +926,7 @@ class GaussianDiffusion1D(nn.Module):
         x_self_cond = None
         if self.self_condition and random() < 0.5:
             with torch.no_grad():
-                x_self_cond = self.model_predictions(x, t).pred_x_start
+                x_self_cond = self.model_predictions(x, t, coefs = coefs).pred_x_start
                 x_self_cond.detach_()
 
         # predict and take gradient step
@@ -675,7 +938,7 @@ class GaussianDiffusion1D(nn.Module):
         elif self.objective == 'pred_x0':
             target = x_start
         elif self.objective == 'pred_v':
-            v = self.predict_v(x_start, t, noise)
+            v = self.predict_v(x_start, t, noise, coefs)
             target = v
         else:
             raise ValueError(f'unknown objective {self.objective}')
@@ -683,7 +946,7 @@ class GaussianDiffusion1D(nn.Module):
         loss = self.loss_fn(model_out, target, reduction = 'none')
         loss = reduce(loss, 'b ... -> b (...)', 'mean')
 
-        loss = loss * extract(self.p2_loss_weight, t, loss.shape)
+        loss = loss * coefs.p2_loss_weight.reshape(b, 1)
         return loss.mean()
 
     def forward(self, img, *args, **kwargs):
@@ -7,6 +7,8 @@ import torch.nn.functional as F
 from tqdm import tqdm
 from einops import rearrange, repeat, reduce
 
+from denoising_diffusion_pytorch.sample_rng import SampleRNG
+
 # helpers
 
 def exists(val):
@@ -122,6 +124,35 @@ class ElucidatedDiffusion(nn.Module):
 
         return out
 
+    # consistency model parameterization - https://arxiv.org/abs/2303.01469
+    # the same preconditioning, with c_skip and c_out shifted so that the output is exactly the input at sigma_min
+
+    def consistency_c_skip(self, sigma):
+        return (self.sigma_data ** 2) / ((sigma - self.sigma_min) ** 2 + self.sigma_data ** 2)
+
+    def consistency_c_out(self, sigma):
+        return (sigma - self.sigma_min) * self.sigma_data * (self.sigma_data ** 2 + sigma ** 2) ** -0.5
+
+    def consistency_network_forward(self, noised_images, sigma, clamp = False):
+        batch, device = noised_images.shape[0], noised_images.device
+
+        if isinstance(sigma, float):
+            sigma = torch.full((batch,), sigma, device = device)
+
+        padded_sigma = rearrange(sigma, 'b -> b 1 1 1')
+
+        net_out = self.net(
+            self.c_in(padded_sigma) * noised_images,
+            self.c_noise(sigma)
+        )
+
+        out = self.consistency_c_skip(padded_sigma) * noised_images + self.consistency_c_out(padded_sigma) * net_out
+
+        if clamp:
+            out = out.clamp(-1., 1.)
+
+        return out
+
     # sampling
 
     # sample schedule
@@ -140,9 +171,16 @@ class ElucidatedDiffusion(nn.Module):
         return sigmas
 
     @torch.no_grad()
-    def sample(self, batch_size = 16, num_sample_steps = None, clamp = True):
+    def sample(self, batch_size = 16, num_sample_steps = None, clamp = True, seeds = None):
+        # with seeds, one per sample, every sample is drawn with its own generator and is the same regardless of the batch it is sampled in
+
         num_sample_steps = default(num_sample_steps, self.num_sample_steps)
 
+        if exists(seeds):
+            batch_size = len(seeds)
+
+        rng = SampleRNG(seeds, device = self.device)
+
         shape = (batch_size, self.channels, self.image_size, self.image_size)
 
         # get the schedule, which is returned as (sigma, gamma) tuple, and pair up with the next sigma and gamma
@@ -161,7 +199,7 @@ class ElucidatedDiffusion(nn.Module):
 
         init_sigma = sigmas[0]
 
-        images = init_sigma * torch.randn(shape, device = self.device)
+        images = init_sigma * rng.randn(shape)
 
         # for self conditioning
 
@@ -172,7 +210,7 @@ class ElucidatedDiffusion(nn.Module):
         for sigma, sigma_next, gamma in tqdm(sigmas_and_gammas, desc = 'sampling time step'):
             sigma, sigma_next, gamma = map(lambda t: t.item(), (sigma, sigma_next, gamma))
 
-            eps = self.S_noise * torch.randn(shape, device = self.device) # stochastic sampling
+            eps = self.S_noise * rng.randn(shape) # stochastic sampling
 
             sigma_hat = sigma + gamma * sigma
             images_hat = images + sqrt(sigma_hat ** 2 - sigma ** 2) * eps
@@ -199,6 +237,34 @@ class ElucidatedDiffusion(nn.Module):
         images = images.clamp(-1., 1.)
         return unnormalize_to_zero_to_one(images)
 
+    # multistep consistency sampling, algorithm 1 in the consistency models paper
+    # only valid for a net trained as a consistency model, for example with ConsistencyDistiller
+
+    @torch.no_grad()
+    def sample_consistency(self, batch_size = 16, steps = 1, clamp = True, seeds = None):
+        assert steps >= 1
+
+        if exists(seeds):
+            batch_size = len(seeds)
+
+        rng = SampleRNG(seeds, device = self.device)
+
+        shape = (batch_size, self.channels, self.image_size, self.image_size)
+
+        # the noise levels are taken from the karras schedule, leaving out sigma_min
+
+        sigmas = self.sample_schedule(steps + 1)[:steps].tolist()
+
+        images = sigmas[0] * rng.randn(shape)
+        x_start = self.consistency_network_forward(images, sigmas[0], clamp = clamp)
+
+        for sigma in sigmas[1:]:
+            images = x_start + sqrt(sigma ** 2 - self.sigma_min ** 2) * rng.randn(shape)
+            x_start = self.consistency_network_forward(images, sigma, clamp = clamp)
+
+        x_start = x_start.clamp(-1., 1.)
+        return unnormalize_to_zero_to_one(x_start)
+
     # training
 
     def loss_weight(self, sigma):
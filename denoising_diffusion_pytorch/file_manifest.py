@@ -0,0 +1,107 @@
+import os
+import gzip
+import json
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+# file manifests, so the image folder is only walked when it changed
+# the folder is walked once, one directory level at a time with the directories of a level listed in parallel,
+# and the image paths are saved with the modification time of every directory. a file added, removed or renamed anywhere in the tree
+# changes the modification time of its directory, so the manifest is reused as long as all the directories still have their recorded times
+
+MANIFEST_VERSION = 1
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    if exists(val):
+        return val
+    return d() if callable(d) else d
+
+def scan_dir(path, exts):
+    files, subdirs = [], []
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks = False):
+                subdirs.append(entry.path)
+            elif entry.name.rsplit('.', 1)[-1] in exts and entry.is_file():
+                files.append(entry.path)
+
+    return files, subdirs, os.stat(path).st_mtime_ns
+
+def walk_folder(folder, exts, executor):
+    folder = str(folder)
+    scan_fn = partial(scan_dir, exts = set(exts))
+
+    files, dir_mtimes = [], dict()
+    level = [folder]
+
+    while len(level) > 0:
+        next_level = []
+
+        for path, (dir_files, subdirs, mtime) in zip(level, executor.map(scan_fn, level)):
+            files.extend(dir_files)
+            next_level.extend(subdirs)
+            dir_mtimes[os.path.relpath(path, folder)] = mtime
+
+        level = next_level
+
+    files = sorted(os.path.relpath(path, folder) for path in files)
+    return files, dir_mtimes
+
+def dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def is_manifest_stale(manifest, folder, exts, executor):
+    if manifest.get('version') != MANIFEST_VERSION or manifest['exts'] != sorted(exts):
+        return True
+
+    dirs = list(manifest['dirs'].keys())
+    mtimes = executor.map(dir_mtime, [os.path.join(str(folder), path) for path in dirs])
+    return any(mtime != manifest['dirs'][path] for path, mtime in zip(dirs, mtimes))
+
+def read_manifest(manifest_path):
+    with gzip.open(str(manifest_path), 'rt') as f:
+        return json.load(f)
+
+def write_manifest(manifest, manifest_path):
+    manifest_path = Path(manifest_path)
+    tmp_path = manifest_path.with_name(f'{manifest_path.name}.tmp')
+
+    with gzip.open(str(tmp_path), 'wt') as f:
+        json.dump(manifest, f, separators = (',', ':'))
+
+    tmp_path.replace(manifest_path)
+
+def list_image_paths(
+    folder,
+    exts = ['jpg', 'jpeg', 'png', 'tiff'],
+    manifest_path = None,
+    check_manifest = True,
+    num_workers = None
+):
+    # the paths of all images under folder, sorted. with a manifest_path, they are read from the manifest there,
+    # which is (re)built if missing, or if check_manifest is set and any directory changed since it was written
+
+    with ThreadPoolExecutor(max_workers = default(num_workers, min(32, cpu_count() * 4))) as executor:
+        if exists(manifest_path) and Path(manifest_path).exists():
+            manifest = read_manifest(manifest_path)
+
+            if not check_manifest or not is_manifest_stale(manifest, folder, exts, executor):
+                return [Path(folder) / path for path in manifest['files']]
+
+        files, dir_mtimes = walk_folder(folder, exts, executor)
+
+    if exists(manifest_path):
+        write_manifest(dict(version = MANIFEST_VERSION, exts = sorted(exts), dirs = dir_mtimes, files = files), manifest_path)
+
+    return [Path(folder) / path for path in files]
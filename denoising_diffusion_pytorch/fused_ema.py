@@ -0,0 +1,196 @@
+import copy
+
+import torch
+from torch import nn
+
+# keys of the state dict of ema-pytorch's EMA that have no counterpart here
+
+LEGACY_KEY_PREFIXES = ('online_model.',)
+
+# helpers functions
+
+def exists(x):
+    return x is not None
+
+def default(val, d):
+    if exists(val):
+        return val
+    return d() if callable(d) else d
+
+def module_device(module):
+    return next(module.parameters()).device
+
+# exponential moving average, updated for all parameters in one multi-tensor pass
+# the shadow weights can be kept in a lower precision, or on cpu in which case the copy from the device is asynchronous
+# the registered buffers (noise schedule etc) are shared with the online model instead of duplicated
+
+class FusedEMA(nn.Module):
+    def __init__(
+        self,
+        model,
+        beta = 0.9999,
+        update_after_step = 100,
+        update_every = 10,
+        inv_gamma = 1.0,
+        power = 2 / 3,
+        min_value = 0.0,
+        ema_device = None,
+        ema_dtype = None
+    ):
+        super().__init__()
+        self.beta = beta
+        self.update_after_step = update_after_step
+        self.update_every = update_every
+
+        self.inv_gamma = inv_gamma
+        self.power = power
+        self.min_value = min_value
+
+        self.online_model = [model] # hidden in a list, so it is not registered as a submodule
+
+        online_device = module_device(model)
+        self.ema_device = torch.device(default(ema_device, online_device))
+        self.ema_dtype = ema_dtype
+
+        ema_model = copy.deepcopy(model)
+        ema_model.requires_grad_(False)
+
+        for param in ema_model.parameters():
+            param.data = param.data.to(self.ema_device, dtype = default(ema_dtype, param.dtype))
+
+        # share the buffers with the online model when on the same device
+
+        for ema_module, online_module in zip(ema_model.modules(), model.modules()):
+            for name, buffer in online_module._buffers.items():
+                if not exists(buffer):
+                    continue
+
+                ema_module._buffers[name] = buffer if buffer.device == self.ema_device else buffer.to(self.ema_device)
+
+        self.ema_model = ema_model
+
+        self.ema_params = list(ema_model.parameters())
+        self.online_params = list(model.parameters())
+
+        # the online parameters are staged into pinned cpu memory, and only folded into the ema at the next update or flush
+
+        self.offloaded = self.ema_device != online_device
+        self.pinned = self.offloaded and self.ema_device.type == 'cpu' and online_device.type == 'cuda'
+
+        self.staged_params = None
+        self.staged_event = None
+        self.staged_weight = None
+
+        if self.offloaded:
+            self.staged_params = [torch.empty(p.shape, dtype = ema_p.dtype, device = self.ema_device, pin_memory = self.pinned) for p, ema_p in zip(self.online_params, self.ema_params)]
+
+        self.register_buffer('initted', torch.tensor(False))
+        self.register_buffer('step', torch.tensor(0))
+
+    def get_current_decay(self):
+        epoch = max(self.step.item() - self.update_after_step - 1, 0)
+
+        if epoch <= 0:
+            return 0.
+
+        value = 1 - (1 + epoch / self.inv_gamma) ** -self.power
+        return min(max(value, self.min_value), self.beta)
+
+    @torch.no_grad()
+    def online_params_in_ema_precision(self):
+        if not self.offloaded:
+            if not exists(self.ema_dtype):
+                return self.online_params
+
+            return [p.to(self.ema_dtype) for p in self.online_params]
+
+        for staged, p in zip(self.staged_params, self.online_params):
+            staged.copy_(p.detach(), non_blocking = self.pinned)
+
+        return self.staged_params
+
+    @torch.no_grad()
+    def flush(self):
+        if not exists(self.staged_weight):
+            return
+
+        if exists(self.staged_event):
+            self.staged_event.synchronize()
+
+        torch._foreach_lerp_(self.ema_params, self.staged_params, self.staged_weight)
+
+        self.staged_event = None
+        self.staged_weight = None
+
+    @torch.no_grad()
+    def update(self):
+        # the step is checked before it is incremented, and the decay computed after, as in ema-pytorch, so checkpoints of either update on the same steps
+
+        step = self.step.item()
+        self.step += 1
+
+        initted = self.initted.item()
+
+        if initted and (step % self.update_every) != 0:
+            return
+
+        self.flush()
+
+        # on the first update, and before update_after_step, the ema is a copy of the online model
+
+        if not initted or step <= self.update_after_step:
+            weight = 1.
+            self.initted.data.copy_(torch.tensor(True))
+        else:
+            weight = 1. - self.get_current_decay()
+
+        online_params = self.online_params_in_ema_precision()
+
+        if not self.offloaded:
+            torch._foreach_lerp_(self.ema_params, online_params, weight)
+            return
+
+        if self.pinned:
+            self.staged_event = torch.cuda.Event()
+            self.staged_event.record()
+
+        self.staged_weight = weight
+
+    def state_dict(self, *args, **kwargs):
+        self.flush()
+        return super().state_dict(*args, **kwargs)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        self.staged_event = None
+        self.staged_weight = None
+
+        # checkpoints saved with the EMA of ema-pytorch also hold a copy of the online model, which is left out here
+
+        state_dict = {key: value for key, value in state_dict.items() if not key.startswith(LEGACY_KEY_PREFIXES)}
+        return super().load_state_dict(state_dict, *args, **kwargs)
+
+    def inference_model(self, device = None, dtype = None):
+        # the shadow weights, on the given device and precision, copied only when they differ from the stored ones
+
+        self.flush()
+
+        device = torch.device(default(device, self.ema_device))
+        dtype = default(dtype, self.ema_params[0].dtype)
+
+        if device == self.ema_device and dtype == self.ema_params[0].dtype:
+            return self.ema_model
+
+        ema_model = copy.deepcopy(self.ema_model)
+
+        for param in ema_model.parameters():
+            param.data = param.data.to(device, dtype = dtype)
+
+        for module in ema_model.modules():
+            for name, buffer in module._buffers.items():
+                if exists(buffer):
+                    module._buffers[name] = buffer.to(device)
+
+        return ema_model
+
+    def __call__(self, *args, **kwargs):
+        return self.inference_model()(*args, **kwargs)
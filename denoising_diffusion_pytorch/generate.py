@@ -0,0 +1,176 @@
+import argparse
+import importlib
+import importlib.util
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+import torch
+from torchvision import utils
+
+from tqdm.auto import tqdm
+from accelerate import Accelerator
+
+# bulk sampling, sharded across the processes of accelerate (or torchrun), on gpus or with gloo on cpu
+#
+#   accelerate launch -m denoising_diffusion_pytorch.generate \
+#       --model my_project.config:build_diffusion \
+#       --checkpoint ./results/model-100.pt \
+#       --num-samples 50000 \
+#       --output ./samples
+#
+# the samples are split into shards of consecutive indices, which are dealt out round robin to the processes
+# sample i is drawn with seed (seed + i), so the output does not depend on the number of processes or the batch size
+# every shard is written to a temporary path and renamed once complete, and complete shards are skipped on restart
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def num_to_groups(num, divisor):
+    groups = num // divisor
+    remainder = num % divisor
+    arr = [divisor] * groups
+    if remainder > 0:
+        arr.append(remainder)
+    return arr
+
+def load_object(path):
+    # path/to/file.py:name or package.module:name
+
+    module_path, name = path.rsplit(':', 1)
+
+    if module_path.endswith('.py'):
+        spec = importlib.util.spec_from_file_location(Path(module_path).stem, module_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(module_path)
+
+    return getattr(module, name)
+
+def load_trainer_checkpoint(diffusion, checkpoint_path, use_ema = True):
+    # the ema weights of a Trainer checkpoint are stored under ema_model. in the state dict of the ema
+
+    data = torch.load(str(checkpoint_path), map_location = 'cpu')
+
+    if not use_ema:
+        diffusion.load_state_dict(data['model'])
+        return diffusion
+
+    prefix = 'ema_model.'
+    state_dict = {key[len(prefix):]: value for key, value in data['ema'].items() if key.startswith(prefix)}
+    diffusion.load_state_dict(state_dict)
+    return diffusion
+
+# shards
+
+def shard_path(output, shard_index, image_format):
+    suffix = '.npy' if image_format == 'npy' else ''
+    return Path(output) / f'shard-{shard_index:05d}{suffix}'
+
+def to_uint8(images):
+    images = (images.clamp(0., 1.) * 255).round().to(torch.uint8)
+    return images.permute(0, 2, 3, 1).cpu().numpy()
+
+def write_shard(diffusion, output, shard_index, start, end, *, batch_size, seed, image_format):
+    path = shard_path(output, shard_index, image_format)
+    tmp_path = path.with_name(f'{path.name}.tmp')
+
+    if image_format == 'png':
+        shutil.rmtree(tmp_path, ignore_errors = True)
+        tmp_path.mkdir(parents = True)
+
+    arrays = []
+    index = start
+
+    for size in num_to_groups(end - start, batch_size):
+        seeds = [seed + i for i in range(index, index + size)]
+        images = diffusion.sample(seeds = seeds)
+
+        if image_format == 'png':
+            for offset, image in enumerate(images):
+                utils.save_image(image, str(tmp_path / f'{index + offset:08d}.png'))
+        else:
+            arrays.append(to_uint8(images))
+
+        index += size
+
+    if image_format == 'npy':
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.concatenate(arrays, axis = 0))
+
+    tmp_path.replace(path)
+
+@torch.no_grad()
+def generate(
+    diffusion,
+    num_samples,
+    output,
+    *,
+    batch_size = 64,
+    shard_size = 1000,
+    seed = 0,
+    image_format = 'png',
+    accelerator = None
+):
+    assert image_format in {'png', 'npy'}, 'image format must be either png or npy'
+
+    accelerator = accelerator if exists(accelerator) else Accelerator()
+
+    output = Path(output)
+
+    if accelerator.is_main_process:
+        output.mkdir(parents = True, exist_ok = True)
+
+    accelerator.wait_for_everyone()
+
+    diffusion = diffusion.to(accelerator.device)
+    diffusion.eval()
+
+    num_shards = (num_samples + shard_size - 1) // shard_size
+    shard_indices = range(accelerator.process_index, num_shards, accelerator.num_processes)
+    remaining = [shard_index for shard_index in shard_indices if not shard_path(output, shard_index, image_format).exists()]
+
+    for shard_index in tqdm(remaining, desc = 'generating shards', disable = not accelerator.is_main_process):
+        start = shard_index * shard_size
+        end = min(start + shard_size, num_samples)
+
+        write_shard(diffusion, output, shard_index, start, end, batch_size = batch_size, seed = seed, image_format = image_format)
+
+    accelerator.wait_for_everyone()
+
+def main():
+    parser = argparse.ArgumentParser(description = 'sample images in bulk from the ema of a Trainer checkpoint')
+    parser.add_argument('--model', required = True, help = 'function returning the diffusion model, as path/to/file.py:name or package.module:name')
+    parser.add_argument('--checkpoint', required = True, help = 'path to a model-{milestone}.pt saved by the Trainer')
+    parser.add_argument('--num-samples', type = int, required = True)
+    parser.add_argument('--output', required = True, help = 'folder the shards are written to')
+    parser.add_argument('--batch-size', type = int, default = 64)
+    parser.add_argument('--shard-size', type = int, default = 1000)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--format', choices = ('png', 'npy'), default = 'png', help = 'a folder of pngs, or a packed uint8 (n, h, w, c) array, per shard')
+    parser.add_argument('--no-ema', action = 'store_true', help = 'sample with the online weights instead of the ema')
+    parser.add_argument('--cpu', action = 'store_true', help = 'sample on cpu, with gloo across processes')
+    args = parser.parse_args()
+
+    accelerator = Accelerator(cpu = args.cpu)
+
+    diffusion = load_object(args.model)()
+    load_trainer_checkpoint(diffusion, args.checkpoint, use_ema = not args.no_ema)
+
+    generate(
+        diffusion,
+        args.num_samples,
+        args.output,
+        batch_size = args.batch_size,
+        shard_size = args.shard_size,
+        seed = args.seed,
+        image_format = args.format,
+        accelerator = accelerator
+    )
+
+if __name__ == '__main__':
+    main()
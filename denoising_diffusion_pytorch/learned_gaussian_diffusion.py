@@ -5,7 +5,7 @@ from inspect import isfunction
 from torch import nn, einsum
 from einops import rearrange
 
-from denoising_diffusion_pytorch.denoising_diffusion_pytorch import GaussianDiffusion, extract, unnormalize_to_zero_to_one
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import GaussianDiffusion, unnormalize_to_zero_to_one
 
 # constants
 
@@ -81,43 +81,46 @@ class LearnedGaussianDiffusion(GaussianDiffusion):
 
         self.vb_loss_weight = vb_loss_weight
 
-    def model_predictions(self, x, t):
+    def model_predictions(self, x, t, coefs = None):
         model_output = self.model(x, t)
         model_output, pred_variance = model_output.chunk(2, dim = 1)
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x.shape))
 
         if self.objective == 'pred_noise':
             pred_noise = model_output
-            x_start = self.predict_start_from_noise(x, t, model_output)
+            x_start = self.predict_start_from_noise(x, t, model_output, coefs)
 
         elif self.objective == 'pred_x0':
-            pred_noise = self.predict_noise_from_start(x, t, model_output)
+            pred_noise = self.predict_noise_from_start(x, t, model_output, coefs)
             x_start = model_output
 
         return ModelPrediction(pred_noise, x_start, pred_variance)
 
-    def p_mean_variance(self, *, x, t, clip_denoised, model_output = None):
+    def p_mean_variance(self, *, x, t, clip_denoised, model_output = None, coefs = None):
         model_output = default(model_output, lambda: self.model(x, t))
         pred_noise, var_interp_frac_unnormalized = model_output.chunk(2, dim = 1)
+        coefs = default(coefs, lambda: self.schedule_coefs(t, x.shape))
 
-        min_log = extract(self.posterior_log_variance_clipped, t, x.shape)
-        max_log = extract(torch.log(self.betas), t, x.shape)
+        min_log = coefs.posterior_log_variance_clipped
+        max_log = torch.log(coefs.betas)
         var_interp_frac = unnormalize_to_zero_to_one(var_interp_frac_unnormalized)
 
         model_log_variance = var_interp_frac * max_log + (1 - var_interp_frac) * min_log
         model_variance = model_log_variance.exp()
 
-        x_start = self.predict_start_from_noise(x, t, pred_noise)
+        x_start = self.predict_start_from_noise(x, t, pred_noise, coefs)
 
         if clip_denoised:
             x_start.clamp_(-1., 1.)
 
-        model_mean, _, _ = self.q_posterior(x_start, x, t)
+        model_mean, _, _ = self.q_posterior(x_start, x, t, coefs)
 
         return model_mean, model_variance, model_log_variance
 
     def p_losses(self, x_start, t, noise = None, clip_denoised = False):
         noise = default(noise, lambda: torch.randn_like(x_start))
-        x_t = self.q_sample(x_start = x_start, t = t, noise = noise)
+        coefs = self.schedule_coefs(t, x_start.shape)
+        x_t = self.q_sample(x_start = x_start, t = t, noise = noise, coefs = coefs)
 
         # model output
 
@@ -125,8 +128,8 @@ class LearnedGaussianDiffusion(GaussianDiffusion):
 
         # calculating kl loss for learned variance (interpolation)
 
-        true_mean, _, true_log_variance_clipped = self.q_posterior(x_start = x_start, x_t = x_t, t = t)
-        model_mean, _, model_log_variance = self.p_mean_variance(x = x_t, t = t, clip_denoised = clip_denoised, model_output = model_output)
+        true_mean, _, true_log_variance_clipped = self.q_posterior(x_start = x_start, x_t = x_t, t = t, coefs = coefs)
+        model_mean, _, model_log_variance = self.p_mean_variance(x = x_t, t = t, clip_denoised = clip_denoised, model_output = model_output, coefs = coefs)
 
         # kl loss with detached model predicted mean, for stability reasons as in paper
 
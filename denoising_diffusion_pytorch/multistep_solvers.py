@@ -0,0 +1,156 @@
+import math
+
+import torch
+from tqdm.auto import tqdm
+
+# high order multistep solvers for the probability flow ode of discrete time gaussian diffusion
+# both work in data (x0) prediction space, so they can be used with any of the objectives, and with clipping (thresholding) of x0
+
+# DPM-Solver++ - https://arxiv.org/abs/2211.01095
+# UniPC - https://arxiv.org/abs/2302.04867
+
+# helpers functions
+
+def log_snr_coefs(alphas_cumprod, time):
+    alpha_cumprod = alphas_cumprod[time]
+    alpha, sigma = math.sqrt(alpha_cumprod), math.sqrt(1. - alpha_cumprod)
+    return alpha, sigma, math.log(alpha) - math.log(sigma)
+
+def solver_order_at(order, step, num_transitions):
+    # lower order for the warmup steps, as there are no previous predictions yet
+    # and for the final steps, which stabilizes sampling with very few steps
+
+    return min(order, step + 1, num_transitions - step)
+
+# dpm-solver++ multistep update, up to third order
+
+def dpm_solver_pp_update(x, x_starts, lambdas, sigma_prev, alpha_next, sigma_next, lambda_next, order):
+    m0, lambda_prev = x_starts[-1], lambdas[-1]
+
+    h = lambda_next - lambda_prev
+    phi_1 = math.expm1(-h)
+
+    x_next = (sigma_next / sigma_prev) * x - (alpha_next * phi_1) * m0
+
+    if order == 1:
+        return x_next
+
+    m1 = x_starts[-2]
+    r0 = (lambda_prev - lambdas[-2]) / h
+    D1_0 = (m0 - m1) / r0
+
+    if order == 2:
+        return x_next - (0.5 * alpha_next * phi_1) * D1_0
+
+    m2 = x_starts[-3]
+    r1 = (lambdas[-2] - lambdas[-3]) / h
+    D1_1 = (m1 - m2) / r1
+
+    D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+    D2 = (D1_0 - D1_1) / (r0 + r1)
+
+    phi_2 = phi_1 / h + 1.
+    phi_3 = phi_2 / h - 0.5
+
+    return x_next + (alpha_next * phi_2) * D1 - (alpha_next * phi_3) * D2
+
+# unipc (bh2 variant) update
+# acts as the predictor when the x0 prediction at the next time is not given, and the corrector when it is
+
+def unipc_update(x, x_starts, lambdas, sigma_prev, alpha_next, sigma_next, lambda_next, order, x_start_next = None):
+    m0, lambda_prev = x_starts[-1], lambdas[-1]
+
+    h = lambda_next - lambda_prev
+    hh = -h
+
+    h_phi_1 = math.expm1(hh)
+    h_phi_k = h_phi_1 / hh - 1.
+    B_h = math.expm1(hh)
+
+    rks = [(lambdas[-(i + 1)] - lambda_prev) / h for i in range(1, order)] + [1.]
+    D1s = [(x_starts[-(i + 1)] - m0) / rk for i, rk in zip(range(1, order), rks)]
+
+    R, b = [], []
+    factorial_i = 1
+
+    for i in range(1, order + 1):
+        R.append([rk ** (i - 1) for rk in rks])
+        b.append(h_phi_k * factorial_i / B_h)
+        factorial_i *= (i + 1)
+        h_phi_k = h_phi_k / hh - 1. / factorial_i
+
+    R, b = torch.tensor(R, dtype = torch.float64), torch.tensor(b, dtype = torch.float64)
+
+    x_next = (sigma_next / sigma_prev) * x - (alpha_next * h_phi_1) * m0
+
+    if x_start_next is None:
+        if order == 1:
+            return x_next
+
+        rhos_p = [0.5] if order == 2 else torch.linalg.solve(R[:-1, :-1], b[:-1]).tolist()
+        pred_res = sum(rho * D1 for rho, D1 in zip(rhos_p, D1s))
+        return x_next - (alpha_next * B_h) * pred_res
+
+    rhos_c = [0.5] if order == 1 else torch.linalg.solve(R, b).tolist()
+    corr_res = sum(rho * D1 for rho, D1 in zip(rhos_c[:-1], D1s))
+    D1_t = x_start_next - m0
+
+    return x_next - (alpha_next * B_h) * (corr_res + rhos_c[-1] * D1_t)
+
+# samplers
+# x_start_fn takes the noised images and an integer time, and returns the predicted x0
+# times are descending, ending at 0, where the final x0 prediction is returned, as in ddim sampling
+
+def dpm_solver_pp_sample(x_start_fn, img, times, alphas_cumprod, order = 2):
+    assert 1 <= order <= 3, 'dpm-solver++ is only implemented up to third order'
+    num_transitions = len(times) - 1
+
+    x_starts, lambdas = [], []
+
+    for step, time in enumerate(tqdm(times, desc = 'sampling loop time step')):
+        x_start = x_start_fn(img, time)
+
+        if step == num_transitions:
+            return x_start
+
+        _, sigma, lambda_ = log_snr_coefs(alphas_cumprod, time)
+        alpha_next, sigma_next, lambda_next = log_snr_coefs(alphas_cumprod, times[step + 1])
+
+        x_starts = [*x_starts, x_start][-order:]
+        lambdas = [*lambdas, lambda_][-order:]
+
+        step_order = solver_order_at(order, step, num_transitions)
+        img = dpm_solver_pp_update(img, x_starts, lambdas, sigma, alpha_next, sigma_next, lambda_next, step_order)
+
+    return img
+
+def unipc_sample(x_start_fn, img, times, alphas_cumprod, order = 2, use_corrector = True):
+    assert order >= 1
+    num_transitions = len(times) - 1
+
+    x_starts, lambdas = [], []
+    prev_img = prev_order = None
+
+    for step, time in enumerate(tqdm(times, desc = 'sampling loop time step')):
+        x_start = x_start_fn(img, time)
+
+        alpha, sigma, lambda_ = log_snr_coefs(alphas_cumprod, time)
+
+        # correct the previous step with the x0 prediction at the current time, which costs no extra network evaluation
+
+        if use_corrector and step > 0:
+            _, prev_sigma, _ = log_snr_coefs(alphas_cumprod, times[step - 1])
+            img = unipc_update(prev_img, x_starts, lambdas, prev_sigma, alpha, sigma, lambda_, prev_order, x_start_next = x_start)
+
+        if step == num_transitions:
+            return x_start
+
+        alpha_next, sigma_next, lambda_next = log_snr_coefs(alphas_cumprod, times[step + 1])
+
+        x_starts = [*x_starts, x_start][-order:]
+        lambdas = [*lambdas, lambda_][-order:]
+
+        prev_img, prev_order = img, solver_order_at(order, step, num_transitions)
+        img = unipc_update(img, x_starts, lambdas, sigma, alpha_next, sigma_next, lambda_next, prev_order)
+
+    return img
@@ -0,0 +1,153 @@
+import copy
+from pathlib import Path
+
+import torch
+from torch import nn, sqrt
+import torch.nn.functional as F
+
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import Trainer
+from denoising_diffusion_pytorch.v_param_continuous_time_gaussian_diffusion import normalize_to_neg_one_to_one, right_pad_dims_to
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    if exists(val):
+        return val
+    return d() if callable(d) else d
+
+def module_device(module):
+    return next(module.parameters()).device
+
+class Frozen:
+    # holds a module without registering it as a submodule, so it is left out of the state dict and optimizer
+    # and is shared rather than copied when the holder is deep copied (as the trainer does for the ema)
+
+    def __init__(self, module):
+        self.module = module
+
+    def __deepcopy__(self, memo):
+        return self
+
+# progressive distillation - https://arxiv.org/abs/2202.00512
+# the student learns to match two deterministic ddim steps of the teacher in one step, halving the number of sampling steps per round
+
+class ProgressiveDistiller(nn.Module):
+    def __init__(
+        self,
+        teacher,
+        student = None,
+        *,
+        teacher_sample_steps = None
+    ):
+        super().__init__()
+        teacher_sample_steps = default(teacher_sample_steps, teacher.num_sample_steps)
+        assert (teacher_sample_steps % 2) == 0, 'number of sampling steps of the teacher must be even'
+
+        # the student is initialized from the teacher
+
+        student = default(student, lambda: copy.deepcopy(teacher))
+        student.num_sample_steps = teacher_sample_steps // 2
+        student.ddim_sampling = True
+
+        teacher.requires_grad_(False)
+        teacher.eval()
+
+        self.teacher = Frozen(teacher)
+        self.student = student
+
+        self.teacher_sample_steps = teacher_sample_steps
+        self.image_size = student.image_size
+
+    @property
+    def student_sample_steps(self):
+        return self.student.num_sample_steps
+
+    @torch.no_grad()
+    def sample(self, *args, **kwargs):
+        return self.student.sample(*args, **kwargs)
+
+    def forward(self, img):
+        teacher, student = self.teacher.module, self.student
+        batch, device, num_steps = img.shape[0], img.device, self.student_sample_steps
+
+        if module_device(teacher) != device:
+            teacher.to(device)
+
+        x_start = normalize_to_neg_one_to_one(img)
+
+        # times on the grid of the student, and the midpoint and end of its step
+
+        times = torch.randint(1, num_steps + 1, (batch,), device = device).float() / num_steps
+        times_mid = times - 0.5 / num_steps
+        times_next = times - 1. / num_steps
+
+        x, log_snr, alpha, sigma = student.q_sample(x_start = x_start, times = times)
+
+        # two deterministic ddim steps of the teacher, without clipping
+
+        with torch.no_grad():
+            x_mid = teacher.ddim_step(x, times, times_mid, clip_denoised = False)
+            x_next = teacher.ddim_step(x_mid, times_mid, times_next, clip_denoised = False)
+
+        # the x_start that takes x to x_next in a single ddim step, expressed as the v target of the student
+
+        log_snr_next = right_pad_dims_to(x, student.log_snr(times_next))
+        alpha_next, sigma_next = sqrt(log_snr_next.sigmoid()), sqrt((-log_snr_next).sigmoid())
+
+        sigma_ratio = sigma_next / sigma
+        x_start_target = (x_next - sigma_ratio * x) / (alpha_next - sigma_ratio * alpha)
+        v_target = (alpha * x - x_start_target) / sigma
+
+        pred_v = student.model(x, log_snr)
+        return F.mse_loss(pred_v, v_target)
+
+# runs the rounds of progressive distillation with the Trainer, each student becoming the teacher of the next round
+# the student of every round is saved as student-{num sample steps}.pt in the results folder
+
+def progressive_distillation(
+    teacher,
+    folder,
+    *,
+    final_sample_steps = 4,
+    train_num_steps_per_round = 10000,
+    results_folder = './results',
+    **trainer_kwargs
+):
+    results_folder = Path(results_folder)
+    results_folder.mkdir(parents = True, exist_ok = True)
+
+    num_sample_steps = teacher.num_sample_steps
+
+    # every round halves the number of steps, so check up front that the rounds end exactly on final_sample_steps
+
+    assert final_sample_steps >= 1, 'final_sample_steps must be at least 1'
+
+    ratio = num_sample_steps // final_sample_steps
+    is_power_of_two = ratio > 0 and (ratio & (ratio - 1)) == 0
+
+    assert (num_sample_steps % final_sample_steps) == 0 and is_power_of_two, \
+        f'the teacher samples with {num_sample_steps} steps, which can not be halved down to {final_sample_steps} steps - the number of sampling steps of the teacher must be final_sample_steps times a power of two, for example {final_sample_steps * 2 ** max(ratio.bit_length() - 1, 0)} or {final_sample_steps * 2 ** max(ratio.bit_length(), 1)}'
+
+    while num_sample_steps > final_sample_steps:
+        distiller = ProgressiveDistiller(teacher, teacher_sample_steps = num_sample_steps)
+        num_sample_steps = distiller.student_sample_steps
+
+        trainer = Trainer(
+            distiller,
+            folder,
+            train_num_steps = train_num_steps_per_round,
+            results_folder = str(results_folder / f'distill-{num_sample_steps}-steps'),
+            **trainer_kwargs
+        )
+
+        trainer.train()
+
+        teacher = trainer.accelerator.unwrap_model(trainer.model).student
+
+        if trainer.accelerator.is_main_process:
+            torch.save(teacher.state_dict(), str(results_folder / f'student-{num_sample_steps}.pt'))
+
+    return teacher
@@ -0,0 +1,47 @@
+import torch
+from torch import nn
+
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, quantize_dynamic
+
+# int8 quantized cpu inference
+# the convolutions are statically quantized, with activation ranges observed over a calibration pass
+# and the linears (time and class mlps) are dynamically quantized
+
+class QuantizedConv(nn.Module):
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+@torch.no_grad()
+def quantize_unet_for_cpu(model, calibrate_fn, backend = 'fbgemm'):
+    # quantizes the unet in place - this cannot be undone, so quantize a copy if the fp32 weights are still needed
+    # calibrate_fn receives the model with observers attached, and should run it over representative inputs
+
+    assert backend in torch.backends.quantized.supported_engines, f'quantized engine {backend} is not supported on this machine'
+    torch.backends.quantized.engine = backend
+
+    model.freeze_for_inference()
+    model.cpu().eval()
+
+    qconfig = get_default_qconfig(backend)
+
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if type(child) not in (nn.Conv1d, nn.Conv2d):
+                continue
+
+            quantized_conv = QuantizedConv(child)
+            quantized_conv.qconfig = qconfig
+            setattr(parent, name, quantized_conv)
+
+    prepare(model, inplace = True)
+    calibrate_fn(model)
+    convert(model, inplace = True)
+
+    quantize_dynamic(model, {nn.Linear}, dtype = torch.qint8, inplace = True)
+    return model
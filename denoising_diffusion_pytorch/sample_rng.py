@@ -0,0 +1,31 @@
+import torch
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+# the random number generation of the samplers
+# when seeds are given, the noise of every sample in the batch is drawn from its own generator, so that a sample only depends on its seed,
+# and not on the rest of its batch or the process it is sampled in. otherwise the noise is drawn from the global generator as usual
+# the generators live on the sampling device, so a seed gives the same sample across runs on the same type of device
+
+class SampleRNG:
+    def __init__(self, seeds = None, device = None):
+        self.device = torch.device(device if exists(device) else 'cpu')
+        self.generators = None
+
+        if exists(seeds):
+            self.generators = [torch.Generator(device = self.device).manual_seed(int(seed)) for seed in seeds]
+
+    def randn(self, shape):
+        if not exists(self.generators):
+            return torch.randn(shape, device = self.device)
+
+        batch, *sample_shape = shape
+        assert batch == len(self.generators), f'batch size {batch} does not match the number of seeds {len(self.generators)}'
+
+        return torch.stack([torch.randn(sample_shape, device = self.device, generator = generator) for generator in self.generators])
+
+    def randn_like(self, t):
+        return self.randn(t.shape).to(t.dtype)
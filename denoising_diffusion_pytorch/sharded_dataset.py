@@ -0,0 +1,226 @@
+import io
+import json
+import tarfile
+from pathlib import Path
+from random import Random
+from functools import partial
+
+from torch import nn
+from torch.utils.data import IterableDataset, get_worker_info
+from torchvision import transforms as T
+
+from PIL import Image
+from tqdm.auto import tqdm
+
+from denoising_diffusion_pytorch.file_manifest import list_image_paths
+
+# sharded image datasets, webdataset style
+# the images are packed into tar shards that are read sequentially, which avoids a directory walk at startup and
+# the per file random reads that are slow on network filesystems. an index.json next to the shards records the number of images in each
+
+INDEX_NAME = 'index.json'
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    if exists(val):
+        return val
+    return d() if callable(d) else d
+
+def convert_image_to_fn(img_type, image):
+    if image.mode != img_type:
+        return image.convert(img_type)
+    return image
+
+def is_image_name(name, exts):
+    return name.rsplit('.', 1)[-1].lower() in exts
+
+def tar_members(path, exts):
+    # the (name, bytes) of the images of a shard, in order, read as a stream
+
+    with tarfile.open(str(path), mode = 'r|') as tar:
+        for member in tar:
+            if not member.isfile() or not is_image_name(member.name, exts):
+                continue
+
+            yield member.name, tar.extractfile(member).read()
+
+def count_shard_images(path, exts):
+    with tarfile.open(str(path), mode = 'r|') as tar:
+        return sum(1 for member in tar if member.isfile() and is_image_name(member.name, exts))
+
+# converter from a folder of images
+
+def write_image_shards(
+    folder,
+    output,
+    *,
+    shard_size = 5000,
+    exts = ['jpg', 'jpeg', 'png', 'tiff'],
+    seed = 0
+):
+    # the image files are stored as is, in a random order, so that a shuffle buffer over consecutive shards mixes the whole dataset
+    # every shard is written to a temporary file and renamed, and the index is written last, once all shards are complete
+
+    paths = list_image_paths(folder, exts)
+    assert len(paths) > 0, f'no images found in {folder}'
+
+    Random(seed).shuffle(paths)
+
+    output = Path(output)
+    output.mkdir(parents = True, exist_ok = True)
+
+    shards = []
+
+    for shard_index, start in enumerate(tqdm(range(0, len(paths), shard_size), desc = 'writing shards')):
+        shard_paths = paths[start:(start + shard_size)]
+
+        name = f'shard-{shard_index:05d}.tar'
+        tmp_path = output / f'{name}.tmp'
+
+        with tarfile.open(str(tmp_path), mode = 'w') as tar:
+            for ind, path in enumerate(shard_paths):
+                tar.add(str(path), arcname = f'{(start + ind):09d}{path.suffix.lower()}')
+
+        tmp_path.replace(output / name)
+        shards.append(dict(name = name, count = len(shard_paths)))
+
+    with open(output / INDEX_NAME, 'w') as f:
+        json.dump(dict(shards = shards), f)
+
+    return output
+
+# iterable dataset over the shards
+
+class ShardedImageDataset(IterableDataset):
+    def __init__(
+        self,
+        folder,
+        image_size,
+        *,
+        exts = ['jpg', 'jpeg', 'png', 'tiff'],
+        augment_horizontal_flip = False,
+        convert_image_to = None,
+        shuffle_buffer_size = 1000,
+        seed = 0,
+        rank = 0,
+        world_size = 1,
+        uint8_output = False
+    ):
+        super().__init__()
+        self.folder = Path(folder)
+        self.image_size = image_size
+        self.exts = set(exts)
+        self.augment_horizontal_flip = augment_horizontal_flip
+
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+
+        # the shards are split across both the ranks and the dataloader workers of each rank
+
+        self.rank = rank
+        self.world_size = world_size
+
+        # the number of images in each shard, from the index if written by write_image_shards, otherwise counted once here
+
+        index_path = self.folder / INDEX_NAME
+
+        if index_path.exists():
+            with open(index_path) as f:
+                shards = json.load(f)['shards']
+
+            self.shard_paths = [self.folder / shard['name'] for shard in shards]
+            self.shard_counts = [shard['count'] for shard in shards]
+        else:
+            self.shard_paths = sorted(self.folder.glob('*.tar'))
+            self.shard_counts = [count_shard_images(path, self.exts) for path in self.shard_paths]
+
+        assert len(self.shard_paths) > 0, f'no shards found in {folder}'
+
+        # the number of batches each rank has already consumed, see set_position
+
+        self.consumed_batches = 0
+        self.batch_size = 1
+
+        maybe_convert_fn = partial(convert_image_to_fn, convert_image_to) if exists(convert_image_to) else nn.Identity()
+
+        self.transform = T.Compose([
+            T.Lambda(maybe_convert_fn),
+            T.Resize(image_size),
+            T.RandomHorizontalFlip() if augment_horizontal_flip else nn.Identity(),
+            T.CenterCrop(image_size),
+            T.PILToTensor() if uint8_output else T.ToTensor()
+        ])
+
+    def __len__(self):
+        return sum(self.shard_counts)
+
+    def set_position(self, consumed_batches, batch_size):
+        # resume after consumed_batches batches of batch_size on every rank. must be called before iteration starts
+        # dataloader workers hand out their batches round robin, so the number of images each worker has read follows from this
+        # the stream resumes at that point, with a freshly filled shuffle buffer. resuming is therefore approximate -
+        # the images that were in the buffer at the checkpoint are skipped for the rest of the epoch, and the order differs from an uninterrupted run
+
+        self.consumed_batches = consumed_batches
+        self.batch_size = batch_size
+
+    def slot_shards(self, epoch, slot, num_slots):
+        order = list(range(len(self.shard_paths)))
+        Random(self.seed + epoch).shuffle(order)
+        return order[slot::num_slots]
+
+    def skipped_stream(self, slot, num_slots, num_workers, worker_id):
+        # the shards of every epoch dealt to this slot, starting from the position set with set_position
+
+        consumed_batches = len(range(worker_id, self.consumed_batches, num_workers))
+        skip = consumed_batches * self.batch_size
+
+        epoch = 0
+
+        while True:
+            for shard_index in self.slot_shards(epoch, slot, num_slots):
+                count = self.shard_counts[shard_index]
+
+                if skip >= count:
+                    skip -= count
+                    continue
+
+                for ind, (_, data) in enumerate(tar_members(self.shard_paths[shard_index], self.exts)):
+                    if ind < skip:
+                        continue
+
+                    yield data
+
+                skip = 0
+
+            epoch += 1
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if exists(worker_info) else (1, 0)
+
+        num_slots = self.world_size * num_workers
+        slot = self.rank * num_workers + worker_id
+
+        assert len(self.shard_paths) >= num_slots, f'there are {len(self.shard_paths)} shards for {num_slots} ranks and dataloader workers in total - write smaller shards or use fewer workers'
+
+        rng = Random(self.seed * 100003 + slot)
+        buffer = []
+
+        for data in self.skipped_stream(slot, num_slots, num_workers, worker_id):
+            img = self.transform(Image.open(io.BytesIO(data)))
+
+            if self.shuffle_buffer_size <= 1:
+                yield img
+                continue
+
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(img)
+                continue
+
+            ind = rng.randrange(len(buffer))
+            yield buffer[ind]
+            buffer[ind] = img
@@ -0,0 +1,91 @@
+import torch
+
+from tqdm.auto import tqdm
+
+# helpers functions
+
+def exists(x):
+    return x is not None
+
+def uniform_times(num_timesteps, num_steps):
+    times = torch.linspace(-1, num_timesteps - 1, steps = num_steps + 1)
+    return list(reversed(times.int().tolist()))
+
+# deterministic (eta = 0) ddim, from a given starting noise
+
+@torch.no_grad()
+def ddim_trajectory(diffusion, noise, times, clip_denoised = True):
+    batch, device = noise.shape[0], noise.device
+
+    img = noise
+    x_start = None
+
+    for time, time_next in zip(times[:-1], times[1:]):
+        time_cond = torch.full((batch,), time, device = device, dtype = torch.long)
+        self_cond = x_start if diffusion.self_condition else None
+        pred_noise, x_start, *_ = diffusion.model_predictions(img, time_cond, self_cond, clip_x_start = clip_denoised)
+
+        if time_next < 0:
+            img = x_start
+            continue
+
+        alpha_next = diffusion.alphas_cumprod[time_next]
+        img = x_start * alpha_next.sqrt() + (1 - alpha_next).sqrt() * pred_noise
+
+    return img
+
+# searches for the ddim timesteps that, for a fixed number of steps, best match a many step reference
+# by coordinate descent over the timesteps, with a step size that is halved every round
+# the result can be set with diffusion.set_ddim_timesteps(times), and is then saved with the state dict
+# both trajectories are deterministic (eta = 0), so the timesteps are only meant for a diffusion with ddim_sampling_eta = 0, or a multistep solver
+
+@torch.no_grad()
+def search_ddim_timesteps(
+    diffusion,
+    num_steps,
+    batch_size = 16,
+    reference_steps = 250,
+    num_rounds = 4,
+    clip_denoised = True,
+    seed = 0
+):
+    num_timesteps, device = diffusion.num_timesteps, diffusion.betas.device
+    assert 1 < num_steps < reference_steps <= num_timesteps
+
+    if hasattr(diffusion, 'image_size'):
+        shape = (batch_size, diffusion.channels, diffusion.image_size, diffusion.image_size)
+    else:
+        shape = (batch_size, diffusion.channels, diffusion.seq_length)
+
+    generator = torch.Generator(device = device).manual_seed(seed)
+    noise = torch.randn(shape, device = device, generator = generator)
+
+    reference = ddim_trajectory(diffusion, noise, uniform_times(num_timesteps, reference_steps), clip_denoised = clip_denoised)
+
+    def loss_fn(times):
+        out = ddim_trajectory(diffusion, noise, [*times, -1], clip_denoised = clip_denoised)
+        return (out - reference).pow(2).mean().item()
+
+    times = uniform_times(num_timesteps, num_steps)[:-1] # descending, [T - 1, ..., 0]
+    best_loss = loss_fn(times)
+
+    delta = max(num_timesteps // (num_steps * 2), 1)
+
+    for _ in tqdm(range(num_rounds), desc = 'timestep search round'):
+        for ind in range(num_steps):
+            upper = times[ind - 1] if ind > 0 else num_timesteps
+            lower = times[ind + 1] if ind < (num_steps - 1) else -1
+
+            for candidate in (times[ind] + delta, times[ind] - delta):
+                if not (lower < candidate < upper):
+                    continue
+
+                candidate_times = [*times[:ind], candidate, *times[ind + 1:]]
+                candidate_loss = loss_fn(candidate_times)
+
+                if candidate_loss < best_loss:
+                    times, best_loss = candidate_times, candidate_loss
+
+        delta = max(delta // 2, 1)
+
+    return times, best_loss
@@ -9,6 +9,8 @@ from tqdm import tqdm
 from einops import rearrange, repeat, reduce
 from einops.layers.torch import Rearrange
 
+from denoising_diffusion_pytorch.sample_rng import SampleRNG
+
 # helpers
 
 def exists(val):
@@ -59,6 +61,7 @@ class VParamContinuousTimeGaussianDiffusion(nn.Module):
         channels = 3,
         num_sample_steps = 500,
         clip_sample_denoised = True,
+        ddim_sampling = False
     ):
         super().__init__()
         assert model.random_or_learned_sinusoidal_cond
@@ -78,7 +81,11 @@ class VParamContinuousTimeGaussianDiffusion(nn.Module):
         # sampling
 
         self.num_sample_steps = num_sample_steps
-        self.clip_sample_denoised = clip_sample_denoised        
+        self.clip_sample_denoised = clip_sample_denoised
+
+        # deterministic ddim steps instead of ancestral sampling, which is what progressively distilled students are trained for
+
+        self.ddim_sampling = ddim_sampling
 
     @property
     def device(self):
@@ -113,39 +120,75 @@ class VParamContinuousTimeGaussianDiffusion(nn.Module):
 
         return model_mean, posterior_variance
 
+    def ddim_step(self, x, time, time_next, clip_denoised = None):
+        # time can either be a scalar, or one time per batch element
+
+        clip_denoised = default(clip_denoised, self.clip_sample_denoised)
+
+        log_snr = self.log_snr(time)
+        log_snr_next = self.log_snr(time_next)
+
+        batch_log_snr = repeat(log_snr, ' -> b', b = x.shape[0]) if log_snr.ndim == 0 else log_snr
+
+        log_snr, log_snr_next = map(lambda t: right_pad_dims_to(x, t), (log_snr, log_snr_next))
+        alpha, sigma = sqrt(log_snr.sigmoid()), sqrt((-log_snr).sigmoid())
+        alpha_next, sigma_next = sqrt(log_snr_next.sigmoid()), sqrt((-log_snr_next).sigmoid())
+
+        pred_v = self.model(x, batch_log_snr)
+        x_start = alpha * x - sigma * pred_v
+
+        if clip_denoised:
+            x_start.clamp_(-1., 1.)
+
+        pred_noise = (x - alpha * x_start) / sigma
+
+        return alpha_next * x_start + sigma_next * pred_noise
+
     # sampling related functions
 
     @torch.no_grad()
-    def p_sample(self, x, time, time_next):
+    def p_sample(self, x, time, time_next, rng = None):
         batch, *_, device = *x.shape, x.device
+        rng = default(rng, lambda: SampleRNG(device = device))
 
         model_mean, model_variance = self.p_mean_variance(x = x, time = time, time_next = time_next)
 
         if time_next == 0:
             return model_mean
 
-        noise = torch.randn_like(x)
+        noise = rng.randn_like(x)
         return model_mean + sqrt(model_variance) * noise
 
     @torch.no_grad()
-    def p_sample_loop(self, shape):
+    def p_sample_loop(self, shape, rng = None):
         batch = shape[0]
+        rng = default(rng, lambda: SampleRNG(device = self.device))
 
-        img = torch.randn(shape, device = self.device)
+        img = rng.randn(shape)
         steps = torch.linspace(1., 0., self.num_sample_steps + 1, device = self.device)
 
         for i in tqdm(range(self.num_sample_steps), desc = 'sampling loop time step', total = self.num_sample_steps):
             times = steps[i]
             times_next = steps[i + 1]
-            img = self.p_sample(img, times, times_next)
+
+            if self.ddim_sampling:
+                img = self.ddim_step(img, times, times_next)
+            else:
+                img = self.p_sample(img, times, times_next, rng = rng)
 
         img.clamp_(-1., 1.)
         img = unnormalize_to_zero_to_one(img)
         return img
 
     @torch.no_grad()
-    def sample(self, batch_size = 16):
-        return self.p_sample_loop((batch_size, self.channels, self.image_size, self.image_size))
+    def sample(self, batch_size = 16, seeds = None):
+        # with seeds, one per sample, every sample is drawn with its own generator and is the same regardless of the batch it is sampled in
+
+        if exists(seeds):
+            batch_size = len(seeds)
+
+        rng = SampleRNG(seeds, device = self.device)
+        return self.p_sample_loop((batch_size, self.channels, self.image_size, self.image_size), rng = rng)
 
     # training related functions - noise prediction
 
@@ -43,8 +43,9 @@ class WeightedObjectiveGaussianDiffusion(GaussianDiffusion):
 
         pred_noise, pred_x_start, weights = model_output.split(self.split_dims, dim = 1)
         normalized_weights = weights.softmax(dim = 1)
+        coefs = self.schedule_coefs(t, x.shape)
 
-        x_start_from_noise = self.predict_start_from_noise(x, t = t, noise = pred_noise)
+        x_start_from_noise = self.predict_start_from_noise(x, t = t, noise = pred_noise, coefs = coefs)
         
         x_starts = torch.stack((x_start_from_noise, pred_x_start), dim = 1)
         weighted_x_start = einsum('b j h w, b j c h w -> b c h w', normalized_weights, x_starts)
@@ -52,13 +53,14 @@ class WeightedObjectiveGaussianDiffusion(GaussianDiffusion):
         if clip_denoised:
             weighted_x_start.clamp_(-1., 1.)
 
-        model_mean, model_variance, model_log_variance = self.q_posterior(weighted_x_start, x, t)
+        model_mean, model_variance, model_log_variance = self.q_posterior(weighted_x_start, x, t, coefs)
 
         return model_mean, model_variance, model_log_variance
 
     def p_losses(self, x_start, t, noise = None, clip_denoised = False):
         noise = default(noise, lambda: torch.randn_like(x_start))
-        x_t = self.q_sample(x_start = x_start, t = t, noise = noise)
+        coefs = self.schedule_coefs(t, x_start.shape)
+        x_t = self.q_sample(x_start = x_start, t = t, noise = noise, coefs = coefs)
 
         model_output = self.model(x_t, t)
         pred_noise, pred_x_start, weights = model_output.split(self.split_dims, dim = 1)
@@ -72,7 +74,7 @@ class WeightedObjectiveGaussianDiffusion(GaussianDiffusion):
         # calculate x_start from predicted noise
         # then do a weighted sum of the x_start prediction, weights also predicted by the model (softmax normalized)
 
-        x_start_from_pred_noise = self.predict_start_from_noise(x_t, t, pred_noise)
+        x_start_from_pred_noise = self.predict_start_from_noise(x_t, t, pred_noise, coefs)
         x_start_from_pred_noise = x_start_from_pred_noise.clamp(-2., 2.)
         weighted_x_start = einsum('b j h w, b j c h w -> b c h w', weights.softmax(dim = 1), torch.stack((x_start_from_pred_noise, pred_x_start), dim = 1))
 
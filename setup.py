@@ -17,7 +17,7 @@ setup(
   install_requires=[
     'accelerate',
     'einops',
-    'ema-pytorch',
+    'numpy',
     'pillow',
     'torch',
     'torchvision',
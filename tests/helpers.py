@@ -0,0 +1,44 @@
+import os
+import socket
+
+import numpy as np
+import torch.multiprocessing as mp
+
+from PIL import Image
+
+# helpers shared by the tests
+
+def make_image_folder(folder, num_images = 8, image_size = 16, seed = 0):
+    folder.mkdir(parents = True, exist_ok = True)
+    rng = np.random.default_rng(seed)
+
+    for ind in range(num_images):
+        arr = rng.integers(0, 256, (image_size, image_size, 3), dtype = np.uint8)
+        Image.fromarray(arr).save(folder / f'{ind}.png')
+
+    return folder
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def distributed_worker(rank, world_size, port, fn, args):
+    # the environment torchrun would set up, with accelerate on cpu, so it uses gloo across the processes
+
+    os.environ.update(
+        MASTER_ADDR = '127.0.0.1',
+        MASTER_PORT = str(port),
+        RANK = str(rank),
+        LOCAL_RANK = str(rank),
+        WORLD_SIZE = str(world_size),
+        LOCAL_WORLD_SIZE = str(world_size),
+        ACCELERATE_USE_CPU = 'true',
+        OMP_NUM_THREADS = '1'
+    )
+
+    fn(*args)
+
+def run_distributed(fn, world_size, *args):
+    # fn must be importable by the spawned processes, so defined at module level
+    mp.spawn(distributed_worker, args = (world_size, free_port(), fn, args), nprocs = world_size)
@@ -0,0 +1,32 @@
+import pytest
+import torch
+
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import Attention
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch_1d import Attention as Attention1D
+from denoising_diffusion_pytorch.classifier_free_guidance import Attention as GuidedAttention
+
+@pytest.mark.parametrize('attention_klass, shape', (
+    (Attention, (2, 16, 8, 8)),
+    (Attention1D, (2, 16, 64)),
+    (GuidedAttention, (2, 16, 8, 8))
+))
+def test_sdpa_matches_chunked_fallback(attention_klass, shape):
+    torch.manual_seed(0)
+
+    sdpa_attn = attention_klass(16)
+    chunked_attn = attention_klass(16, use_sdpa = False, query_chunk_size = 24) # 64 queries in uneven chunks
+    chunked_attn.load_state_dict(sdpa_attn.state_dict())
+
+    assert sdpa_attn.use_sdpa
+
+    x = torch.randn(shape, requires_grad = True)
+
+    sdpa_out = sdpa_attn(x)
+    sdpa_grad, = torch.autograd.grad(sdpa_out.sum(), x)
+
+    chunked_out = chunked_attn(x)
+    chunked_grad, = torch.autograd.grad(chunked_out.sum(), x)
+
+    # under 1e-6 apart in float32
+    assert torch.allclose(sdpa_out, chunked_out, atol = 1e-5)
+    assert torch.allclose(sdpa_grad, chunked_grad, atol = 1e-5)
@@ -0,0 +1,26 @@
+import torch
+
+from denoising_diffusion_pytorch.classifier_free_guidance import Unet, GaussianDiffusion
+
+def test_batched_guidance_matches_two_passes():
+    torch.manual_seed(0)
+
+    model = Unet(dim = 8, dim_mults = (1, 2), num_classes = 4).eval()
+
+    x = torch.randn(3, 3, 16, 16)
+    time = torch.randint(0, 10, (3,))
+    classes = torch.randint(0, 4, (3,))
+
+    with torch.no_grad():
+        for cond_scale in (1., 3., 6.):
+            batched = model.forward_with_cond_scale(x, time, classes, cond_scale = cond_scale)
+            two_passes = model.forward_with_cond_scale(x, time, classes, cond_scale = cond_scale, batched_guidance = False)
+
+            assert torch.allclose(batched, two_passes, atol = 1e-5)
+
+def test_guided_sampling():
+    model = Unet(dim = 8, dim_mults = (1, 2), num_classes = 4)
+    diffusion = GaussianDiffusion(model, image_size = 16, timesteps = 10, sampling_timesteps = 4)
+
+    images = diffusion.sample(classes = torch.tensor([0, 3]), cond_scale = 3.)
+    assert images.shape == (2, 3, 16, 16)
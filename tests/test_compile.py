@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+
+@pytest.mark.parametrize('gradient_checkpointing', (False, True))
+@pytest.mark.parametrize('channels_last', (False, True))
+def test_unet_forward_compiles_without_graph_breaks(gradient_checkpointing, channels_last):
+    torch._dynamo.reset()
+
+    model = Unet(dim = 8, dim_mults = (1, 2), gradient_checkpointing = gradient_checkpointing)
+    model.train()
+
+    if channels_last:
+        model.to(memory_format = torch.channels_last)
+        model.channels_last = True
+
+    x = torch.randn(2, 3, 16, 16)
+    time = torch.randint(0, 10, (2,))
+
+    explanation = torch._dynamo.explain(Unet.unet_forward)(model, x, time)
+
+    assert explanation.graph_break_count == 0, explanation.break_reasons
+    assert explanation.graph_count == 1
+
+def test_compiled_forward_matches_eager():
+    torch._dynamo.reset()
+    torch.manual_seed(0)
+
+    model = Unet(dim = 8, dim_mults = (1, 2)).eval()
+    diffusion = GaussianDiffusion(model, image_size = 16, timesteps = 10)
+
+    x = torch.randn(2, 3, 16, 16)
+    time = torch.randint(0, 10, (2,))
+
+    with torch.no_grad():
+        expected = model(x, time)
+        model.compile(channels_last = True)
+        out = model(x, time)
+
+    assert torch.allclose(out, expected, atol = 1e-4)
+
+def test_compiled_sampling_has_no_graph_breaks():
+    from torch._dynamo.utils import counters
+
+    torch._dynamo.reset()
+    counters.clear()
+
+    diffusion = GaussianDiffusion(Unet(dim = 8, dim_mults = (1, 2)), image_size = 16, timesteps = 10, sampling_timesteps = 4, compile = True)
+    images = diffusion.sample(batch_size = 2)
+
+    assert images.shape == (2, 3, 16, 16)
+    assert sum(counters['graph_break'].values()) == 0, dict(counters['graph_break'])
+    assert counters['stats']['unique_graphs'] >= 1
@@ -0,0 +1,70 @@
+import torch
+
+from denoising_diffusion_pytorch import Unet, ElucidatedDiffusion, ConsistencyDistiller, Trainer
+
+from helpers import make_image_folder
+
+def make_distiller():
+    torch.manual_seed(0)
+    model = Unet(dim = 8, dim_mults = (1, 2), learned_sinusoidal_cond = True)
+    teacher = ElucidatedDiffusion(model, image_size = 16, num_sample_steps = 4)
+    return ConsistencyDistiller(teacher, num_discretization_steps = 4)
+
+def make_trainer(distiller, folder, results_folder, **kwargs):
+    return Trainer(
+        distiller,
+        str(folder),
+        train_batch_size = 2,
+        train_num_steps = 3,
+        save_and_sample_every = 1000,
+        num_samples = 4,
+        results_folder = str(results_folder),
+        **kwargs
+    )
+
+def params_equal(module, other):
+    return all(torch.equal(p, other_p) for p, other_p in zip(module.parameters(), other.parameters()))
+
+def test_target_is_updated_once_per_optimizer_step(tmp_path):
+    distiller = make_distiller()
+    trainer = make_trainer(distiller, make_image_folder(tmp_path / 'images'), tmp_path / 'results', gradient_accumulate_every = 3)
+
+    num_updates = 0
+    update_target = distiller.update_target
+
+    def counted_update_target(*args, **kwargs):
+        nonlocal num_updates
+        num_updates += 1
+        return update_target(*args, **kwargs)
+
+    distiller.update_target = counted_update_target
+    trainer.train()
+
+    assert num_updates == 3
+
+def test_target_is_reset_to_student_on_load(tmp_path):
+    folder = make_image_folder(tmp_path / 'images')
+
+    distiller = make_distiller()
+    trainer = make_trainer(distiller, folder, tmp_path / 'results')
+    trainer.train()
+    trainer.save(1)
+
+    resumed = make_distiller()
+    assert not params_equal(resumed.target.module, distiller.student)
+
+    resumed_trainer = make_trainer(resumed, folder, tmp_path / 'results')
+    resumed_trainer.load(1)
+
+    assert params_equal(resumed.student, distiller.student)
+    assert params_equal(resumed.target.module, resumed.student)
+
+def test_sample_consistency_seeded():
+    distiller = make_distiller()
+    student = distiller.student
+
+    images = student.sample_consistency(steps = 2, seeds = [3, 4])
+    single = student.sample_consistency(steps = 2, seeds = [4])
+
+    assert images.shape == (2, 3, 16, 16)
+    assert torch.allclose(images[1], single[0], atol = 1e-5)
@@ -0,0 +1,57 @@
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion, ContinuousBatchingSampler
+
+def make_diffusion(**kwargs):
+    torch.manual_seed(0)
+    return GaussianDiffusion(Unet(dim = 8, dim_mults = (1, 2)), image_size = 16, timesteps = 20, sampling_timesteps = 4, **kwargs)
+
+def test_single_request_matches_ddim_sample():
+    diffusion = make_diffusion()
+    expected = diffusion.sample(seeds = [7])[0]
+
+    sampler = ContinuousBatchingSampler(diffusion)
+    sampler.add_request('only', seed = 7)
+
+    (request_id, image), = list(sampler.run())
+
+    assert request_id == 'only'
+    assert torch.allclose(image, expected, atol = 1e-5)
+    assert diffusion.model.time_cond_index is None
+
+def test_staggered_requests_finish_at_their_own_step():
+    diffusion = make_diffusion()
+    seeds = dict(a = 0, b = 1, c = 2)
+    expected = dict(zip(seeds.keys(), diffusion.sample(seeds = list(seeds.values()))))
+
+    sampler = ContinuousBatchingSampler(diffusion, max_batch_size = 2)
+    sampler.add_request('a', seed = seeds['a'])
+
+    finished_at = dict()
+    step = 0
+
+    while not sampler.is_idle:
+        step += 1
+
+        # b is admitted next to a at step 3, and c waits for the slot a frees after step 4
+
+        if step == 3:
+            sampler.add_request('b', seed = seeds['b'])
+            sampler.add_request('c', seed = seeds['c'])
+
+        for request_id, image in sampler.step():
+            finished_at[request_id] = step
+            assert torch.allclose(image, expected[request_id], atol = 1e-5)
+
+    assert finished_at == dict(a = 4, b = 6, c = 8)
+
+def test_searched_ddim_timesteps_are_used():
+    diffusion = make_diffusion(ddim_sampling_eta = 0.)
+    diffusion.set_ddim_timesteps([19, 11, 3, 0])
+    expected = diffusion.sample(seeds = [3])[0]
+
+    sampler = ContinuousBatchingSampler(diffusion)
+    sampler.add_request(seed = 3)
+
+    (_, image), = list(sampler.run())
+    assert torch.allclose(image, expected, atol = 1e-5)
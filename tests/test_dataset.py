@@ -0,0 +1,33 @@
+import torch
+
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import Dataset, build_image_cache
+
+from helpers import make_image_folder
+
+def test_cached_items_match_uncached(tmp_path):
+    folder = make_image_folder(tmp_path / 'images', num_images = 4)
+    cache_path = build_image_cache(folder, 16, tmp_path / 'cache.npy', num_workers = 1)
+
+    for uint8_output in (False, True):
+        uncached = Dataset(folder, 16, uint8_output = uint8_output)
+        cached = Dataset(folder, 16, cache_path = cache_path, uint8_output = uint8_output)
+
+        assert len(cached) == len(uncached) == 4
+
+        for index in range(4):
+            img, cached_img = uncached[index], cached[index]
+
+            assert cached_img.dtype == img.dtype == (torch.uint8 if uint8_output else torch.float32)
+            assert torch.equal(cached_img, img)
+
+def test_cached_items_are_flipped_with_uint8_output(tmp_path):
+    folder = make_image_folder(tmp_path / 'images', num_images = 1)
+    cache_path = build_image_cache(folder, 16, tmp_path / 'cache.npy', num_workers = 1)
+
+    img = Dataset(folder, 16, uint8_output = True)[0]
+    cached = Dataset(folder, 16, cache_path = cache_path, augment_horizontal_flip = True, uint8_output = True)
+
+    draws = [cached[0] for _ in range(32)]
+
+    assert all(torch.equal(draw, img) or torch.equal(draw, img.flip(-1)) for draw in draws)
+    assert any(torch.equal(draw, img.flip(-1)) for draw in draws)
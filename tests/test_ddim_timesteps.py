@@ -0,0 +1,62 @@
+import pytest
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion, Unet1D, GaussianDiffusion1D
+from denoising_diffusion_pytorch.timestep_search import search_ddim_timesteps
+
+def make_diffusion():
+    return GaussianDiffusion(Unet(dim = 8, dim_mults = (1, 2)), image_size = 16, timesteps = 20, sampling_timesteps = 5, ddim_sampling_eta = 0.)
+
+def test_ddim_timesteps_are_saved_and_loaded():
+    diffusion = make_diffusion()
+    diffusion.set_ddim_timesteps([19, 12, 4, 0])
+
+    loaded = make_diffusion()
+    loaded.load_state_dict(diffusion.state_dict())
+
+    assert loaded.ddim_timesteps.tolist() == [19, 12, 4, 0]
+    assert loaded.sampling_times() == [19, 12, 4, 0, -1]
+
+def test_checkpoint_without_ddim_timesteps_loads_strictly_and_clears_them():
+    state_dict = make_diffusion().state_dict()
+    assert 'ddim_timesteps' not in state_dict
+
+    diffusion = make_diffusion()
+    diffusion.set_ddim_timesteps([19, 12, 4, 0])
+    diffusion.load_state_dict(state_dict)
+
+    assert diffusion.ddim_timesteps is None
+    assert diffusion.sampling_timesteps == 5
+    assert diffusion.sampling_times() == make_diffusion().sampling_times()
+
+def test_checkpoint_without_ddim_timesteps_loads_strictly_1d():
+    make = lambda: GaussianDiffusion1D(Unet1D(dim = 8, dim_mults = (1, 2), channels = 1), seq_length = 16, timesteps = 20, ddim_sampling_eta = 0.)
+
+    diffusion = make()
+    diffusion.set_ddim_timesteps([15, 5, 0])
+    diffusion.load_state_dict(make().state_dict())
+
+    assert diffusion.ddim_timesteps is None
+    assert not diffusion.is_ddim_sampling
+
+def test_searched_timesteps_are_no_worse_than_uniform():
+    torch.manual_seed(0)
+    diffusion = make_diffusion()
+
+    _, uniform_loss = search_ddim_timesteps(diffusion, num_steps = 4, batch_size = 2, reference_steps = 20, num_rounds = 0)
+    times, loss = search_ddim_timesteps(diffusion, num_steps = 4, batch_size = 2, reference_steps = 20, num_rounds = 2)
+
+    assert loss <= uniform_loss
+    assert times == sorted(set(times), reverse = True) and 0 <= times[-1] and times[0] < 20
+
+    diffusion.set_ddim_timesteps(times)
+    assert diffusion.sampling_times() == [*times, -1]
+
+def test_searched_timesteps_need_deterministic_ddim():
+    diffusion = GaussianDiffusion(Unet(dim = 8, dim_mults = (1, 2)), image_size = 16, timesteps = 20, sampling_timesteps = 5)
+
+    with pytest.raises(AssertionError):
+        diffusion.set_ddim_timesteps([19, 12, 4, 0])
+
+    diffusion.sampler = 'dpm_solver++'
+    diffusion.set_ddim_timesteps([19, 12, 4, 0])
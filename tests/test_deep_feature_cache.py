@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+
+@pytest.fixture(scope = 'module')
+def samples():
+    torch.manual_seed(0)
+    model = Unet(dim = 16, dim_mults = (1, 2, 4))
+
+    def sample(feature_cache_interval):
+        diffusion = GaussianDiffusion(model, image_size = 16, timesteps = 100, sampling_timesteps = 20, feature_cache_interval = feature_cache_interval)
+        return diffusion.sample(seeds = [0, 1, 2, 3])
+
+    return sample
+
+def test_cached_sampling_stays_close_to_uncached(samples):
+    uncached = samples(1)
+
+    for feature_cache_interval in (2, 3, 5):
+        cached = samples(feature_cache_interval)
+
+        # about 0.04 on this untrained unet, for images in [0, 1]
+        rmse = (cached - uncached).pow(2).mean().sqrt()
+        assert 0 < rmse < 0.1, f'rmse {rmse:.4f} with feature_cache_interval {feature_cache_interval}'
+
+def test_feature_cache_is_cleared_after_sampling():
+    model = Unet(dim = 8, dim_mults = (1, 2))
+    diffusion = GaussianDiffusion(model, image_size = 16, timesteps = 20, sampling_timesteps = 6, feature_cache_interval = 3)
+    diffusion.sample(batch_size = 1)
+
+    assert not model.cache_deep_features
+    assert model.deep_features is None
@@ -0,0 +1,27 @@
+import os
+
+from denoising_diffusion_pytorch.file_manifest import list_image_paths
+
+from helpers import make_image_folder
+
+def test_symlinked_directories_are_not_followed(tmp_path):
+    folder = tmp_path / 'images'
+    make_image_folder(folder / 'sub', num_images = 2)
+
+    # a cycle back to the root would otherwise be walked forever
+
+    os.symlink(folder, folder / 'sub' / 'loop', target_is_directory = True)
+
+    paths = list_image_paths(folder)
+    assert [path.relative_to(folder).parent.name for path in paths] == ['sub', 'sub']
+
+def test_manifest_is_reused_until_a_directory_changes(tmp_path):
+    folder = tmp_path / 'images'
+    make_image_folder(folder, num_images = 2)
+    manifest_path = tmp_path / 'manifest.json.gz'
+
+    assert len(list_image_paths(folder, manifest_path = manifest_path)) == 2
+
+    (folder / '0.png').rename(folder / 'renamed.png')
+    os.utime(folder, ns = (0, 0))
+    assert sorted(path.name for path in list_image_paths(folder, manifest_path = manifest_path))[-1] == 'renamed.png'
@@ -0,0 +1,68 @@
+import torch
+
+from denoising_diffusion_pytorch import Unet, Unet1D
+from denoising_diffusion_pytorch.classifier_free_guidance import Unet as GuidedUnet
+
+def test_unfrozen_unet_follows_dtype_changes_made_while_frozen():
+    model = Unet(dim = 8, dim_mults = (1, 2)).eval()
+    state_dict = {key: value.clone() for key, value in model.state_dict().items()}
+
+    model.freeze_for_inference()
+    model.double()
+    model.unfreeze_for_training()
+
+    assert all(param.dtype == torch.float64 for param in model.parameters())
+    assert all(torch.equal(value.double(), model.state_dict()[key]) for key, value in state_dict.items() if value.is_floating_point())
+
+def test_frozen_unet_keeps_its_parameters_and_state_dict_keys():
+    for model in (Unet(dim = 8, dim_mults = (1, 2)), Unet1D(dim = 8, dim_mults = (1, 2)), GuidedUnet(dim = 8, dim_mults = (1, 2), num_classes = 2)):
+        keys = set(model.state_dict().keys())
+        num_params = len(list(model.parameters()))
+
+        model.freeze_for_inference()
+        model.half()
+
+        assert set(model.state_dict().keys()) == keys
+        assert len(list(model.parameters())) == num_params
+        assert all(conv.weight.dtype == torch.float16 for _, conv in model.standardized_convs)
+
+def unets():
+    return (
+        (Unet(dim = 8, dim_mults = (1, 2)), (torch.randn(2, 3, 16, 16), torch.randint(0, 10, (2,)))),
+        (Unet1D(dim = 8, dim_mults = (1, 2), channels = 1), (torch.randn(2, 1, 32), torch.randint(0, 10, (2,)))),
+        (GuidedUnet(dim = 8, dim_mults = (1, 2), num_classes = 2), (torch.randn(2, 3, 16, 16), torch.randint(0, 10, (2,)), torch.tensor([0, 1])))
+    )
+
+@torch.no_grad()
+def test_frozen_unet_matches_unfrozen():
+    torch.manual_seed(0)
+
+    for model, args in unets():
+        model.eval()
+        kwargs = dict(cond_drop_prob = 0.) if isinstance(model, GuidedUnet) else dict()
+
+        expected = model(*args, **kwargs)
+        model.freeze_for_inference()
+
+        assert model.frozen_for_inference
+        assert torch.equal(model(*args, **kwargs), expected)
+
+def test_training_after_unfreezing_updates_the_standardized_weights():
+    torch.manual_seed(0)
+
+    for model, args in unets():
+        model.freeze_for_inference()
+        standardized_convs = [conv for _, conv in model.standardized_convs]
+
+        model.unfreeze_for_training()
+        model.train()
+
+        weights = [conv.weight.detach().clone() for conv in standardized_convs]
+
+        opt = torch.optim.SGD(model.parameters(), lr = 0.1)
+        kwargs = dict(cond_drop_prob = 0.) if isinstance(model, GuidedUnet) else dict()
+
+        model(*args, **kwargs).pow(2).mean().backward()
+        opt.step()
+
+        assert all(not torch.equal(conv.weight, weight) for conv, weight in zip(standardized_convs, weights))
@@ -0,0 +1,114 @@
+import pytest
+import torch
+from torch import nn
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+from denoising_diffusion_pytorch.fused_ema import FusedEMA
+
+def make_diffusion():
+    model = Unet(dim = 8, dim_mults = (1, 2))
+    return GaussianDiffusion(model, image_size = 16, timesteps = 10)
+
+def test_loads_ema_pytorch_state_dict():
+    ema_pytorch = pytest.importorskip('ema_pytorch')
+
+    diffusion = make_diffusion()
+    legacy_ema = ema_pytorch.EMA(diffusion, beta = 0.995, update_every = 1, update_after_step = 0)
+
+    with torch.no_grad():
+        for param in diffusion.parameters():
+            param.add_(torch.randn_like(param))
+
+    legacy_ema.update()
+    legacy_ema.update()
+
+    state_dict = legacy_ema.state_dict()
+    assert any(key.startswith('online_model.') for key in state_dict)
+
+    fused_ema = FusedEMA(make_diffusion())
+    fused_ema.load_state_dict(state_dict)
+
+    for fused_param, legacy_param in zip(fused_ema.ema_model.parameters(), legacy_ema.ema_model.parameters()):
+        assert torch.equal(fused_param, legacy_param)
+
+    assert fused_ema.step.item() == legacy_ema.step.item()
+
+def test_fused_ema_state_dict_roundtrip():
+    diffusion = make_diffusion()
+    ema = FusedEMA(diffusion, update_every = 1, update_after_step = 0)
+    ema.update()
+
+    other = FusedEMA(make_diffusion())
+    other.load_state_dict(ema.state_dict())
+
+    for param, other_param in zip(ema.ema_model.parameters(), other.ema_model.parameters()):
+        assert torch.equal(param, other_param)
+
+def make_model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(4, 8), nn.SiLU(), nn.Linear(8, 4))
+
+def perturb_(model):
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(torch.randn_like(param) * 0.1)
+
+def test_updates_match_ema_pytorch():
+    ema_pytorch = pytest.importorskip('ema_pytorch')
+
+    model = make_model()
+    kwargs = dict(beta = 0.99, update_after_step = 4, update_every = 3)
+
+    legacy_ema = ema_pytorch.EMA(model, **kwargs)
+    fused_ema = FusedEMA(model, **kwargs)
+
+    for step in range(20):
+        perturb_(model)
+        legacy_ema.update()
+        fused_ema.update()
+
+        assert fused_ema.step.item() == legacy_ema.step.item()
+
+        for fused_param, legacy_param in zip(fused_ema.ema_model.parameters(), legacy_ema.ema_model.parameters()):
+            assert torch.allclose(fused_param, legacy_param, atol = 1e-6), f'ema differs after update {step + 1}'
+
+def test_bfloat16_ema_tracks_float32_ema():
+    model = make_model()
+    kwargs = dict(beta = 0.99, update_after_step = 2, update_every = 1)
+
+    ema = FusedEMA(model, **kwargs)
+    bfloat16_ema = FusedEMA(model, ema_dtype = torch.bfloat16, **kwargs)
+
+    for _ in range(10):
+        perturb_(model)
+        ema.update()
+        bfloat16_ema.update()
+
+    for param, bfloat16_param in zip(ema.ema_model.parameters(), bfloat16_ema.ema_model.parameters()):
+        assert bfloat16_param.dtype == torch.bfloat16
+        assert torch.allclose(bfloat16_param.float(), param, atol = 2e-2)
+
+    inference_model = bfloat16_ema.inference_model(dtype = torch.float32)
+    assert all(param.dtype == torch.float32 for param in inference_model.parameters())
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason = 'staging into pinned cpu memory needs a cuda online model')
+def test_cpu_ema_of_cuda_model_matches_on_device_ema():
+    model = make_model().cuda()
+    kwargs = dict(beta = 0.99, update_after_step = 2, update_every = 2)
+
+    ema = FusedEMA(model, **kwargs)
+    cpu_ema = FusedEMA(model, ema_device = 'cpu', **kwargs)
+
+    assert cpu_ema.pinned and all(staged.is_pinned() for staged in cpu_ema.staged_params)
+
+    for _ in range(10):
+        perturb_(model)
+        ema.update()
+        cpu_ema.update()
+
+    # the last staged update is folded in when the state dict is read
+
+    cpu_state_dict = cpu_ema.state_dict()
+
+    for key, value in ema.state_dict().items():
+        assert torch.allclose(cpu_state_dict[key].cuda().to(value.dtype), value, atol = 1e-6)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import torch
+
+from PIL import Image
+from accelerate import Accelerator
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+from denoising_diffusion_pytorch.generate import generate, shard_path
+
+def make_diffusion():
+    torch.manual_seed(0)
+    model = Unet(dim = 8, dim_mults = (1, 2))
+    return GaussianDiffusion(model, image_size = 16, timesteps = 10, sampling_timesteps = 4)
+
+def read_shard(path, image_format):
+    if image_format == 'npy':
+        return np.load(path)
+
+    return np.stack([np.asarray(Image.open(file).convert('RGB')) for file in sorted(path.glob('*.png'))])
+
+def expected_image(diffusion, seed):
+    image = diffusion.sample(seeds = [seed])[0]
+    return (image.clamp(0., 1.) * 255).round().to(torch.uint8).permute(1, 2, 0).numpy()
+
+@pytest.mark.parametrize('image_format', ('png', 'npy'))
+def test_generate_shards_and_restart(tmp_path, image_format):
+    diffusion = make_diffusion()
+    accelerator = Accelerator(cpu = True)
+
+    kwargs = dict(batch_size = 2, shard_size = 3, seed = 100, image_format = image_format, accelerator = accelerator)
+    generate(diffusion, 7, tmp_path, **kwargs)
+
+    # 7 samples in shards of 3 - the last shard holds the remainder
+
+    paths = [shard_path(tmp_path, shard_index, image_format) for shard_index in range(3)]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [path.name for path in paths]
+
+    shards = [read_shard(path, image_format) for path in paths]
+    assert [len(shard) for shard in shards] == [3, 3, 1]
+
+    if image_format == 'png':
+        assert sorted(file.name for file in paths[1].iterdir()) == [f'{index:08d}.png' for index in range(3, 6)]
+
+    # sample i is drawn with seed (seed + i), whatever the batch it was sampled in
+
+    images = np.concatenate(shards)
+    assert images.shape == (7, 16, 16, 3) and images.dtype == np.uint8
+
+    for index in (0, 4, 6):
+        assert np.abs(images[index].astype(int) - expected_image(diffusion, 100 + index).astype(int)).max() <= 1
+
+    # on restart, complete shards are kept as they are and only the missing one is sampled again
+
+    if image_format == 'npy':
+        paths[2].unlink()
+        np.save(paths[0], np.zeros_like(shards[0]))
+    else:
+        for file in paths[2].iterdir():
+            file.unlink()
+        paths[2].rmdir()
+        Image.fromarray(np.zeros_like(shards[0][0])).save(paths[0] / '00000000.png')
+
+    generate(diffusion, 7, tmp_path, **kwargs)
+
+    restarted = [read_shard(path, image_format) for path in paths]
+    assert (restarted[0][0] == 0).all()
+    assert np.array_equal(restarted[1], shards[1])
+    assert np.array_equal(restarted[2], shards[2])
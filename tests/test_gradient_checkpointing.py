@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from denoising_diffusion_pytorch import Unet, Unet1D
+from denoising_diffusion_pytorch.classifier_free_guidance import Unet as GuidedUnet
+
+def grads(model, *args, **kwargs):
+    model.zero_grad()
+    out = model(*args, **kwargs)
+    out.pow(2).mean().backward()
+    return out, [param.grad for param in model.parameters()]
+
+@pytest.mark.parametrize('build, inputs', (
+    (lambda **kwargs: Unet(dim = 8, dim_mults = (1, 2), **kwargs), lambda: (torch.randn(2, 3, 16, 16), torch.randint(0, 10, (2,)))),
+    (lambda **kwargs: Unet1D(dim = 8, dim_mults = (1, 2), channels = 1, **kwargs), lambda: (torch.randn(2, 1, 32), torch.randint(0, 10, (2,)))),
+    (lambda **kwargs: GuidedUnet(dim = 8, dim_mults = (1, 2), num_classes = 3, **kwargs), lambda: (torch.randn(2, 3, 16, 16), torch.randint(0, 10, (2,)), torch.randint(0, 3, (2,))))
+))
+def test_checkpointed_gradients_match(build, inputs):
+    torch.manual_seed(0)
+
+    model = build().train()
+    checkpointed_model = build(gradient_checkpointing = True).train()
+    checkpointed_model.load_state_dict(model.state_dict())
+
+    args = inputs()
+    kwargs = dict(cond_drop_prob = 0.) if isinstance(model, GuidedUnet) else dict()
+
+    out, expected_grads = grads(model, *args, **kwargs)
+    checkpointed_out, checkpointed_grads = grads(checkpointed_model, *args, **kwargs)
+
+    assert torch.equal(out, checkpointed_out)
+
+    for grad, expected in zip(checkpointed_grads, expected_grads):
+        assert (grad is None) == (expected is None)
+        assert grad is None or torch.allclose(grad, expected, atol = 1e-6)
@@ -0,0 +1,92 @@
+import pytest
+import torch
+from torch import nn
+
+from denoising_diffusion_pytorch import GaussianDiffusion
+from denoising_diffusion_pytorch.sample_rng import SampleRNG
+from denoising_diffusion_pytorch.multistep_solvers import unipc_sample
+from denoising_diffusion_pytorch.classifier_free_guidance import Unet as GuidedUnet, GaussianDiffusion as GuidedGaussianDiffusion
+
+SHAPE = (2, 3, 8, 8)
+
+# the exact denoiser of gaussian data, so that the probability flow ode is smooth and the solvers converge as they would on a trained model
+
+class GaussianDataDenoiser(nn.Module):
+    def __init__(self, objective, mean = 0.2, std = 0.5):
+        super().__init__()
+        self.channels = self.out_dim = 3
+        self.self_condition = False
+        self.random_or_learned_sinusoidal_cond = False
+
+        self.objective = objective
+        self.mean = mean
+        self.std = std
+        self.alphas_cumprod = None
+
+    def forward(self, x, time, x_self_cond = None):
+        alpha_cumprod = self.alphas_cumprod[time].view(-1, 1, 1, 1)
+        alpha, sigma = alpha_cumprod.sqrt(), (1. - alpha_cumprod).sqrt()
+
+        x_start = self.mean + alpha * self.std ** 2 / (alpha_cumprod * self.std ** 2 + sigma ** 2) * (x - alpha * self.mean)
+        noise = (x - alpha * x_start) / sigma
+
+        if self.objective == 'pred_noise':
+            return noise
+        elif self.objective == 'pred_x0':
+            return x_start
+
+        return alpha * noise - sigma * x_start
+
+def make_diffusion(objective, **kwargs):
+    model = GaussianDataDenoiser(objective)
+    diffusion = GaussianDiffusion(model, image_size = 8, timesteps = 1000, objective = objective, ddim_sampling_eta = 0., **kwargs)
+    model.alphas_cumprod = diffusion.alphas_cumprod
+    return diffusion
+
+def solver_sample(objective, sampling_timesteps, sampler, order):
+    diffusion = make_diffusion(objective, sampling_timesteps = sampling_timesteps, sampler = sampler, solver_order = order)
+    return diffusion.multistep_solver_sample(SHAPE, clip_denoised = False, rng = SampleRNG([0, 1]))
+
+@pytest.mark.parametrize('objective', ('pred_noise', 'pred_x0', 'pred_v'))
+def test_first_order_matches_deterministic_ddim(objective):
+    diffusion = make_diffusion(objective, sampling_timesteps = 10)
+    ddim = diffusion.ddim_sample(SHAPE, clip_denoised = False, rng = SampleRNG([0, 1]))
+
+    assert torch.allclose(solver_sample(objective, 10, 'dpm_solver++', 1), ddim, atol = 1e-5)
+
+    # unipc without its corrector is the same first order update
+
+    times = diffusion.sampling_times()[:-1]
+    x_start_fn = lambda img, time: diffusion.model_predictions(img, torch.full((SHAPE[0],), time), clip_x_start = False).pred_x_start
+
+    img = SampleRNG([0, 1]).randn(SHAPE)
+    unipc = diffusion.unnormalize(unipc_sample(x_start_fn, img, times, diffusion.alphas_cumprod.tolist(), order = 1, use_corrector = False))
+
+    assert torch.allclose(unipc, ddim, atol = 1e-5)
+
+@pytest.mark.parametrize('objective', ('pred_noise', 'pred_x0', 'pred_v'))
+@pytest.mark.parametrize('sampler', ('dpm_solver++', 'unipc'))
+def test_error_drops_with_more_steps(objective, sampler):
+    reference = make_diffusion(objective, sampling_timesteps = 1000).ddim_sample(SHAPE, clip_denoised = False, rng = SampleRNG([0, 1]))
+
+    errors = dict()
+
+    for order in (1, 2, 3):
+        errors[order] = [(solver_sample(objective, steps, sampler, order) - reference).abs().max().item() for steps in (5, 10, 20)]
+        assert errors[order][0] > errors[order][1] > errors[order][2], f'order {order}: {errors[order]}'
+
+    # the higher orders converge faster, about 0.02 against 0.03 to 0.06 for first order at 20 steps
+
+    assert errors[2][-1] < errors[1][-1]
+    assert errors[3][-1] < errors[1][-1]
+
+@pytest.mark.parametrize('sampler', ('ddim', 'dpm_solver++', 'unipc'))
+def test_guided_sampling_is_seeded_per_sample(sampler):
+    torch.manual_seed(0)
+    model = GuidedUnet(dim = 8, dim_mults = (1, 2), num_classes = 4)
+    diffusion = GuidedGaussianDiffusion(model, image_size = 16, timesteps = 20, sampling_timesteps = 4, sampler = sampler)
+
+    batch = diffusion.sample(torch.tensor([1, 3, 2]), seeds = [10, 11, 12])
+    alone = diffusion.sample(torch.tensor([3]), seeds = [11])
+
+    assert torch.allclose(batch[1], alone[0], atol = 1e-5)
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from denoising_diffusion_pytorch import Unet, VParamContinuousTimeGaussianDiffusion, ProgressiveDistiller, progressive_distillation
+
+def make_teacher(num_sample_steps):
+    model = Unet(dim = 8, dim_mults = (1, 2), learned_sinusoidal_cond = True)
+    return VParamContinuousTimeGaussianDiffusion(model, image_size = 16, num_sample_steps = num_sample_steps)
+
+@pytest.mark.parametrize('num_sample_steps', (500, 12, 2))
+def test_rejects_schedule_that_does_not_halve_to_final_steps(num_sample_steps, tmp_path):
+    # fails before any trainer or dataset is created, so the folder does not need to exist
+
+    with pytest.raises(AssertionError, match = 'power of two'):
+        progressive_distillation(make_teacher(num_sample_steps), str(tmp_path / 'missing'), final_sample_steps = 4, results_folder = str(tmp_path))
+
+def test_rejects_zero_final_steps(tmp_path):
+    with pytest.raises(AssertionError, match = 'at least 1'):
+        progressive_distillation(make_teacher(8), str(tmp_path / 'missing'), final_sample_steps = 0, results_folder = str(tmp_path))
+
+def test_distiller_loss_and_sampling():
+    distiller = ProgressiveDistiller(make_teacher(8))
+    assert distiller.student_sample_steps == 4
+
+    loss = distiller(torch.rand(2, 3, 16, 16))
+    loss.backward()
+
+    assert distiller.sample(batch_size = 1).shape == (1, 3, 16, 16)
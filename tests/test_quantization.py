@@ -0,0 +1,36 @@
+import copy
+
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+
+def test_int8_unet_output_stays_close_to_fp32():
+    torch.manual_seed(0)
+
+    diffusion = GaussianDiffusion(Unet(dim = 16, dim_mults = (1, 2)), image_size = 16, timesteps = 100, sampling_timesteps = 10).eval()
+    fp32_diffusion = copy.deepcopy(diffusion)
+
+    diffusion.quantize_for_cpu()
+
+    x = torch.randn(4, 3, 16, 16)
+
+    for t in (0, 50, 99):
+        time = torch.full((4,), t)
+
+        with torch.no_grad():
+            expected = fp32_diffusion.model(x, time)
+            out = diffusion.model(x, time)
+
+        # about 7% on this untrained unet
+        relative_error = (out - expected).norm() / expected.norm()
+        assert relative_error < 0.15, f'relative error {relative_error:.3f} at timestep {t}'
+
+def test_quantized_diffusion_samples():
+    torch.manual_seed(0)
+
+    diffusion = GaussianDiffusion(Unet(dim = 8, dim_mults = (1, 2)), image_size = 16, timesteps = 20, sampling_timesteps = 4)
+    diffusion.quantize_for_cpu(calibration_batch_size = 2, calibration_steps = 4)
+
+    images = diffusion.sample(batch_size = 2)
+    assert images.shape == (2, 3, 16, 16)
+    assert torch.isfinite(images).all()
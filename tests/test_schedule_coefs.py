@@ -0,0 +1,98 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import ScheduleCoefs, extract
+
+# reference implementations gathering every schedule coefficient with its own extract, as before the coefficient table
+
+def reference_model_predictions(diffusion, x, t, clip_x_start = False):
+    model_output = diffusion.model(x, t)
+
+    sqrt_recip = extract(diffusion.sqrt_recip_alphas_cumprod, t, x.shape)
+    sqrt_recipm1 = extract(diffusion.sqrt_recipm1_alphas_cumprod, t, x.shape)
+
+    if diffusion.objective == 'pred_noise':
+        pred_noise = model_output
+        x_start = sqrt_recip * x - sqrt_recipm1 * pred_noise
+    elif diffusion.objective == 'pred_x0':
+        x_start = model_output
+    elif diffusion.objective == 'pred_v':
+        x_start = extract(diffusion.sqrt_alphas_cumprod, t, x.shape) * x - extract(diffusion.sqrt_one_minus_alphas_cumprod, t, x.shape) * model_output
+
+    if clip_x_start:
+        x_start = x_start.clamp(-1., 1.)
+
+    if diffusion.objective != 'pred_noise':
+        pred_noise = (sqrt_recip * x - x_start) / sqrt_recipm1
+
+    return pred_noise, x_start
+
+def reference_p_mean_variance(diffusion, x, t):
+    _, x_start = reference_model_predictions(diffusion, x, t)
+    x_start = x_start.clamp(-1., 1.)
+
+    model_mean = extract(diffusion.posterior_mean_coef1, t, x.shape) * x_start + extract(diffusion.posterior_mean_coef2, t, x.shape) * x
+    return model_mean, extract(diffusion.posterior_variance, t, x.shape), extract(diffusion.posterior_log_variance_clipped, t, x.shape), x_start
+
+def reference_p_losses(diffusion, x_start, t, noise):
+    x = extract(diffusion.sqrt_alphas_cumprod, t, x_start.shape) * x_start + extract(diffusion.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+    model_out = diffusion.model(x, t)
+
+    if diffusion.objective == 'pred_noise':
+        target = noise
+    elif diffusion.objective == 'pred_x0':
+        target = x_start
+    elif diffusion.objective == 'pred_v':
+        target = extract(diffusion.sqrt_alphas_cumprod, t, x_start.shape) * noise - extract(diffusion.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * x_start
+
+    loss = F.mse_loss(model_out, target, reduction = 'none').mean(dim = (1, 2, 3))
+    return (loss * extract(diffusion.p2_loss_weight, t, loss.shape)).mean()
+
+@pytest.fixture(params = ('pred_noise', 'pred_x0', 'pred_v'))
+def diffusion(request):
+    torch.manual_seed(0)
+    model = Unet(dim = 8, dim_mults = (1, 2))
+    return GaussianDiffusion(model, image_size = 16, timesteps = 50, objective = request.param, loss_type = 'l2').eval()
+
+def assert_close(a, b):
+    assert torch.allclose(a, b, atol = 1e-6), (a - b).abs().max()
+
+def test_schedule_coefs_match_extract(diffusion):
+    t = torch.tensor([0, 7, 49])
+    coefs = diffusion.schedule_coefs(t, (3, 3, 16, 16))
+
+    for name in ScheduleCoefs._fields:
+        assert torch.equal(getattr(coefs, name), extract(getattr(diffusion, name), t, (3, 3, 16, 16)))
+
+@torch.no_grad()
+def test_sampling_steps_match_extract(diffusion):
+    x = torch.randn(3, 3, 16, 16)
+    t = torch.tensor([0, 7, 49])
+
+    # p_sample
+
+    for out, expected in zip(diffusion.p_mean_variance(x, t), reference_p_mean_variance(diffusion, x, t)):
+        assert_close(out, expected)
+
+    img, x_start = diffusion.p_sample(x, 0)
+    expected_mean, *_, expected_x_start = reference_p_mean_variance(diffusion, x, torch.zeros(3, dtype = torch.long))
+    assert_close(img, expected_mean)
+    assert_close(x_start, expected_x_start)
+
+    # ddim_sample
+
+    for clip_x_start in (False, True):
+        preds = diffusion.model_predictions(x, t, clip_x_start = clip_x_start)
+
+        for out, expected in zip(preds, reference_model_predictions(diffusion, x, t, clip_x_start = clip_x_start)):
+            assert_close(out, expected)
+
+@torch.no_grad()
+def test_p_losses_match_extract(diffusion):
+    x_start = torch.rand(3, 3, 16, 16) * 2 - 1
+    noise = torch.randn_like(x_start)
+    t = torch.tensor([0, 7, 49])
+
+    assert_close(diffusion.p_losses(x_start, t, noise = noise), reference_p_losses(diffusion, x_start, t, noise))
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from denoising_diffusion_pytorch import (
+    Unet,
+    GaussianDiffusion,
+    Unet1D,
+    GaussianDiffusion1D,
+    ElucidatedDiffusion,
+    ContinuousTimeGaussianDiffusion,
+    VParamContinuousTimeGaussianDiffusion
+)
+
+from denoising_diffusion_pytorch.sample_rng import SampleRNG
+
+def unet():
+    torch.manual_seed(0)
+    return Unet(dim = 8, dim_mults = (1, 2))
+
+def continuous_time_unet():
+    torch.manual_seed(0)
+    return Unet(dim = 8, dim_mults = (1, 2), learned_sinusoidal_cond = True)
+
+def assert_seed_gives_same_sample(diffusion):
+    batch = diffusion.sample(seeds = [5, 6, 7])
+    alone = diffusion.sample(seeds = [6])
+    other = diffusion.sample(seeds = [8])
+
+    assert batch.shape[0] == 3
+    assert torch.allclose(batch[1], alone[0], atol = 1e-5)
+    assert not torch.allclose(batch[1], other[0])
+
+@pytest.mark.parametrize('sampling_timesteps, sampler', (
+    (None, 'ddim'),          # p_sample_loop
+    (4, 'ddim'),
+    (4, 'dpm_solver++'),
+    (4, 'unipc')
+))
+def test_gaussian_diffusion_seeds(sampling_timesteps, sampler):
+    diffusion = GaussianDiffusion(unet(), image_size = 16, timesteps = 10, sampling_timesteps = sampling_timesteps, sampler = sampler)
+    assert_seed_gives_same_sample(diffusion)
+
+@pytest.mark.parametrize('sampling_timesteps', (None, 4))
+def test_gaussian_diffusion_1d_seeds(sampling_timesteps):
+    torch.manual_seed(0)
+    model = Unet1D(dim = 8, dim_mults = (1, 2), channels = 1)
+    diffusion = GaussianDiffusion1D(model, seq_length = 16, timesteps = 10, sampling_timesteps = sampling_timesteps)
+    assert_seed_gives_same_sample(diffusion)
+
+def test_continuous_time_seeds():
+    assert_seed_gives_same_sample(ElucidatedDiffusion(continuous_time_unet(), image_size = 16, num_sample_steps = 4))
+    assert_seed_gives_same_sample(ContinuousTimeGaussianDiffusion(continuous_time_unet(), image_size = 16, num_sample_steps = 4))
+    assert_seed_gives_same_sample(VParamContinuousTimeGaussianDiffusion(continuous_time_unet(), image_size = 16, num_sample_steps = 4))
+
+def test_seeds_must_match_batch():
+    with pytest.raises(AssertionError):
+        SampleRNG([0, 1]).randn((3, 2))
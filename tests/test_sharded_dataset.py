@@ -0,0 +1,70 @@
+from collections import Counter
+from itertools import islice
+
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from denoising_diffusion_pytorch.sharded_dataset import write_image_shards, ShardedImageDataset
+
+from helpers import make_image_folder
+
+NUM_IMAGES = 12
+BATCH_SIZE = 2
+
+@pytest.fixture
+def shards(tmp_path):
+    folder = make_image_folder(tmp_path / 'images', num_images = NUM_IMAGES)
+    return write_image_shards(folder, tmp_path / 'shards', shard_size = 2)
+
+def make_dataset(shards, **kwargs):
+    return ShardedImageDataset(shards, 16, shuffle_buffer_size = 1, uint8_output = True, **kwargs)
+
+def take_batches(dataset, num_workers, num_batches):
+    dl = DataLoader(dataset, batch_size = BATCH_SIZE, num_workers = num_workers)
+    return list(islice(dl, num_batches))
+
+def image_keys(batches):
+    return [image.numpy().tobytes() for batch in batches for image in batch]
+
+def test_write_image_shards(shards):
+    names = sorted(path.name for path in shards.iterdir())
+    assert names == ['index.json', *[f'shard-{ind:05d}.tar' for ind in range(6)]]
+    assert len(make_dataset(shards)) == NUM_IMAGES
+
+@pytest.mark.parametrize('world_size, num_workers', ((1, 0), (2, 0), (2, 3)))
+def test_every_image_once_per_epoch(shards, world_size, num_workers):
+    batches_per_epoch = NUM_IMAGES // (world_size * BATCH_SIZE)
+
+    epochs = [Counter() for _ in range(2)]
+
+    for rank in range(world_size):
+        dataset = make_dataset(shards, rank = rank, world_size = world_size)
+        keys = image_keys(take_batches(dataset, num_workers, 2 * batches_per_epoch))
+
+        epoch_length = len(keys) // 2
+        epochs[0].update(keys[:epoch_length])
+        epochs[1].update(keys[epoch_length:])
+
+    for counts in epochs:
+        assert len(counts) == NUM_IMAGES
+        assert set(counts.values()) == {1}
+
+    assert epochs[0] == epochs[1]
+
+@pytest.mark.parametrize('num_workers', (0, 2))
+def test_set_position_skips_consumed_prefix(shards, num_workers):
+    uninterrupted = take_batches(make_dataset(shards, rank = 1, world_size = 2), num_workers, 6)
+
+    resumed_dataset = make_dataset(shards, rank = 1, world_size = 2)
+    resumed_dataset.set_position(4, BATCH_SIZE)
+    resumed = take_batches(resumed_dataset, num_workers, 2)
+
+    for batch, expected in zip(resumed, uninterrupted[4:]):
+        assert torch.equal(batch, expected)
+
+def test_too_few_shards(shards):
+    dataset = make_dataset(shards, world_size = 7)
+
+    with pytest.raises(AssertionError):
+        next(iter(dataset))
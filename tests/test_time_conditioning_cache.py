@@ -0,0 +1,58 @@
+from contextlib import nullcontext
+
+import pytest
+import torch
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion
+
+def test_cached_timesteps_match_the_time_mlp():
+    torch.manual_seed(0)
+    model = Unet(dim = 8, dim_mults = (1, 2)).eval()
+    x = torch.randn(2, 3, 16, 16)
+
+    with torch.no_grad():
+        expected = {time: model(x, torch.full((2,), time)) for time in (3, 5)}
+
+        model.cache_time_conditioning(torch.tensor([3, 5]))
+
+        for time, out in expected.items():
+            assert torch.allclose(model(x, torch.full((2,), time)), out, atol = 1e-5), f'timestep {time} differs from the uncached output'
+
+        mixed = model(x, torch.tensor([5, 3]))
+        assert torch.allclose(mixed[0], expected[5][0], atol = 1e-5)
+        assert torch.allclose(mixed[1], expected[3][1], atol = 1e-5)
+
+        model.clear_time_conditioning_cache()
+
+def test_cached_timesteps_use_the_cache():
+    model = Unet(dim = 8, dim_mults = (1, 2)).eval()
+    model.cache_time_conditioning(torch.tensor([2, 7]))
+
+    rows = model.time_conditioning(torch.tensor([7, 2, 7]))
+    assert not torch.is_floating_point(rows)
+    assert rows.tolist() == [1, 0, 1]
+
+def test_uncached_timesteps_fail():
+    model = Unet(dim = 8, dim_mults = (1, 2)).eval()
+    model.cache_time_conditioning(torch.tensor([2, 7]))
+
+    with pytest.raises((RuntimeError, IndexError)):
+        model.time_conditioning(torch.tensor([2, 4]))
+
+    with pytest.raises((RuntimeError, IndexError)):
+        model.time_conditioning(torch.tensor([8]))
+
+    # continuous times always go through the time mlp
+
+    assert torch.is_floating_point(model.time_conditioning(torch.tensor([0.5])))
+
+def test_cached_sampling_matches_uncached():
+    torch.manual_seed(0)
+    diffusion = GaussianDiffusion(Unet(dim = 8, dim_mults = (1, 2)), image_size = 16, timesteps = 20, sampling_timesteps = 5)
+
+    cached = diffusion.sample(seeds = [0, 1])
+
+    diffusion.cached_time_conditioning = lambda times: nullcontext()
+    uncached = diffusion.sample(seeds = [0, 1])
+
+    assert torch.allclose(cached, uncached, atol = 1e-5)
@@ -0,0 +1,76 @@
+import torch
+
+from PIL import Image
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion, Trainer
+
+from helpers import make_image_folder
+
+def make_trainer(tmp_path, **kwargs):
+    folder = make_image_folder(tmp_path / 'images')
+    torch.manual_seed(0)
+
+    model = Unet(dim = 8, dim_mults = (1, 2))
+    diffusion = GaussianDiffusion(model, image_size = 16, timesteps = 10)
+
+    return Trainer(
+        diffusion,
+        str(folder),
+        train_batch_size = 4,
+        num_samples = 4,
+        results_folder = str(tmp_path / 'results'),
+        **kwargs
+    )
+
+def dataset_batch(trainer):
+    return torch.stack([trainer.ds[ind] for ind in range(len(trainer.ds))])
+
+def test_uint8_batch_matches_float_batch(tmp_path):
+    float_trainer = make_trainer(tmp_path, augment_horizontal_flip = False)
+    uint8_trainer = make_trainer(tmp_path, augment_horizontal_flip = False, uint8_transfer = True)
+
+    uint8_data = dataset_batch(uint8_trainer)
+    assert uint8_data.dtype == torch.uint8
+
+    float_batch = float_trainer.prepare_batch(dataset_batch(float_trainer))
+    uint8_batch = uint8_trainer.prepare_batch(uint8_data)
+
+    assert uint8_batch.dtype == torch.float32
+    assert torch.allclose(uint8_batch, float_batch, atol = 1e-6)
+
+    # with flips, every image is flipped as a whole on the device, or left as is
+
+    flip_trainer = make_trainer(tmp_path, augment_horizontal_flip = True, uint8_transfer = True)
+    flipped = flip_trainer.prepare_batch(uint8_data)
+
+    for image, expected in zip(flipped, float_batch):
+        assert torch.allclose(image, expected, atol = 1e-6) or torch.allclose(image, expected.flip(-1), atol = 1e-6)
+
+def test_async_checkpoints_keep_last_n_and_resume(tmp_path):
+    trainer = make_trainer(tmp_path, train_num_steps = 4, save_and_sample_every = 1, async_checkpoint = True, keep_last_n_checkpoints = 2)
+    trainer.train()
+
+    assert trainer.checkpoint_milestones == [3, 4]
+    assert not any(tmp_path.glob('results/*.tmp'))
+
+    # without a milestone, load resumes from the newest checkpoint
+
+    resumed = make_trainer(tmp_path, train_num_steps = 4, save_and_sample_every = 1)
+    resumed.load()
+
+    assert resumed.step == 4
+
+    trained_model = trainer.accelerator.unwrap_model(trainer.model)
+    resumed_model = resumed.accelerator.unwrap_model(resumed.model)
+
+    for trained, loaded in zip(trained_model.parameters(), resumed_model.parameters()):
+        assert torch.equal(trained, loaded)
+
+def test_background_sampling_writes_grid(tmp_path):
+    trainer = make_trainer(tmp_path, train_num_steps = 2, save_and_sample_every = 2, sample_mode = 'background')
+    trainer.train()
+
+    assert trainer.pending_samples is None
+
+    grid = Image.open(tmp_path / 'results' / 'sample-1.png')
+    assert grid.size == (2 + 2 * (16 + 2), 2 + 2 * (16 + 2))
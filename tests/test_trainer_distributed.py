@@ -0,0 +1,110 @@
+import numpy as np
+import torch
+
+from PIL import Image
+
+from denoising_diffusion_pytorch import Unet, GaussianDiffusion, Trainer
+
+from helpers import make_image_folder, run_distributed
+
+def make_trainer(folder, results_folder, **kwargs):
+    results_folder.mkdir(parents = True, exist_ok = True)
+    torch.manual_seed(0)
+
+    model = Unet(dim = 8, dim_mults = (1, 2))
+    diffusion = GaussianDiffusion(model, image_size = 16, timesteps = 10)
+
+    return Trainer(
+        diffusion,
+        str(folder),
+        train_batch_size = 4,
+        num_samples = 4,
+        results_folder = str(results_folder),
+        **kwargs
+    )
+
+def sample_sharded_milestone(folder, results_folder):
+    trainer = make_trainer(folder, results_folder, sample_mode = 'sharded')
+    trainer.sample_milestone(1)
+    trainer.accelerator.wait_for_everyone()
+
+def grid_tiles(path, image_size = 16, padding = 2):
+    grid = np.asarray(Image.open(path), dtype = np.float32) / 255.
+    tiles = []
+
+    for row in range(2):
+        for col in range(2):
+            top, left = padding + row * (image_size + padding), padding + col * (image_size + padding)
+            tiles.append(grid[top:(top + image_size), left:(left + image_size)])
+
+    return tiles
+
+def test_sharded_milestone_samples_are_distinct_and_independent_of_world_size(tmp_path):
+    folder = make_image_folder(tmp_path / 'images')
+
+    run_distributed(sample_sharded_milestone, 1, folder, tmp_path / 'one')
+    run_distributed(sample_sharded_milestone, 2, folder, tmp_path / 'two')
+
+    one = grid_tiles(tmp_path / 'one' / 'sample-1.png')
+    two = grid_tiles(tmp_path / 'two' / 'sample-1.png')
+
+    for tile_one, tile_two in zip(one, two):
+        assert np.abs(tile_one - tile_two).max() <= 2 / 255
+
+    # tiles 0, 1 come from the first rank and 2, 3 from the second
+
+    assert np.abs(two[0] - two[2]).mean() > 0.05
+    assert np.abs(two[1] - two[3]).mean() > 0.05
+
+def train_step_with_counted_allreduce(folder, results_folder, use_no_sync):
+    from contextlib import nullcontext
+    from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+
+    trainer = make_trainer(folder, results_folder, gradient_accumulate_every = 2, train_num_steps = 1, augment_horizontal_flip = False)
+
+    if not use_no_sync:
+        trainer.accelerator.no_sync = lambda model: nullcontext()
+
+    num_allreduces = 0
+
+    def counting_hook(state, bucket):
+        nonlocal num_allreduces
+        num_allreduces += 1
+        return allreduce_hook(state, bucket)
+
+    trainer.model.register_comm_hook(None, counting_hook)
+
+    grads = None
+    opt_step = trainer.opt.step
+
+    def recording_step(*args, **kwargs):
+        nonlocal grads
+        grads = [param.grad.detach().clone() for param in trainer.model.parameters()]
+        return opt_step(*args, **kwargs)
+
+    trainer.opt.step = recording_step
+
+    torch.manual_seed(trainer.accelerator.process_index)
+    trainer.train()
+
+    torch.save(dict(grads = grads, num_allreduces = num_allreduces), results_folder / f'grads-{trainer.accelerator.process_index}.pt')
+
+def test_no_sync_gives_same_gradients_with_fewer_allreduces(tmp_path):
+    folder = make_image_folder(tmp_path / 'images')
+
+    run_distributed(train_step_with_counted_allreduce, 2, folder, tmp_path / 'no-sync', True)
+    run_distributed(train_step_with_counted_allreduce, 2, folder, tmp_path / 'sync', False)
+
+    for rank in range(2):
+        no_sync = torch.load(tmp_path / 'no-sync' / f'grads-{rank}.pt')
+        sync = torch.load(tmp_path / 'sync' / f'grads-{rank}.pt')
+
+        assert len(no_sync['grads']) == len(sync['grads'])
+
+        for no_sync_grad, sync_grad in zip(no_sync['grads'], sync['grads']):
+            assert torch.allclose(no_sync_grad, sync_grad, atol = 1e-6, rtol = 1e-4)
+
+        # the gradients are only all-reduced on the last of the two micro-batches
+
+        assert no_sync['num_allreduces'] > 0
+        assert no_sync['num_allreduces'] * 2 == sync['num_allreduces']